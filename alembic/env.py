@@ -4,6 +4,7 @@ from sqlalchemy.engine import Connection
 from sqlalchemy.ext.asyncio import create_async_engine
 
 from donate4fun.settings import load_settings
+from donate4fun.db import engine_options
 from donate4fun.db_models import Base
 
 from alembic import context
@@ -50,7 +51,7 @@ async def run_migrations_online() -> None:
 
     """
     with load_settings() as settings:
-        engine = create_async_engine(**settings.db.dict())
+        engine = create_async_engine(**engine_options(settings.db))
 
         async with engine.connect() as connection:
             await connection.run_sync(do_run_migrations)
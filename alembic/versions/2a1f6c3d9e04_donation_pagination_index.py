@@ -0,0 +1,29 @@
+"""donation pagination index
+
+Revision ID: 2a1f6c3d9e04
+Revises: b8d2e5f3a06c
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2a1f6c3d9e04'
+down_revision = 'b8d2e5f3a06c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not lock donation table for writes but could not be run inside a transaction
+    with op.get_context().autocommit_block():
+        op.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS donation_paid_or_created_at_id_idx'
+            ' ON donation (coalesce(paid_at, created_at) DESC, id DESC)'
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS donation_paid_or_created_at_id_idx')
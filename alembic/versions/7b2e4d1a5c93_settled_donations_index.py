@@ -0,0 +1,38 @@
+"""settled donations index
+
+Revision ID: 7b2e4d1a5c93
+Revises: 2a1f6c3d9e04
+Create Date: 2026-10-19 12:10:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e4d1a5c93'
+down_revision = '2a1f6c3d9e04'
+branch_labels = None
+depends_on = None
+
+indexes = {
+    'donation_settled_idx': '(coalesce(paid_at, created_at) DESC, id DESC) WHERE paid_at IS NOT NULL AND cancelled_at IS NULL',
+}
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not lock donation table for writes but could not be run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, definition in indexes.items():
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON donation {definition}')
+        # Donations lists are settled donations, so the unfiltered index is replaced by donation_settled_idx
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS donation_paid_or_created_at_id_idx')
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS donation_paid_or_created_at_id_idx'
+            ' ON donation (coalesce(paid_at, created_at) DESC, id DESC)'
+        )
+        for name in indexes:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
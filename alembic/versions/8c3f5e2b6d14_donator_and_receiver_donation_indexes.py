@@ -0,0 +1,33 @@
+"""donator and receiver donation indexes
+
+Revision ID: 8c3f5e2b6d14
+Revises: 7b2e4d1a5c93
+Create Date: 2026-10-19 12:20:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3f5e2b6d14'
+down_revision = '7b2e4d1a5c93'
+branch_labels = None
+depends_on = None
+
+indexes = {
+    'donation_donator_id_idx': '(donator_id, coalesce(paid_at, created_at) DESC, id DESC)',
+    'donation_receiver_id_idx': '(receiver_id, coalesce(paid_at, created_at) DESC, id DESC) WHERE receiver_id IS NOT NULL',
+}
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not lock donation table for writes but could not be run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, definition in indexes.items():
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON donation {definition}')
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name in indexes:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,39 @@
+"""donation target indexes
+
+Revision ID: 9d4a6f3c7e25
+Revises: 8c3f5e2b6d14
+Create Date: 2026-10-19 12:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4a6f3c7e25'
+down_revision = '8c3f5e2b6d14'
+branch_labels = None
+depends_on = None
+
+SORT_KEY = 'coalesce(paid_at, created_at) DESC, id DESC'
+CLAIMABLE = 'claimed_at IS NULL AND paid_at IS NOT NULL AND cancelled_at IS NULL'
+TARGET_COLUMNS = ['youtube_channel_id', 'twitter_account_id', 'github_user_id']
+indexes = {
+    **{f'donation_{column}_idx': f'({column}, {SORT_KEY}) WHERE {column} IS NOT NULL' for column in TARGET_COLUMNS},
+    **{
+        f'donation_{column}_claimable_idx': f'({column}) WHERE {column} IS NOT NULL AND {CLAIMABLE}'
+        for column in TARGET_COLUMNS
+    },
+}
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not lock donation table for writes but could not be run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, definition in indexes.items():
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON donation {definition}')
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name in indexes:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
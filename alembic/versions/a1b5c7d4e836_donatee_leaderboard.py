@@ -0,0 +1,59 @@
+"""donatee leaderboard
+
+Revision ID: a1b5c7d4e836
+Revises: 9d4a6f3c7e25
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1b5c7d4e836'
+down_revision = '9d4a6f3c7e25'
+branch_labels = None
+depends_on = None
+
+# table, donation column, title column, thumbnail column
+accounts = {
+    'youtube': ('youtube_channel', 'youtube_channel_id', 'title', 'thumbnail_url'),
+    'twitter': ('twitter_author', 'twitter_account_id', 'name', 'profile_image_url'),
+    'github': ('github_user', 'github_user_id', 'name', 'avatar_url'),
+}
+
+
+def upgrade() -> None:
+    op.create_table(
+        'donatee_leaderboard',
+        sa.Column('type', sa.String(), nullable=False),
+        sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('thumbnail_url', sa.String(), nullable=True),
+        sa.Column('balance', sa.BigInteger(), nullable=False),
+        sa.Column('total_donated', sa.BigInteger(), nullable=False),
+        sa.Column('last_donated_at', postgresql.TIMESTAMP(), nullable=True),
+        sa.PrimaryKeyConstraint('type', 'id'),
+    )
+    op.create_index('donatee_leaderboard_total_donated_idx', 'donatee_leaderboard', [sa.text('total_donated DESC')])
+    op.create_index(
+        'donatee_leaderboard_balance_idx', 'donatee_leaderboard', [sa.text('balance DESC')],
+        postgresql_where=sa.text('balance > 0'),
+    )
+    op.create_index('donatee_leaderboard_last_donated_at_idx', 'donatee_leaderboard', [sa.text('last_donated_at DESC')])
+    for type_, (table, donation_column, title, thumbnail_url) in accounts.items():
+        op.execute(f"""
+            INSERT INTO donatee_leaderboard
+            SELECT
+                '{type_}', id, {title}, {thumbnail_url}, balance, total_donated,
+                (
+                    SELECT max(paid_at) FROM donation
+                    WHERE donation.{donation_column} = {table}.id AND cancelled_at IS NULL
+                )
+            FROM {table}
+        """)
+
+
+def downgrade() -> None:
+    op.drop_table('donatee_leaderboard')
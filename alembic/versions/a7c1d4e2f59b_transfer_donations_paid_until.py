@@ -0,0 +1,25 @@
+"""transfer donations_paid_until
+
+Revision ID: a7c1d4e2f59b
+Revises: f6a0b2c9d38b
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c1d4e2f59b'
+down_revision = 'f6a0b2c9d38b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Not yet stamped transfers fall back to created_at
+    op.add_column('transfer', sa.Column('donations_paid_until', sa.TIMESTAMP(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('transfer', 'donations_paid_until')
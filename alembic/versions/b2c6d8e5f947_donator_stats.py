@@ -0,0 +1,62 @@
+"""donator stats
+
+Revision ID: b2c6d8e5f947
+Revises: a1b5c7d4e836
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2c6d8e5f947'
+down_revision = 'a1b5c7d4e836'
+branch_labels = None
+depends_on = None
+
+SETTLED = (
+    'donation.paid_at IS NOT NULL AND donation.cancelled_at IS NULL'
+    ' AND (donation.receiver_id IS NULL OR donation.receiver_id != donation.donator_id)'
+)
+
+
+def upgrade() -> None:
+    op.create_table(
+        'donator_stats',
+        sa.Column('donator_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('total_donated', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+        sa.Column('total_claimed', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+        sa.Column('total_received', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+        sa.ForeignKeyConstraint(['donator_id'], ['donator.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('donator_id'),
+    )
+    op.execute(f"""
+        INSERT INTO donator_stats (donator_id, total_donated, total_claimed)
+        SELECT donator_id, sum(amount), sum(CASE WHEN claimed_at IS NULL THEN 0 ELSE amount END)
+        FROM donation
+        WHERE {SETTLED} AND donator_id IS NOT NULL
+        GROUP BY donator_id
+    """)
+    op.execute(f"""
+        INSERT INTO donator_stats (donator_id, total_received)
+        SELECT donator_id, sum(amount) FROM (
+            SELECT receiver_id AS donator_id, amount FROM donation
+            WHERE {SETTLED} AND receiver_id IS NOT NULL
+            UNION ALL
+            SELECT youtube_channel_link.donator_id, amount FROM donation
+            JOIN youtube_channel_link ON youtube_channel_link.youtube_channel_id = donation.youtube_channel_id
+            WHERE {SETTLED}
+            UNION ALL
+            SELECT twitter_author_link.donator_id, amount FROM donation
+            JOIN twitter_author_link ON twitter_author_link.twitter_author_id = donation.twitter_account_id
+            WHERE {SETTLED}
+        ) AS received
+        GROUP BY donator_id
+        ON CONFLICT (donator_id) DO UPDATE SET total_received = excluded.total_received
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('donator_stats')
@@ -0,0 +1,50 @@
+"""push subscriptions
+
+Revision ID: b8d2e5f3a06c
+Revises:
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d2e5f3a06c'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'push_subscription',
+        sa.Column('id', postgresql.UUID(as_uuid=True), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+        sa.Column('donator_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('endpoint', sa.String(), nullable=False),
+        sa.Column('p256dh', sa.String(), nullable=False),
+        sa.Column('auth', sa.String(), nullable=False),
+        sa.Column('created_at', postgresql.TIMESTAMP(), server_default=sa.text('now()'), nullable=False),
+        sa.ForeignKeyConstraint(['donator_id'], ['donator.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('endpoint'),
+    )
+    op.create_index('ix_push_subscription_donator_id', 'push_subscription', ['donator_id'])
+    op.create_table(
+        'push_delivery',
+        sa.Column('id', postgresql.UUID(as_uuid=True), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+        sa.Column('subscription_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('payload', sa.String(), nullable=False),
+        sa.Column('attempts', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+        sa.Column('next_attempt_at', postgresql.TIMESTAMP(), server_default=sa.text('now()'), nullable=False),
+        sa.ForeignKeyConstraint(['subscription_id'], ['push_subscription.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('subscription_id'),
+    )
+    op.create_index('ix_push_delivery_next_attempt_at', 'push_delivery', ['next_attempt_at'])
+
+
+def downgrade() -> None:
+    op.drop_table('push_delivery')
+    op.drop_table('push_subscription')
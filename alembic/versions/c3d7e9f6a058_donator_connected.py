@@ -0,0 +1,32 @@
+"""donator connected
+
+Revision ID: c3d7e9f6a058
+Revises: b2c6d8e5f947
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d7e9f6a058'
+down_revision = 'b2c6d8e5f947'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('donator', sa.Column('connected', sa.Boolean(), server_default='f', nullable=False))
+    op.execute("""
+        UPDATE donator SET connected = (
+            lnauth_pubkey IS NOT NULL
+            OR EXISTS (SELECT 1 FROM youtube_channel_link WHERE donator_id = donator.id AND via_oauth)
+            OR EXISTS (SELECT 1 FROM twitter_author_link WHERE donator_id = donator.id AND via_oauth)
+            OR EXISTS (SELECT 1 FROM github_user_link WHERE donator_id = donator.id AND via_oauth)
+        )
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('donator', 'connected')
@@ -0,0 +1,40 @@
+"""donation payment hash
+
+Revision ID: c9e3f6a4b17d
+Revises: a7c1d4e2f59b
+Create Date: 2026-10-19 23:00:00.000000
+
+Unique constraints on donation.r_hash and donation.transient_r_hash were dropped by donation partitioning,
+this table keeps payment hashes unique.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e3f6a4b17d'
+down_revision = 'a7c1d4e2f59b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'donation_payment_hash',
+        sa.Column('r_hash', sa.String(), nullable=False),
+        sa.Column('transient', sa.Boolean(), nullable=False),
+        sa.Column('donation_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.PrimaryKeyConstraint('r_hash', 'transient'),
+    )
+    # Fails if duplicates were created after partitioning, they should be resolved manually
+    op.execute("""
+        INSERT INTO donation_payment_hash (r_hash, transient, donation_id)
+        SELECT r_hash, false, id FROM donation WHERE r_hash IS NOT NULL
+        UNION ALL
+        SELECT transient_r_hash, true, id FROM donation WHERE transient_r_hash IS NOT NULL
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('donation_payment_hash')
@@ -0,0 +1,28 @@
+"""drop donation sort key index
+
+Revision ID: d0f4a7b5c28e
+Revises: c9e3f6a4b17d
+Create Date: 2026-10-20 00:00:00.000000
+
+donation_paid_or_created_at_id_idx has the same key as donation_settled_idx,
+and lists not filtered by donator or target are of settled donations, so it only slowed down writes.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd0f4a7b5c28e'
+down_revision = 'c9e3f6a4b17d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Index of a partitioned table could not be dropped concurrently, dropping it drops indexes of all partitions
+    op.execute('DROP INDEX IF EXISTS donation_paid_or_created_at_id_idx')
+    op.execute('DROP INDEX IF EXISTS donation_legacy_paid_or_created_at_id_idx')
+
+
+def downgrade() -> None:
+    # Earlier migrations do not create this index anymore, so it's not restored
+    pass
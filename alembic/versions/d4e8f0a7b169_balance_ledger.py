@@ -0,0 +1,36 @@
+"""balance ledger
+
+Revision ID: d4e8f0a7b169
+Revises: c3d7e9f6a058
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e8f0a7b169'
+down_revision = 'c3d7e9f6a058'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'balance_ledger',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('account_type', sa.String(), nullable=False),
+        sa.Column('account_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('balance_diff', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+        sa.Column('total_diff', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+        sa.Column('donated_at', sa.TIMESTAMP(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('balance_ledger_account_idx', 'balance_ledger', ['account_type', 'account_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('balance_ledger_account_idx', table_name='balance_ledger')
+    op.drop_table('balance_ledger')
@@ -0,0 +1,54 @@
+"""transfer donation ids
+
+Revision ID: e1b7c4d2a85f
+Revises: d0f4a7b5c28e
+Create Date: 2026-10-20 01:00:00.000000
+
+Transfers record ids of transferred donations instead of paid_at watermark, so stamping does not depend on sums matching.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1b7c4d2a85f'
+down_revision = 'd0f4a7b5c28e'
+branch_labels = None
+depends_on = None
+
+# transfer column -> donation column
+TARGET_COLUMNS = {
+    'youtube_channel_id': 'youtube_channel_id',
+    'twitter_author_id': 'twitter_account_id',
+    'github_user_id': 'github_user_id',
+}
+CLAIMABLE = 'donation.claimed_at IS NULL AND donation.paid_at IS NOT NULL AND donation.cancelled_at IS NULL'
+
+
+def upgrade() -> None:
+    op.add_column('transfer', sa.Column(
+        'donation_ids', postgresql.ARRAY(postgresql.UUID(as_uuid=True)), server_default='{}', nullable=False,
+    ))
+    # Not yet stamped transfers get donations they would have been stamped with
+    for transfer_column, donation_column in TARGET_COLUMNS.items():
+        op.execute(f"""
+            UPDATE transfer SET donation_ids = ARRAY(
+                SELECT donation.id FROM donation
+                WHERE donation.{donation_column} = transfer.{transfer_column} AND {CLAIMABLE}
+                    AND donation.paid_at <= coalesce(transfer.donations_paid_until, transfer.created_at)
+            )
+            WHERE transfer.stamped_at IS NULL AND transfer.{transfer_column} IS NOT NULL
+        """)
+    op.drop_column('transfer', 'donations_paid_until')
+
+
+def downgrade() -> None:
+    op.add_column('transfer', sa.Column('donations_paid_until', sa.TIMESTAMP(), nullable=True))
+    op.execute("""
+        UPDATE transfer SET donations_paid_until = (
+            SELECT max(donation.paid_at) FROM donation WHERE donation.id = ANY(transfer.donation_ids)
+        )
+        WHERE transfer.stamped_at IS NULL
+    """)
+    op.drop_column('transfer', 'donation_ids')
@@ -0,0 +1,31 @@
+"""transfer stamped_at
+
+Revision ID: e5f9a1b8c27a
+Revises: d4e8f0a7b169
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5f9a1b8c27a'
+down_revision = 'd4e8f0a7b169'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('transfer', sa.Column('stamped_at', sa.TIMESTAMP(), nullable=True))
+    # Donations of existing transfers are already marked as claimed
+    op.execute("UPDATE transfer SET stamped_at = created_at")
+    op.create_index(
+        'transfer_not_stamped_idx', 'transfer', ['created_at'],
+        postgresql_where=sa.text('stamped_at IS NULL'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('transfer_not_stamped_idx', table_name='transfer')
+    op.drop_column('transfer', 'stamped_at')
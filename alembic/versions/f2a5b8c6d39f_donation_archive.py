@@ -0,0 +1,49 @@
+"""donation archive
+
+Revision ID: f2a5b8c6d39f
+Revises: e1b7c4d2a85f
+Create Date: 2026-10-20 02:00:00.000000
+
+Totals of detached donation partitions, so rebuilt stats and leaderboard do not lose their donations.
+The empty default partition is dropped, because it forbids DETACH PARTITION CONCURRENTLY.
+If it has rows, it's kept and partitions are not detached until the rows are moved.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a5b8c6d39f'
+down_revision = 'e1b7c4d2a85f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'donation_archive',
+        sa.Column('partition', sa.String(), nullable=False),
+        sa.Column('account_column', sa.String(), nullable=False),
+        sa.Column('account_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('amount', sa.BigInteger(), nullable=False),
+        sa.Column('claimed_amount', sa.BigInteger(), nullable=False),
+        sa.Column('last_paid_at', postgresql.TIMESTAMP(), nullable=True),
+        sa.PrimaryKeyConstraint('partition', 'account_column', 'account_id'),
+    )
+    op.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM donation_default) THEN
+                DROP TABLE donation_default;
+            ELSE
+                RAISE WARNING 'donation_default has rows, donation partitions will not be detached';
+            END IF;
+        END
+        $$
+    """)
+
+
+def downgrade() -> None:
+    op.execute('CREATE TABLE IF NOT EXISTS donation_default PARTITION OF donation DEFAULT')
+    op.drop_table('donation_archive')
@@ -0,0 +1,112 @@
+"""donation partitions
+
+Revision ID: f6a0b2c9d38b
+Revises: e5f9a1b8c27a
+Create Date: 2026-10-19 20:00:00.000000
+
+Existing donation table becomes a partition for rows created before the next month (donation_legacy),
+so rows are not copied and writes are blocked only for catalog changes.
+New rows go to monthly partitions (see donate4fun/db_partitions.py).
+"""
+from datetime import datetime
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a0b2c9d38b'
+down_revision = 'e5f9a1b8c27a'
+branch_labels = None
+depends_on = None
+
+SORT_KEY = 'coalesce(paid_at, created_at) DESC, id DESC'
+CLAIMABLE = 'claimed_at IS NULL AND paid_at IS NOT NULL AND cancelled_at IS NULL'
+TARGET_COLUMNS = ['youtube_channel_id', 'twitter_account_id', 'github_user_id']
+# Indexes of the partitioned table, the same indexes of the legacy table are attached to them
+indexes = {
+    'donation_r_hash_idx': '(r_hash)',
+    'donation_transient_r_hash_idx': '(transient_r_hash)',
+    'donation_settled_idx': f'({SORT_KEY}) WHERE paid_at IS NOT NULL AND cancelled_at IS NULL',
+    'donation_donator_id_idx': f'(donator_id, {SORT_KEY})',
+    'donation_receiver_id_idx': f'(receiver_id, {SORT_KEY}) WHERE receiver_id IS NOT NULL',
+    **{f'donation_{column}_idx': f'({column}, {SORT_KEY}) WHERE {column} IS NOT NULL' for column in TARGET_COLUMNS},
+    **{
+        f'donation_{column}_claimable_idx': f'({column}) WHERE {column} IS NOT NULL AND {CLAIMABLE}'
+        for column in TARGET_COLUMNS
+    },
+}
+foreign_keys = {
+    'receiver_id': 'donator',
+    'youtube_channel_id': 'youtube_channel',
+    'youtube_video_id': 'youtube_video',
+    'twitter_account_id': 'twitter_author',
+    'twitter_tweet_id': 'twitter_tweet',
+    'github_user_id': 'github_user',
+    'donator_twitter_account_id': 'twitter_author',
+}
+MONTHS_AHEAD = 2
+
+
+def month_start(value: datetime, months: int = 0) -> datetime:
+    month_index: int = value.year * 12 + value.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def legacy_index_name(name: str) -> str:
+    return name.replace('donation_', 'donation_legacy_', 1)
+
+
+def upgrade() -> None:
+    cutover: datetime = month_start(datetime.utcnow(), 1)
+    # CONCURRENTLY does not lock donation table for writes but could not be run inside a transaction.
+    # Primary key and unique indexes of a partitioned table must include created_at.
+    # Validated CHECK constraint lets ATTACH PARTITION skip the scan of all rows.
+    with op.get_context().autocommit_block():
+        op.execute('CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS donation_id_created_at_idx ON donation (id, created_at)')
+        for name in ['donation_r_hash_idx', 'donation_transient_r_hash_idx']:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON donation {indexes[name]}')
+        op.execute('ALTER TABLE donation DROP CONSTRAINT IF EXISTS donation_legacy_bound')
+        op.execute(
+            f"ALTER TABLE donation ADD CONSTRAINT donation_legacy_bound CHECK (created_at < '{cutover.isoformat()}') NOT VALID"
+        )
+        op.execute('ALTER TABLE donation VALIDATE CONSTRAINT donation_legacy_bound')
+
+    op.execute('ALTER TABLE donation DROP CONSTRAINT donation_pkey')
+    op.execute('ALTER TABLE donation ADD CONSTRAINT donation_legacy_pkey PRIMARY KEY USING INDEX donation_id_created_at_idx')
+    op.execute('ALTER TABLE donation RENAME TO donation_legacy')
+    for name in indexes:
+        op.execute(f'ALTER INDEX {name} RENAME TO {legacy_index_name(name)}')
+
+    op.execute(
+        'CREATE TABLE donation (LIKE donation_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        ' PARTITION BY RANGE (created_at)'
+    )
+    op.execute('ALTER TABLE donation DROP CONSTRAINT donation_legacy_bound')
+    op.execute('ALTER TABLE donation ADD PRIMARY KEY (id, created_at)')
+    for column, table in foreign_keys.items():
+        op.execute(f'ALTER TABLE donation ADD FOREIGN KEY ({column}) REFERENCES {table} (id)')
+    for name, definition in indexes.items():
+        op.execute(f'CREATE INDEX {name} ON donation {definition}')
+
+    op.execute(f"ALTER TABLE donation ATTACH PARTITION donation_legacy FOR VALUES FROM (MINVALUE) TO ('{cutover.isoformat()}')")
+    op.execute('CREATE TABLE donation_default PARTITION OF donation DEFAULT')
+    for months in range(MONTHS_AHEAD + 1):
+        start, end = month_start(cutover, months), month_start(cutover, months + 1)
+        op.execute(
+            f"CREATE TABLE donation_y{start:%Y}m{start:%m} PARTITION OF donation"
+            f" FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+
+
+def downgrade() -> None:
+    op.execute('ALTER TABLE donation DETACH PARTITION donation_legacy')
+    op.execute('ALTER TABLE donation_legacy DROP CONSTRAINT donation_legacy_bound')
+    op.execute('INSERT INTO donation_legacy SELECT * FROM donation')
+    op.execute('DROP TABLE donation')
+    op.execute('ALTER TABLE donation_legacy RENAME TO donation')
+    for name in indexes:
+        op.execute(f'ALTER INDEX {legacy_index_name(name)} RENAME TO {name}')
+    op.execute('DROP INDEX donation_r_hash_idx')
+    op.execute('DROP INDEX donation_transient_r_hash_idx')
+    op.execute('ALTER TABLE donation DROP CONSTRAINT donation_legacy_pkey')
+    op.execute('ALTER TABLE donation ADD PRIMARY KEY (id)')
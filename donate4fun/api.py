@@ -1,8 +1,11 @@
 import logging
 from uuid import UUID
+from datetime import timedelta
 from functools import partial
 from urllib.parse import urlencode
+from contextlib import AsyncExitStack
 
+import anyio
 import ecdsa
 import posthog
 from fastapi import FastAPI, WebSocket, Request, Depends, Query, WebSocketDisconnect
@@ -19,20 +22,21 @@ from jwt import InvalidTokenError
 from .models import (
     Donation, Donator, Invoice,
     WithdrawalToken, BaseModel, Notification, Credentials, SubscribeEmailRequest,
-    DonatorStats, PayInvoiceResult, Donatee, OAuthState, SocialProvider, Toast,
+    DonatorStats, PayInvoiceResult, Donatee, OAuthState, SocialProvider, Toast, ResumeToken, ReconnectHint,
 )
-from .types import ValidationError, PaymentRequest, OAuthError, LnurlpError, AccountAlreadyLinked
+from .types import ValidationError, PaymentRequest, OAuthError, LnurlpError, AccountAlreadyLinked, QueryBudgetExceeded
 from .core import to_base64
+from .db import DbSession
 from .db_models import WithdrawalDb
-from .db_libs import WithdrawalDbLib, DonationsDbLib, OtherDbLib
+from .db_libs import WithdrawalDbLib, DonationsDbLib, OtherDbLib, DonatorStatsDbLib
 from .settings import settings
 from .api_utils import (
-    get_donator, load_donator, get_db_session, task_group, only_me, make_redirect, get_donations_db, sha256hash,
-    oauth_success_messages, signin_success_message,
+    get_donator, load_donator, get_db_session, get_read_only_db_session, task_group, only_me, make_redirect, sha256hash,
+    oauth_success_messages, signin_success_message, endpoint_budget, run_transaction, get_async_commit_db_session,
 )
 from .lnd import PayInvoiceError, LnurlWithdrawResponse, lnd, lightning_payment_metadata, LndIsNotReady
 from .pubsub import pubsub
-from . import api_twitter, api_youtube, api_github, api_social, api_donation
+from . import api_twitter, api_youtube, api_github, api_social, api_donation, api_push
 
 
 logger = logging.getLogger(__name__)
@@ -43,6 +47,7 @@ app.include_router(api_youtube.legacy_router)
 app.include_router(api_github.router)
 app.include_router(api_social.router)
 app.include_router(api_donation.router)
+app.include_router(api_push.router)
 
 
 @router.exception_handler(LnurlpError)
@@ -76,6 +81,12 @@ def no_result_found_handler(request, exc):
     return JSONResponse(status_code=404, content=dict(message="Item not found"))
 
 
+@app.exception_handler(QueryBudgetExceeded)
+def query_budget_exceeded_handler(request, exc):
+    logger.warning(f"{request.url}: {exc}")
+    return JSONResponse(status_code=503, content=dict(message=f"Request took too long: {exc}"))
+
+
 @app.exception_handler(ValidationError)
 def validation_error_handler(request, exc):
     return JSONResponse(
@@ -108,7 +119,7 @@ class StatusResponse(BaseModel):
 
 @router.head("/status")
 @router.get("/status")
-async def status(db=Depends(get_db_session)):
+async def status(db=Depends(get_read_only_db_session)):
     return StatusResponse(
         db=await db.query_status(),
         lnd=await lnd.query_state(),
@@ -116,7 +127,7 @@ async def status(db=Depends(get_db_session)):
 
 
 @router.get("/me", response_model=Donator)
-async def new_me(request: Request, db=Depends(get_db_session), me: Donator = Depends(get_donator)):
+async def new_me(request: Request, db=Depends(get_read_only_db_session), me: Donator = Depends(get_donator)):
     me = await load_donator(db, me.id)
     # FIXME: balance is saved in cookie to notify extension about balance change, but it should be done via VAPID
     request.session['balance'] = me.balance
@@ -131,7 +142,7 @@ class MeResponse(BaseModel):
 
 
 @router.get("/donator/me", response_model=MeResponse, deprecated=True)
-async def me(request: Request, db=Depends(get_db_session), me: Donator = Depends(get_donator)):
+async def me(request: Request, db=Depends(get_read_only_db_session), me: Donator = Depends(get_donator)):
     """
     Deprecated, remove when all browser extension instances update
     """
@@ -150,14 +161,14 @@ class DonatorResponse(BaseModel):
 
 
 @router.get("/donator/{donator_id}", response_model=DonatorResponse)
-async def donator(request: Request, donator_id: UUID, db=Depends(get_db_session), me: Donator = Depends(get_donator)):
+async def donator(request: Request, donator_id: UUID, db=Depends(get_read_only_db_session), me: Donator = Depends(get_donator)):
     donator = await load_donator(db, donator_id)
     return DonatorResponse(**donator.dict())
 
 
 @router.get("/donator/{donator_id}/stats", response_model=DonatorStats)
-async def donator_stats(request: Request, donator_id: UUID, db=Depends(get_donations_db), me=Depends(only_me)):
-    return await db.query_donator_stats(donator_id)
+async def donator_stats(request: Request, donator_id: UUID, db=Depends(get_read_only_db_session), me=Depends(only_me)):
+    return await DonatorStatsDbLib(db).query_donator_stats(donator_id)
 
 
 @router.get('/lnurl/withdraw', response_model=LnurlWithdrawResponse)
@@ -246,17 +257,27 @@ async def payment_callback(
     )
 
 
+async def pay_withdrawal(
+    db_session: DbSession, *, withdrawal_id: UUID, payment_request: PaymentRequest, amount: int, lnd, task_status: TaskStatus,
+):
+    withdrawal_db = WithdrawalDbLib(db_session)
+    await withdrawal_db.start_withdraw(withdrawal_id=withdrawal_id, amount=amount, fee_msat=settings.fee_limit * 1000)
+    # Payment could not be repeated, so the transaction is not retried after it
+    db_session.retryable = False
+    task_status.started()
+    result: PayInvoiceResult = await lnd.pay_invoice(payment_request)
+    await withdrawal_db.finish_withdraw(withdrawal_id=withdrawal_id, fee_msat=result.fee_msat)
+
+
 async def send_withdrawal(
     *, donator_id: UUID, withdrawal_id: UUID, payment_request: PaymentRequest, amount: int, lnd, db,
     task_status: TaskStatus,
 ):
     try:
-        async with db.session() as db_session:
-            withdrawal_db = WithdrawalDbLib(db_session)
-            await withdrawal_db.start_withdraw(withdrawal_id=withdrawal_id, amount=amount, fee_msat=settings.fee_limit * 1000)
-            task_status.started()
-            result: PayInvoiceResult = await lnd.pay_invoice(payment_request)
-            await withdrawal_db.finish_withdraw(withdrawal_id=withdrawal_id, fee_msat=result.fee_msat)
+        await db.transact(
+            pay_withdrawal, withdrawal_id=withdrawal_id, payment_request=payment_request, amount=amount, lnd=lnd,
+            task_status=task_status,
+        )
     except PayInvoiceError as exc:
         logger.exception("Failed to send withdrawal payment")
         params = dict(amount=amount, withdrawal_id=withdrawal_id, message=str(exc))
@@ -325,24 +346,55 @@ async def disconnect_wallet(db=Depends(get_db_session), donator=Depends(get_dona
     posthog.capture(donator.id, 'disconnect-wallet')
 
 
+async def close_with_reconnect_hint(websocket: WebSocket, code: int, reconnect_after: float, topics: list[str]):
+    hint = ReconnectHint(reconnect_after=reconnect_after, resume_token=ResumeToken(topics=topics).to_jwt())
+    await websocket.send_text(hint.json())
+    await websocket.close(code=code)
+
+
 @router.websocket('/subscribe/{topic}')
-async def subscribe(websocket: WebSocket, topic: str):
+async def subscribe(websocket: WebSocket, topic: str, resume_token: str | None = None):
+    """
+    *resume_token* is received in RECONNECT message, it restores all topics of the closed connection
+    """
     logger.trace("Websocket connection request: %s", topic)
+    topics = [topic]
+    if resume_token is not None:
+        try:
+            topics.extend(topic_ for topic_ in ResumeToken.from_jwt(resume_token).topics if topic_ not in topics)
+        except InvalidTokenError as exc:
+            logger.debug(f"Invalid resume token for {topic}: {exc}")
 
     async def send_to_websocket(msg: str):
         await websocket.send_text(msg)
 
     await websocket.accept()
-    logger.trace("Websocket connection accepted: %s", topic)
-    async with pubsub.subscribe(topic, send_to_websocket):
-        while True:
-            try:
-                msg = await websocket.receive_json()
-            except WebSocketDisconnect:
-                logger.debug(f"Websocket {topic} disconnected")
-                break
-            else:
-                logger.debug(f"Received '{msg}' from websocket for topic {topic}")
+    if retry_after := pubsub.admit():
+        logger.debug(f"Websocket {topic} is not admitted, retry after {retry_after:.1f}s")
+        # 1013 - Try Again Later
+        await close_with_reconnect_hint(websocket, code=1013, reconnect_after=retry_after, topics=topics)
+        return
+    logger.trace("Websocket connection accepted: %s", topics)
+    async with pubsub.connection() as shutting_down, AsyncExitStack() as stack, anyio.create_task_group() as tg:
+        for topic_ in topics:
+            await stack.enter_async_context(pubsub.subscribe(topic_, send_to_websocket))
+
+        async def receive():
+            while True:
+                try:
+                    msg = await websocket.receive_json()
+                except WebSocketDisconnect:
+                    logger.debug(f"Websocket {topic} disconnected")
+                    break
+                else:
+                    logger.debug(f"Received '{msg}' from websocket for topic {topic}")
+            tg.cancel_scope.cancel()
+
+        tg.start_soon(receive)
+        await shutting_down.wait()
+        # 1012 - Service Restart
+        await close_with_reconnect_hint(websocket, code=1012, reconnect_after=pubsub.reconnect_delay(), topics=topics)
+        tg.cancel_scope.cancel()
 
 
 class UpdateSessionRequest(BaseModel):
@@ -357,12 +409,12 @@ async def update_session(request: Request, req: UpdateSessionRequest):
 
 
 @router.get("/donatee/recently-donated", response_model=list[Donatee])
-async def recently_donated_donatees(db=Depends(get_db_session)):
+async def recently_donated_donatees(db=Depends(get_read_only_db_session)):
     return await OtherDbLib(db).query_recently_donated_donatees(limit=20)
 
 
 @router.post("/subscribe-email", response_model=UUID | None)
-async def subscribe_email(request: SubscribeEmailRequest, db=Depends(get_db_session), me=Depends(get_donator)):
+async def subscribe_email(request: SubscribeEmailRequest, db=Depends(get_async_commit_db_session), me=Depends(get_donator)):
     subscription_id: UUID = await OtherDbLib(db).save_email(request.email)
     posthog.capture(me.id, 'subscribe-email')
     return subscription_id
@@ -374,13 +426,17 @@ class WithdrawResponse(BaseModel):
     withdrawal_id: UUID
 
 
-@router.get('/me/withdraw', response_model=WithdrawResponse)
-async def withdraw(request: Request, db=Depends(get_db_session), me: Donator = Depends(get_donator)):
+async def create_withdrawal(db: DbSession, donator_id: UUID) -> WithdrawalDb:
     # Refresh balance
-    me = await load_donator(db, me.id)
+    me = await load_donator(db, donator_id)
     if me.balance < settings.min_withdraw:
         raise ValidationError(f"Minimum amount to withdraw is {settings.min_withdraw}, but available only {me.balance}.")
-    withdrawal: WithdrawalDb = await WithdrawalDbLib(db).create_withdrawal(donator=me)
+    return await WithdrawalDbLib(db).create_withdrawal(donator=me)
+
+
+@router.get('/me/withdraw', response_model=WithdrawResponse)
+async def withdraw(request: Request, me: Donator = Depends(get_donator)):
+    withdrawal: WithdrawalDb = await run_transaction(request, create_withdrawal, me.id)
     token = WithdrawalToken(
         withdrawal_id=withdrawal.id,
     )
@@ -445,5 +501,6 @@ async def oauth_redirect(
 
 
 @router.get("/donatees/top-unclaimed", response_model=list[Donatee])
-async def donatees_list(db=Depends(get_db_session), limit: int = 20, offset: int = 0):
+@endpoint_budget(statement_timeout=timedelta(seconds=2), max_queries=1)
+async def donatees_list(db=Depends(get_read_only_db_session), limit: int = 20, offset: int = 0):
     return await OtherDbLib(db).query_top_unclaimed_donatees(limit=limit, offset=offset)
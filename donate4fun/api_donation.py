@@ -2,10 +2,10 @@ import json
 import logging
 import hashlib
 from uuid import UUID
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import httpx
-from fastapi import Request, Depends, HTTPException, APIRouter
+from fastapi import Request, Response, Depends, HTTPException, APIRouter
 from sqlalchemy import select
 from lnpayencode import LnAddr
 
@@ -15,11 +15,14 @@ from .models import (
 )
 from .types import ValidationError, LnurlpError
 from .api_utils import (
-    get_donator, get_db_session, load_donator, auto_transfer_donations, track_donation, HttpClient, get_donations_db, only_me,
-    sha256hash, get_social_provider_db,
+    get_donator, load_donator, auto_transfer_donations, track_donation, HttpClient, get_donations_db, only_me,
+    sha256hash, get_social_provider_db, paginate_donations, get_read_only_db_session, get_read_only_donations_db,
+    endpoint_budget, run_transaction,
 )
+from .db import DbSession
 from .db_libs import GithubDbLib, TwitterDbLib, YoutubeDbLib, DonationsDbLib
-from .db_donations import sent_donations_subquery, received_donations_subquery
+from .db_donations import DonationProjection
+from .db_stats import sent_donations_subquery, received_donations_subquery
 from .db_models import DonationDb
 from .db_social import SocialDbWrapper
 from .twitter import query_or_fetch_twitter_account
@@ -44,9 +47,14 @@ def make_memo(donation: Donation) -> str:
 
 
 @router.post("/donate", response_model=DonateResponse)
-async def donate(
-    web_request: Request, request: DonateRequest, donator: Donator = Depends(get_donator), db_session=Depends(get_db_session),
- ) -> DonateResponse:
+async def donate(web_request: Request, request: DonateRequest, donator: Donator = Depends(get_donator)) -> DonateResponse:
+    response: DonateResponse = await run_transaction(web_request, make_donation, web_request, request, donator)
+    if response.payment_request is None:
+        track_donation(response.donation)
+    return response
+
+
+async def make_donation(db_session: DbSession, web_request: Request, request: DonateRequest, donator: Donator) -> DonateResponse:
     logger.debug(
         "Donator %s wants to donate %d to %s",
         donator.id, request.amount, request.target or request.channel_id or request.lightning_address,
@@ -109,6 +117,8 @@ async def donate(
     await donations_db.create_donation(donation)
     if use_balance:
         if donation.lightning_address:
+            # Payment could not be repeated, so the transaction is not retried after it
+            db_session.retryable = False
             pay_result: PayInvoiceResult = await lnd.pay_invoice(pay_req)
             amount = pay_result.value_sat
             paid_at = pay_result.creation_date
@@ -127,7 +137,6 @@ async def donate(
         donation = await donations_db.query_donation(id=donation.id)
         # FIXME: balance is saved in cookie to notify extension about balance change, but it should be done via VAPID
         web_request.session['balance'] = (await db_session.query_donator(id=donator.id)).balance
-        track_donation(donation)
         return DonateResponse(donation=donation, payment_request=None)
     else:
         return DonateResponse(donation=donation, payment_request=pay_req)
@@ -211,11 +220,19 @@ async def get_donation(donation_id: UUID, db_session=Depends(get_donations_db)):
 
 
 @router.post("/donation/{donation_id}/paid", response_model=Donation)
-async def donation_paid(donation_id: UUID, request: DonationPaidRequest, db=Depends(get_donations_db)):
-    donation: Donation = await db.query_donation(id=donation_id)
+async def donation_paid(web_request: Request, donation_id: UUID, request: DonationPaidRequest):
+    donation: Donation | None = await run_transaction(web_request, mark_donation_paid, donation_id, request)
+    if donation is not None:
+        track_donation(donation)
+    return donation
+
+
+async def mark_donation_paid(db_session: DbSession, donation_id: UUID, request: DonationPaidRequest) -> Donation | None:
+    db = DonationsDbLib(db_session)
+    donation: Donation = await db.query_donation(id=donation_id, projection=DonationProjection.ids)
     if donation.lightning_address is None:
         # Do nothing for all other cases
-        return
+        return None
     digest = RequestHash(hashlib.sha256(bytes.fromhex(request.preimage)).digest())
     if digest != donation.transient_r_hash:
         raise ValidationError(f"Preimage hash does not match {digest}")
@@ -223,9 +240,7 @@ async def donation_paid(donation_id: UUID, request: DonationPaidRequest, db=Depe
         raise ValidationError(f"Donation amount do not match {request.route.total_amt}")
     now = datetime.utcnow()
     await db.donation_paid(donation.id, donation.amount, paid_at=now, fee_msat=request.route.total_fees * 1000, claimed_at=now)
-    donation = await db.query_donation(id=donation.id)
-    track_donation(donation)
-    return donation
+    return await db.query_donation(id=donation.id)
 
 
 @router.post("/donation/{donation_id}/cancel")
@@ -242,38 +257,56 @@ async def cancel_donation(donation_id: UUID, db=Depends(get_donations_db), me=De
 
 
 @router.get("/donations/latest", response_model=list[Donation])
-async def latest_donations(offset: int = 0, db=Depends(get_donations_db)):
-    return await db.query_donations(
+async def latest_donations(
+    response: Response, offset: int = 0, cursor: str | None = None, db=Depends(get_read_only_donations_db),
+):
+    return await paginate_donations(
+        db,
+        response,
         DonationDb.paid_at.isnot(None)
         & DonationDb.cancelled_at.is_(None)
         & (
             (DonationDb.receiver_id != DonationDb.donator_id)
             | DonationDb.receiver_id.is_(None)
         ),
-        limit=settings.latest_donations_count, offset=offset,
+        limit=settings.latest_donations_count, offset=offset, cursor=cursor,
     )
 
 
 @router.get("/donations/by-donator/{donator_id}", response_model=list[Donation])
-async def donator_donations(donator_id: UUID, db=Depends(get_donations_db), me=Depends(only_me), offset: int = 0):
-    return await db.query_donations(
+async def donator_donations(
+    donator_id: UUID, response: Response, db=Depends(get_read_only_donations_db), me=Depends(only_me), offset: int = 0,
+    cursor: str | None = None,
+):
+    return await paginate_donations(
+        db,
+        response,
         DonationDb.paid_at.isnot(None) & (
             (DonationDb.donator_id == donator_id)
             | (DonationDb.receiver_id == donator_id)
         ),
-        offset=offset,
+        offset=offset, cursor=cursor,
     )
 
 
 @router.get("/donations/by-donator/{donator_id}/sent", response_model=list[Donation])
-async def donator_donations_sent(donator_id: UUID, db=Depends(get_db_session), me=Depends(only_me), offset: int = 0):
-    return await DonationsDbLib(db).query_donations(
-        DonationDb.id.in_(select(sent_donations_subquery(donator_id).c.id)), offset=offset,
+async def donator_donations_sent(
+    donator_id: UUID, response: Response, db=Depends(get_read_only_db_session), me=Depends(only_me), offset: int = 0,
+    cursor: str | None = None,
+):
+    return await paginate_donations(
+        DonationsDbLib(db), response,
+        DonationDb.id.in_(select(sent_donations_subquery(donator_id).c.id)), offset=offset, cursor=cursor,
     )
 
 
 @router.get("/donations/by-donator/{donator_id}/received", response_model=list[Donation])
-async def donator_donations_received(donator_id: UUID, db=Depends(get_db_session), me=Depends(only_me), offset: int = 0):
-    return await DonationsDbLib(db).query_donations(
-        DonationDb.id.in_(select(received_donations_subquery(donator_id).c.id)), offset=offset,
+@endpoint_budget(statement_timeout=timedelta(seconds=5))
+async def donator_donations_received(
+    donator_id: UUID, response: Response, db=Depends(get_read_only_db_session), me=Depends(only_me), offset: int = 0,
+    cursor: str | None = None,
+):
+    return await paginate_donations(
+        DonationsDbLib(db), response,
+        DonationDb.id.in_(select(received_donations_subquery(donator_id).c.id)), offset=offset, cursor=cursor,
     )
@@ -0,0 +1,47 @@
+from fastapi import Depends, APIRouter, HTTPException
+
+from .api_utils import get_donator, get_db_session
+from .models import BaseModel, Donator, PushSubscription
+from .db_push import PushDbLib
+from .settings import settings
+from .types import ValidationError
+from .webpush import application_server_key, check_endpoint, InvalidEndpoint
+
+router = APIRouter(prefix='/push')
+
+
+class VapidPublicKeyResponse(BaseModel):
+    public_key: str
+
+
+@router.get('/vapid-public-key', response_model=VapidPublicKeyResponse)
+async def vapid_public_key():
+    if settings.push.vapid_private_key is None:
+        raise ValidationError("Push notifications are disabled")
+    return VapidPublicKeyResponse(public_key=application_server_key(settings.push))
+
+
+def push_enabled():
+    if settings.push.vapid_private_key is None:
+        raise HTTPException(status_code=503, detail="Push notifications are disabled")
+
+
+@router.post('/subscription', dependencies=[Depends(push_enabled)])
+async def subscribe(subscription: PushSubscription, db=Depends(get_db_session), me: Donator = Depends(get_donator)):
+    """
+    Subscribes browser to `donator:{id}` notifications (balance and connection status changes)
+    """
+    try:
+        check_endpoint(subscription.endpoint, settings.push)
+    except InvalidEndpoint as exc:
+        raise ValidationError(str(exc)) from exc
+    await PushDbLib(db).save_subscription(donator_id=me.id, subscription=subscription)
+
+
+class UnsubscribeRequest(BaseModel):
+    endpoint: str
+
+
+@router.post('/unsubscribe')
+async def unsubscribe(request: UnsubscribeRequest, db=Depends(get_db_session), me: Donator = Depends(get_donator)):
+    await PushDbLib(db).delete_subscription(donator_id=me.id, endpoint=request.endpoint)
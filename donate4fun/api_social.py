@@ -1,20 +1,31 @@
 from uuid import UUID
 
 import posthog
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response, Request
 
 from .models import TransferResponse, Donator, SocialAccountOwned, Donation, SocialProvider
 from .types import ValidationError
-from .api_utils import get_db_session, load_donator, get_donator, get_donations_db, get_social_provider_db
+from .api_utils import (
+    get_db_session, load_donator, get_donator, get_social_provider_db, paginate_donations, get_read_only_db_session,
+    get_read_only_donations_db, run_transaction,
+)
+from .db import DbSession
 from .db_models import DonationDb
+from .db_donations import DonationProjection
 
 router = APIRouter(prefix='/social')
 
 
 @router.post('/{social_provider}/{account_id}/transfer', response_model=TransferResponse)
 async def transfer_social_account_donations(
-    social_provider: SocialProvider, account_id: UUID, db=Depends(get_db_session), donator: Donator = Depends(get_donator),
+    request: Request, social_provider: SocialProvider, account_id: UUID, donator: Donator = Depends(get_donator),
 ):
+    amount: int = await run_transaction(request, transfer_account_donations, social_provider, account_id, donator)
+    posthog.capture(donator.id, 'transfer', dict(amount=amount, source=social_provider))
+    return TransferResponse(amount=amount)
+
+
+async def transfer_account_donations(db: DbSession, social_provider: SocialProvider, account_id: UUID, donator: Donator) -> int:
     donator = await load_donator(db, donator.id)
     social_db = get_social_provider_db(social_provider)(db)
     account: SocialAccountOwned = await social_db.query_account(id=account_id, owner_id=donator.id)
@@ -24,13 +35,12 @@ async def transfer_social_account_donations(
         raise ValidationError("You should have a connected auth method to claim donations")
     if account.balance != 0:
         amount = await social_db.transfer_donations(account=account, donator=donator)
-    posthog.capture(donator.id, 'transfer', dict(amount=amount, source=social_provider))
-    return TransferResponse(amount=amount)
+    return amount
 
 
 @router.get("/{social_provider}/linked", response_model=None)
 async def get_linked_social_accounts(
-    db=Depends(get_db_session), me=Depends(get_donator), social_db_lib=Depends(get_social_provider_db),
+    db=Depends(get_read_only_db_session), me=Depends(get_donator), social_db_lib=Depends(get_social_provider_db),
 ) -> list[SocialAccountOwned]:
     return await social_db_lib(db).query_linked_accounts(owner_id=me.id)
 
@@ -47,9 +57,14 @@ async def unlink_social_account(
 
 
 @router.get("/{social_provider}/{account_id}/donations/by-donatee", response_model=list[Donation])
-async def donatee_donations(account_id: UUID, donations_db=Depends(get_donations_db), social_db=Depends(get_social_provider_db)):
-    return await donations_db.query_donations(
-        (getattr(DonationDb, social_db.donation_column) == account_id) & DonationDb.paid_at.isnot(None)
+async def donatee_donations(
+    account_id: UUID, response: Response, donations_db=Depends(get_read_only_donations_db),
+    social_db=Depends(get_social_provider_db), offset: int = 0, cursor: str | None = None,
+):
+    return await paginate_donations(
+        donations_db, response,
+        (getattr(DonationDb, social_db.donation_column) == account_id) & DonationDb.paid_at.isnot(None),
+        offset=offset, cursor=cursor, projection=DonationProjection.summary,
     )
 
 
@@ -59,7 +74,7 @@ class SocialAccountResponse(SocialAccountOwned):
 
 @router.get("/{social_provider}/{account_id}", response_model=None)
 async def get_social_account(
-    account_id: UUID, db=Depends(get_db_session), me=Depends(get_donator), social_db=Depends(get_social_provider_db),
+    account_id: UUID, db=Depends(get_read_only_db_session), me=Depends(get_donator), social_db=Depends(get_social_provider_db),
 ) -> SocialAccountResponse:
     account: SocialAccountOwned = await social_db(db).query_account(id=account_id, owner_id=me.id)
     return dict(
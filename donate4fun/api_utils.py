@@ -1,12 +1,14 @@
 import unicodedata
 import hashlib
 import json
+import time
+from functools import wraps
 from uuid import uuid4, UUID
 
 import posthog
 import httpx
 from furl import furl
-from fastapi import Request, Depends, HTTPException
+from fastapi import Request, Response, Depends, HTTPException
 from fastapi.responses import RedirectResponse
 from sqlalchemy.orm.exc import NoResultFound  # noqa - imported from other modules
 from jwcrypto.jwt import JWT
@@ -15,9 +17,10 @@ from jwcrypto.jwk import JWK
 from .models import Donator, Credentials, Donation, SocialProvider, SocialAccountOwned, SocialAccount, Toast
 from .db import DbSession, db
 from .db_libs import TwitterDbLib, YoutubeDbLib, GithubDbLib, DonationsDbLib
+from .db_donations import encode_donations_cursor, DonationProjection
 from .core import ContextualObject
 from .types import LightningAddress, Satoshi
-from .settings import settings
+from .settings import settings, QueryBudget
 
 
 task_group = ContextualObject('task_group')
@@ -47,8 +50,65 @@ async def load_donator(db: DbSession, donator_id: UUID) -> Donator:
         return Donator(id=donator_id)
 
 
-async def get_db_session():
+def endpoint_budget(**limits):
+    """
+    Declares statement timeout and number of statements allowed for requests to the decorated endpoint,
+    requests exceeding them fail with 503. Should be applied below the router decorator.
+    """
+    def decorator(endpoint):
+        endpoint.query_budget = QueryBudget(**limits)
+        return endpoint
+    return decorator
+
+
+async def apply_query_budget(request: Request, session: DbSession):
+    endpoint = request.scope.get('endpoint')
+    budget: QueryBudget = getattr(endpoint, 'query_budget', settings.query_budget)
+    if budget.statement_timeout is not None or budget.max_queries is not None:
+        await session.push_query_budget(getattr(endpoint, '__qualname__', request.url.path), budget)
+
+
+def read_from_primary(request: Request):
+    if db.replicas:
+        # Following reads of this browser session go to primary so they see the changes made by this request
+        request.session['primary_until'] = time.time() + db.settings.read_your_writes_period.total_seconds()
+
+
+async def get_db_session(request: Request):
+    read_from_primary(request)
     async with db.session() as session:
+        await apply_query_budget(request, session)
+        yield session
+
+
+async def get_async_commit_db_session(request: Request):
+    """
+    Session for endpoints which write only non-financial data, see Database.async_commit_session
+    """
+    read_from_primary(request)
+    async with db.async_commit_session() as session:
+        await apply_query_budget(request, session)
+        yield session
+
+
+async def run_transaction(request: Request, func, *args, **kwargs):
+    """
+    Runs func(db_session, *args, **kwargs) using Database.transact, so the transaction is retried on serialization failures.
+    Used instead of get_db_session by endpoints which update contended rows.
+    """
+    read_from_primary(request)
+
+    @wraps(func)
+    async def unit_of_work(db_session: DbSession):
+        await apply_query_budget(request, db_session)
+        return await func(db_session, *args, **kwargs)
+    return await db.transact(unit_of_work)
+
+
+async def get_read_only_db_session(request: Request):
+    use_replica: bool = request.session.get('primary_until', 0) < time.time()
+    async with db.read_only_session(use_replica=use_replica) as session:
+        await apply_query_budget(request, session)
         yield session
 
 
@@ -56,6 +116,25 @@ async def get_donations_db(db_session=Depends(get_db_session)):
     return DonationsDbLib(db_session)
 
 
+async def get_read_only_donations_db(db_session=Depends(get_read_only_db_session)):
+    return DonationsDbLib(db_session)
+
+
+async def paginate_donations(
+    donations_db: DonationsDbLib, response: Response, where, offset: int, cursor: str | None, limit: int = 20,
+    projection: DonationProjection = DonationProjection.full,
+) -> list[Donation]:
+    """
+    Cursor for the next page is returned in X-Next-Cursor header if there could be more donations
+    """
+    donations: list[Donation] = await donations_db.query_donations(
+        where, limit=limit, offset=offset, cursor=cursor, projection=projection,
+    )
+    if len(donations) == limit:
+        response.headers['X-Next-Cursor'] = encode_donations_cursor(donations[-1])
+    return donations
+
+
 def scrape_lightning_address(text: str):
     # Remove Mark characters
     text = ''.join(char for char in text if unicodedata.category(char)[0] != 'M')
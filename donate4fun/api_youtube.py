@@ -5,7 +5,7 @@ from fastapi import Depends, APIRouter, Request
 from aiogoogle import Aiogoogle
 from sqlalchemy.orm.exc import NoResultFound
 
-from .api_utils import get_donator, get_db_session, make_absolute_uri
+from .api_utils import get_donator, get_db_session, get_read_only_db_session, make_absolute_uri
 from .models import (
     BaseModel, YoutubeVideo, YoutubeChannel, Donator, YoutubeChannelOwned, OAuthState,
     OAuthResponse,
@@ -32,7 +32,7 @@ class YoutubeVideoResponse(BaseModel):
 
 @legacy_router.get('/youtube-video/{video_id}', response_model=YoutubeVideoResponse)
 @router.get('/video/{video_id}', response_model=YoutubeVideoResponse)
-async def youtube_video_info(video_id: str, db=Depends(get_db_session)):
+async def youtube_video_info(video_id: str, db=Depends(get_read_only_db_session)):
     try:
         video: YoutubeVideo = await YoutubeDbLib(db).query_youtube_video(video_id=video_id)
         return YoutubeVideoResponse(id=video.id, total_donated=video.total_donated)
@@ -1,5 +1,8 @@
+import asyncio
 import logging
 import os
+import signal
+from functools import partial
 from contextlib import asynccontextmanager, AsyncExitStack
 
 import anyio
@@ -20,8 +23,12 @@ from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 
 from .settings import load_settings, Settings, settings
 from .db import Database, db
+from .db_pool import check_resizable
 from .lnd import monitor_invoices, LndClient, lnd
 from .pubsub import PubSubBroker, pubsub
+from .metrics import QueryStatsMiddleware, metrics_endpoint
+from .webpush import run_push_dispatcher
+from .jobs import run_ledger_compactor, run_transfer_stamper, run_partition_manager, run_pool_resizer
 from .twitter import run_twitter_bot_restarting
 from .core import app, register_command, commands
 from .screenshot import create_screenshoter_app
@@ -63,6 +70,7 @@ async def create_app(settings: Settings):
         ],
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Next-Cursor"],
         allow_credentials=True,
     )
     # `same_site = None` is needed for CORS auth
@@ -71,6 +79,9 @@ async def create_app(settings: Settings):
         domain=settings.cookie_domain,
     )
     app.add_middleware(ServerNameMiddleware)
+    app.add_middleware(QueryStatsMiddleware, settings=settings.metrics)
+    if settings.metrics.enabled:
+        app.add_route('/metrics', metrics_endpoint, include_in_schema=False)
     app.mount("/static", StaticFiles(directory="frontend/public/static"), name="static")
     app.mount('/api/v1', api.app)
     async with create_screenshoter_app() as screenshoter_app:
@@ -144,9 +155,22 @@ def init_posthog():
     posthog.debug = settings.posthog.debug
 
 
+async def wait_for_shutdown_signal(pubsub_: PubSubBroker):
+    """
+    Replacement for default hypercorn shutdown trigger, it asks websocket clients
+    to reconnect gracefully before the server stops
+    """
+    shutdown_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_ in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signal_, shutdown_requested.set)
+    await shutdown_requested.wait()
+    await pubsub_.shutdown()
+
+
 @register_command
 async def serve():
-    pubsub_ = PubSubBroker()
+    pubsub_ = PubSubBroker(settings.pubsub)
     lnd_ = LndClient(settings.lnd)
     async with create_app(settings) as app_, anyio.create_task_group() as tg:
         if settings.google_cloud_logging:
@@ -156,13 +180,23 @@ async def serve():
             bugsnag.configure(**settings.bugsnag.dict(), project_root=os.path.dirname(__file__))
         init_posthog()
         with app.assign(app_), lnd.assign(lnd_), pubsub.assign(pubsub_), task_group.assign(tg):
+            if settings.db.pool_prewarm:
+                await db.prewarm()
             async with pubsub.run(db), monitor_invoices(lnd_, db), AsyncExitStack() as stack:
+                if settings.db.adaptive_pool:
+                    check_resizable()
+                    await stack.enter_async_context(run_pool_resizer(db, settings.db))
+                await stack.enter_async_context(run_ledger_compactor(db, settings.ledger))
+                await stack.enter_async_context(run_transfer_stamper(db, settings.transfer))
+                await stack.enter_async_context(run_partition_manager(db, settings.partitions))
                 if settings.twitter.enable_bot:
                     await stack.enter_async_context(run_twitter_bot_restarting(db))
+                if settings.push.vapid_private_key:
+                    await stack.enter_async_context(run_push_dispatcher(db, settings.push))
                 hyper_config = Config.from_mapping(settings.hypercorn)
                 hyper_config.accesslog = logging.getLogger('hypercorn.acceslog')
                 iface = hyper_config.bind[0].split(':')[0]
                 hyper_config.bind = f'{iface}:{settings.api_port}'
                 if settings.bugsnag:
                     app_ = BugsnagMiddleware(app_)
-                await hypercorn_serve(app_, hyper_config)
+                await hypercorn_serve(app_, hyper_config, shutdown_trigger=partial(wait_for_shutdown_signal, pubsub_))
@@ -1,7 +1,7 @@
 import io
 import asyncio
 import logging
-from base64 import b64encode, b64decode
+from base64 import b64encode, b64decode, urlsafe_b64encode, urlsafe_b64decode
 from contextvars import ContextVar
 from contextlib import contextmanager, asynccontextmanager
 from functools import wraps
@@ -182,3 +182,14 @@ def to_base64(data: bytes) -> str:
 
 def from_base64(data: str) -> bytes:
     return b64decode(data)
+
+
+def to_base64url(data: bytes) -> str:
+    """
+    Unpadded base64url as used by Web Push and JWT
+    """
+    return urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def from_base64url(data: str) -> bytes:
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
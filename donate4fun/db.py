@@ -1,25 +1,180 @@
+import asyncio
+import json
 import logging
-from uuid import UUID
-from contextlib import asynccontextmanager
+import random
+import time
+from itertools import count
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import wraps
+from uuid import UUID, uuid4
+from contextlib import asynccontextmanager, AsyncExitStack
 
-from sqlalchemy import select, func, text, literal
+import asyncpg
+from sqlalchemy import select, update, func, text, literal, exists, or_, String
+from sqlalchemy.dialects.postgresql import ARRAY, UUID as Uuid, insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from sqlalchemy.orm.exc import NoResultFound  # noqa - imported from other modules
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
 from .core import ContextualObject
-from .models import Donator, Notification, Credentials
-from .settings import DbSettings
-from .db_models import Base, DonatorDb, YoutubeChannelLink, TwitterAuthorLink, GithubUserLink
-from .db_utils import insert_on_conflict_update
+from .models import Donator, Notification, Credentials, DonationNotification
+from .settings import DbSettings, QueryBudget
+from .types import QueryBudgetExceeded
+from .db_models import (
+    Base, DonatorDb, DonationDb, YoutubeChannelLink, TwitterAuthorLink, GithubUserLink, PushSubscriptionDb, PushDeliveryDb,
+)
+from .db_utils import upsert_statement, upsert_params, current_columns
+from .metrics import instrument_engine, query_budget_exceeded, transaction_retries, transaction_retries_exhausted
+from .db_pool import MeteredPool
 
 logger = logging.getLogger(__name__)
 
+QUERY_CANCELED = '57014'
+# serialization_failure and deadlock_detected, the whole transaction could be retried
+RETRYABLE_ERRORS = {'40001', '40P01'}
+
+
+def connected_expression():
+    """
+    Donator is connected if he has a linked lightning wallet or a social account linked via OAuth
+    """
+    return or_(
+        DonatorDb.lnauth_pubkey.isnot(None),
+        *[
+            exists().where((link_model.donator_id == DonatorDb.id) & link_model.via_oauth)
+            for link_model in [YoutubeChannelLink, TwitterAuthorLink, GithubUserLink]
+        ],
+    )
+
+
+# DbSettings fields that are not create_async_engine options
+ROUTING_SETTINGS = {
+    'replica_urls', 'max_replica_lag', 'replica_lag_check_interval', 'replica_lag_check_timeout', 'read_your_writes_period',
+}
+POOL_SETTINGS = {
+    'pool_prewarm', 'adaptive_pool', 'pool_size_min', 'pool_size_max', 'pool_wait_target', 'pool_resize_interval',
+}
+RETRY_SETTINGS = {'transaction_retries', 'transaction_retry_delay'}
+PGBOUNCER_SETTINGS = {'pgbouncer', 'listen_url'}
+
+
+class PgBouncerConnection(asyncpg.Connection):
+    """
+    PgBouncer in transaction pooling mode runs transactions of one client connection on different server connections,
+    so names of prepared statements should be unique across all clients
+    """
+    def _get_unique_id(self, prefix: str) -> str:
+        return f'__asyncpg_{prefix}_{uuid4()}__'
+
+
+def engine_options(db_settings: DbSettings) -> dict:
+    options: dict = db_settings.dict(exclude=ROUTING_SETTINGS | POOL_SETTINGS | RETRY_SETTINGS | PGBOUNCER_SETTINGS)
+    options['poolclass'] = MeteredPool
+    if db_settings.pgbouncer:
+        # Neither asyncpg nor SQLAlchemy asyncpg adapter should reuse prepared statements between transactions
+        options['connect_args'] = dict(
+            statement_cache_size=0, prepared_statement_cache_size=0, connection_class=PgBouncerConnection,
+        ) | options['connect_args']
+    return options
+
+
+def listen_engine_options(db_settings: DbSettings) -> dict:
+    """
+    Same options as for the primary engine, but listen_url points directly to Postgres
+    and each LISTEN connection is closed when pubsub stops, so connections are not pooled
+    """
+    options: dict = engine_options(db_settings.copy(update=dict(pgbouncer=False)))
+    # NullPool does not accept QueuePool size options
+    options.pop('pool_size')
+    options.pop('max_overflow')
+    return options | dict(url=db_settings.listen_url, poolclass=NullPool)
+
+
+class Replica:
+    def __init__(self, engine_options: dict, url: str):
+        self.engine = create_async_engine(**{**engine_options, 'url': url})
+        self.engine.pool.name = f'{self.engine.url.host}:{self.engine.url.port}'
+        instrument_engine(self.engine)
+        self.session_maker = sessionmaker(self.engine, class_=AsyncSession, future=True)
+        # Replication lag in seconds, None if unknown or replica is unavailable
+        self.lag: float | None = None
+        self.checked_at: float = -float('inf')
+
+    def __str__(self):
+        return f'{type(self).__name__}<{self.engine.url.host}:{self.engine.url.port}>'
+
+    async def check_lag(self, timeout: float):
+        """
+        Replica which does not answer within *timeout* seconds is considered lagging
+        """
+        self.checked_at = time.monotonic()
+        try:
+            self.lag = await asyncio.wait_for(self.query_lag(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s did not report its lag in %s seconds", self, timeout)
+            self.lag = None
+        except Exception as exc:
+            logger.warning("%s is unavailable: %s", self, exc)
+            self.lag = None
+
+    async def query_lag(self) -> float:
+        async with self.engine.connect() as connection:
+            # Replay timestamp is stale when primary is idle, so caught up replica is considered not lagging
+            return (await connection.execute(text(
+                """
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+                END
+                """
+            ))).scalar()
+
 
 class Database:
     def __init__(self, db_settings: DbSettings):
-        self.engine = create_async_engine(**db_settings.dict())
+        self.settings = db_settings
+        options: dict = engine_options(db_settings)
+        self.engine = create_async_engine(**options)
+        instrument_engine(self.engine)
         self.session_maker = sessionmaker(self.engine, class_=AsyncSession, future=True)
+        self.replicas = [Replica(options, url) for url in db_settings.replica_urls]
+        self.listen_engine = create_async_engine(**listen_engine_options(db_settings)) if db_settings.listen_url else None
+
+    async def choose_replica(self) -> Replica | None:
+        """
+        Returns a random replica that is not lagging behind or None if reads should go to primary
+        """
+        max_lag: float = self.settings.max_replica_lag.total_seconds()
+        check_interval: float = self.settings.replica_lag_check_interval.total_seconds()
+        check_timeout: float = self.settings.replica_lag_check_timeout.total_seconds()
+        for replica in random.sample(self.replicas, len(self.replicas)):
+            if time.monotonic() - replica.checked_at > check_interval:
+                await replica.check_lag(check_timeout)
+            if replica.lag is not None and replica.lag <= max_lag:
+                return replica
+        return None
+
+    @property
+    def engines(self) -> list:
+        return [self.engine, *[replica.engine for replica in self.replicas]]
+
+    async def prewarm(self):
+        """
+        Opens pool_size connections in each pool and returns them to the pool
+        """
+        async def open_connections(engine):
+            async with AsyncExitStack() as stack:
+                try:
+                    await asyncio.gather(*[
+                        stack.enter_async_context(engine.connect()) for _ in range(engine.pool.size())
+                    ])
+                except Exception as exc:
+                    logger.warning("Failed to prewarm %s pool: %s", engine.pool.name, exc)
+
+        await asyncio.gather(*[open_connections(engine) for engine in self.engines])
 
     async def create_tables(self):
         async with self.engine.begin() as conn:
@@ -34,8 +189,19 @@ class Database:
         async with self.engine.connect() as connection:
             await connection.execute(text(query))
 
+    async def execute_autocommit(self, query: str):
+        """
+        Executes *query* outside of a transaction, like DDL with CONCURRENTLY
+        """
+        async with self.engine.connect() as connection:
+            await connection.execution_options(isolation_level='AUTOCOMMIT')
+            await connection.execute(text(query))
+
     async def dispose(self):
-        await self.engine.dispose()
+        for engine in self.engines:
+            await engine.dispose()
+        if self.listen_engine:
+            await self.listen_engine.dispose()
 
     async def create_database(self, db_name: str):
         return await self.execute(f'CREATE DATABASE "{db_name}"')
@@ -49,6 +215,76 @@ class Database:
             db_session = DbSession(self, session)
             await session.connection(execution_options=dict(logging_token=str(db_session)))
             yield db_session
+            # Notifications are sent only if transaction is going to be committed
+            await db_session.flush_notifications()
+
+    @asynccontextmanager
+    async def async_commit_session(self) -> 'DbSession':
+        """
+        Session for non-financial writes, like refreshed social account metadata, OAuth tokens and email subscriptions.
+        Commit does not wait for WAL flush, so the last of these transactions could be lost (but not corrupted)
+        if the server crashes. Balances could not be changed in this session.
+        """
+        async with self.session() as db_session:
+            await db_session.execute(select(func.set_config('synchronous_commit', 'off', True)))
+            db_session.synchronous_commit = False
+            yield db_session
+
+    async def transact(self, func, *args, **kwargs):
+        """
+        Runs func(db_session, *args, **kwargs) in a new session and returns its result.
+        The whole transaction is retried with a jittered exponential backoff if it fails because of
+        a serialization failure or a deadlock, so func should not have side effects outside of the database
+        or it should set db_session.retryable to False before making them.
+        """
+        name: str = func.__qualname__
+        for attempt in count():
+            db_session = None
+            try:
+                async with self.session() as db_session:
+                    return await func(db_session, *args, **kwargs)
+            except DBAPIError as exc:
+                sqlstate: str | None = getattr(exc.orig, 'sqlstate', None)
+                if sqlstate not in RETRYABLE_ERRORS or (db_session is not None and not db_session.retryable):
+                    raise
+                if attempt >= self.settings.transaction_retries:
+                    transaction_retries_exhausted.inc(name, sqlstate)
+                    raise
+                transaction_retries.inc(name, sqlstate)
+                delay: float = self.settings.transaction_retry_delay.total_seconds() * 2 ** attempt
+                logger.debug("Retrying %s after %s in %.3fs", name, sqlstate, delay)
+                await asyncio.sleep(random.uniform(0, delay))
+
+    @asynccontextmanager
+    async def read_only_session(self, use_replica: bool = True) -> 'DbSession':
+        """
+        Session for requests that only read data.
+        READ COMMITTED does not hold a snapshot for the whole transaction and READ ONLY rejects any writes.
+        It is routed to a replica if *use_replica* is set and there is an up to date replica.
+        """
+        replica: Replica | None = await self.choose_replica() if use_replica and self.replicas else None
+        session_maker = self.session_maker if replica is None else replica.session_maker
+        async with session_maker() as session, session.begin():
+            db_session = DbSession(self, session)
+            await session.connection(execution_options=dict(
+                logging_token=str(db_session),
+                isolation_level='READ COMMITTED',
+                postgresql_readonly=True,
+            ))
+            yield db_session
+            if db_session.pending_notifications:
+                raise RuntimeError("Notifications could not be sent from a read-only session")
+
+    @asynccontextmanager
+    async def listen_connection(self, **execution_options):
+        """
+        Yields asyncpg connection for LISTEN, it's held until exit.
+        It's opened to listen_url if it's set, because LISTEN does not work through PgBouncer in transaction pooling mode.
+        """
+        async with (self.listen_engine or self.engine).connect() as connection:
+            await connection.execution_options(**execution_options)
+            raw_connection = await connection.get_raw_connection()
+            yield raw_connection.connection._connection
 
     @asynccontextmanager
     async def raw_session(self):
@@ -59,50 +295,207 @@ class Database:
 db = ContextualObject("db")
 
 
+@dataclass
+class ActiveBudget:
+    name: str
+    budget: QueryBudget
+    queries: int = 0
+    # statement_timeout value to restore after a DbLib method
+    previous_timeout: str | None = None
+
+
+def query_budget(**limits):
+    """
+    Limits statement timeout and number of statements of a DbSession or DbLib method,
+    QueryBudgetExceeded is raised if the method exceeds them
+    """
+    budget = QueryBudget(**limits)
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            db_session: DbSession = self if isinstance(self, DbSession) else self.session
+            async with db_session.query_budget(func.__qualname__, budget):
+                return await func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class DbSession:
     def __init__(self, db, session):
         self.db = db
         self.session = session
+        # Notifications are buffered until commit, key is (channel, object id) so the latest notification wins
+        self.pending_notifications: dict[tuple[str, str], tuple[str, Notification]] = {}
+        self.budgets: list[ActiveBudget] = []
+        # Set to False before side effects which should not be repeated if the transaction is retried
+        self.retryable: bool = True
+        self.synchronous_commit: bool = True
 
     def __str__(self):
         return f'{type(self).__name__}<{hex(id(self))}>'
 
-    async def execute(self, query):
-        return await self.session.execute(query)
+    async def execute(self, query, params: dict | None = None):
+        for active in self.budgets:
+            active.queries += 1
+            if active.budget.max_queries is not None and active.queries > active.budget.max_queries:
+                self.budget_exceeded(active, 'max_queries')
+        try:
+            return await self.session.execute(query, params)
+        except DBAPIError as exc:
+            if getattr(exc.orig, 'sqlstate', None) == QUERY_CANCELED:
+                # Innermost statement_timeout is in effect
+                for active in reversed(self.budgets):
+                    if active.budget.statement_timeout is not None:
+                        self.budget_exceeded(active, 'statement_timeout', exc)
+            raise
+
+    def budget_exceeded(self, active: ActiveBudget, reason: str, cause: Exception | None = None):
+        query_budget_exceeded.inc(active.name, reason)
+        budget = getattr(active.budget, reason)
+        raise QueryBudgetExceeded(f"{active.name} exceeded {reason} {budget}") from cause
+
+    async def set_statement_timeout(self, value: timedelta | str) -> str:
+        """
+        Sets statement timeout until the end of the transaction, returns the previous value
+        """
+        if isinstance(value, timedelta):
+            value = f'{int(value.total_seconds() * 1000)}ms'
+        # Not counted in query budgets
+        resp = await self.session.execute(select(
+            func.current_setting('statement_timeout'), func.set_config('statement_timeout', value, True),
+        ))
+        return resp.first()[0]
+
+    async def push_query_budget(self, name: str, budget: QueryBudget) -> ActiveBudget:
+        """
+        Limits all following statements of the session
+        """
+        active = ActiveBudget(name, budget)
+        if budget.statement_timeout is not None:
+            active.previous_timeout = await self.set_statement_timeout(budget.statement_timeout)
+        self.budgets.append(active)
+        return active
+
+    @asynccontextmanager
+    async def query_budget(self, name: str, budget: QueryBudget):
+        """
+        Limits statements executed inside the block, the previous statement timeout is restored after it
+        """
+        active = await self.push_query_budget(name, budget)
+        try:
+            yield active
+        finally:
+            self.budgets.remove(active)
+        # Transaction is aborted if the block failed, so the timeout is restored only on success
+        if active.previous_timeout is not None:
+            await self.set_statement_timeout(active.previous_timeout)
 
     async def notify(self, channel: str, notification: Notification):
         logger.trace("notify %s %s", channel, notification)
-        await self.execute(select(func.pg_notify(channel, notification.json())))
+        key = (channel, str(notification.id))
+        # Re-insert to keep notifications in order of the last change
+        self.pending_notifications.pop(key, None)
+        self.pending_notifications[key] = (channel, notification)
+
+    async def flush_notifications(self):
+        """
+        Sends all buffered notifications using a single statement
+        """
+        if not self.pending_notifications:
+            return
+        channels, notifications = zip(*self.pending_notifications.values())
+        self.pending_notifications.clear()
+        payloads = [notification.json() for notification in notifications]
+        pending = func.unnest(
+            literal(list(channels), ARRAY(String)),
+            literal(payloads, ARRAY(String)),
+        ).table_valued('channel', 'payload')
+        query = select(func.pg_notify(pending.c.channel, pending.c.payload)).select_from(pending)
+        if push_deliveries := self.push_deliveries(channels, payloads):
+            query = query.add_cte(push_deliveries)
+        await self.execute(query)
+
+    def push_deliveries(self, channels: list[str], payloads: list[str]):
+        """
+        Returns CTE that enqueues donator notifications for Web Push subscriptions of that donator.
+        Pending message for the same subscription is replaced by the new one.
+        """
+        donator_ids, push_payloads = [], []
+        for channel, payload in zip(channels, payloads):
+            object_class, _, object_id = channel.partition(':')
+            if object_class == 'donator':
+                donator_ids.append(object_id)
+                push_payloads.append(f'{{"topic": {json.dumps(channel)}, "notification": {payload}}}')
+        if not donator_ids:
+            return None
+        pending = func.unnest(
+            literal(donator_ids, ARRAY(Uuid)),
+            literal(push_payloads, ARRAY(String)),
+        ).table_valued('donator_id', 'payload')
+        query = insert(PushDeliveryDb).from_select(
+            [PushDeliveryDb.subscription_id, PushDeliveryDb.payload],
+            # WHERE instead of JOIN ... ON to avoid ambiguity with ON CONFLICT clause
+            select(PushSubscriptionDb.id, pending.c.payload)
+            .select_from(PushSubscriptionDb, pending)
+            .where(PushSubscriptionDb.donator_id == pending.c.donator_id),
+        )
+        return query.on_conflict_do_update(
+            index_elements=[PushDeliveryDb.subscription_id],
+            set_=dict(payload=query.excluded.payload, attempts=0, next_attempt_at=func.now()),
+        ).cte('push_deliveries')
 
     async def object_changed(self, object_class: str, object_id: UUID, notification: Notification | None = None):
         return await self.notify(f'{object_class}:{object_id}', notification or Notification(id=object_id, status='OK'))
 
+    async def donator_changed(self, donator_id: UUID):
+        """
+        Anyone could subscribe to donator topics, so notification does not carry balance,
+        the owner refetches it from /donator/me
+        """
+        await self.object_changed('donator', donator_id)
+
+    async def donation_changed(self, donation: DonationDb) -> DonationNotification:
+        """
+        *donation* could be any row with donation id, amount and status timestamps
+        """
+        notification = DonationNotification(
+            id=donation.id,
+            status='OK',
+            amount=donation.amount,
+            paid_at=donation.paid_at,
+            cancelled_at=donation.cancelled_at,
+            claimed_at=donation.claimed_at,
+        )
+        await self.object_changed('donation', donation.id, notification)
+        return notification
+
     async def query_donator(self, id: UUID) -> Donator:
         return await self.find_donator(DonatorDb.id == id)
 
     async def find_donator(self, *where) -> Donator:
         result = await self.execute(
-            select(
-                *DonatorDb.__table__.columns,
-                (
-                    func.coalesce(func.bool_or(YoutubeChannelLink.via_oauth), False)
-                    | func.coalesce(func.bool_or(TwitterAuthorLink.via_oauth), False)
-                    | func.coalesce(func.bool_or(GithubUserLink.via_oauth), False)
-                    | DonatorDb.lnauth_pubkey.isnot(None)
-                ).label('connected'),
-            )
-            .outerjoin(YoutubeChannelLink, YoutubeChannelLink.donator_id == DonatorDb.id)
-            .outerjoin(TwitterAuthorLink, TwitterAuthorLink.donator_id == DonatorDb.id)
-            .outerjoin(GithubUserLink, GithubUserLink.donator_id == DonatorDb.id)
+            select(*current_columns(DonatorDb))
             .where(*where)
-            .group_by(DonatorDb.id)
         )
         return Donator(**result.one())
 
+    async def update_donator_connected(self, donator_id: UUID):
+        """
+        Should be called after changing donator's lnauth_pubkey or OAuth links
+        """
+        await self.execute(
+            update(DonatorDb)
+            .values(connected=connected_expression())
+            .where(DonatorDb.id == donator_id)
+        )
+
     async def commit(self):
+        await self.flush_notifications()
         return await self.session.commit()
 
     async def rollback(self):
+        self.pending_notifications.clear()
         return await self.session.rollback()
 
     async def query_status(self):
@@ -125,10 +518,9 @@ class DbSession:
         return Credentials(donator=registered_donator_id, lnauth_pubkey=key)
 
     async def save_donator(self, donator: Donator) -> UUID:
-        resp = await self.execute(
-            insert_on_conflict_update(DonatorDb, donator)
-        )
-        await self.object_changed('donator', donator.id)
+        resp = await self.execute(upsert_statement(DonatorDb), upsert_params(DonatorDb, donator))
+        await self.update_donator_connected(donator.id)
+        await self.donator_changed(donator.id)
         return resp.scalar()
 
 
@@ -137,4 +529,11 @@ class DbSessionWrapper:
         self.session = session
         self.execute = session.execute
         self.object_changed = session.object_changed
+        self.donator_changed = session.donator_changed
+        self.donation_changed = session.donation_changed
+        self.update_donator_connected = session.update_donator_connected
         self.notify = session.notify
+
+    @property
+    def synchronous_commit(self) -> bool:
+        return self.session.synchronous_commit
@@ -1,54 +1,150 @@
+import json
 import logging
 import math
+from enum import Enum
 from uuid import UUID
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from sqlalchemy import select, desc, update, func, case, true
+from sqlalchemy import select, desc, update, delete, func, tuple_, any_, exists
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
 
-from .models import Donation, DonatorStats, Notification
-from .types import RequestHash, NotEnoughBalance, ValidationError
+from .models import Donation, unloaded_defaults
+from .types import RequestHash, ValidationError
 from .db import DbSessionWrapper
-from .db_models import (
-    DonatorDb, DonationDb, YoutubeChannelDb, TwitterAuthorDb,
-    YoutubeChannelLink, TwitterAuthorLink,
-)
+from .core import to_base64url, from_base64url
+from .db_models import DonatorDb, DonationDb, DonationPaymentHashDb, YoutubeVideoDb, YoutubeChannelDb, TransferDb
 from .db_youtube import YoutubeDbLib
 from .db_twitter import TwitterDbLib
 from .db_github import GithubDbLib
+from .db_stats import DonatorStatsDbLib
+from .db_ledger import LedgerDbLib
+from .db_utils import undefer_ledger_columns
 
 logger = logging.getLogger(__name__)
 
 
+# paid_at could be a bit earlier than created_at (LND reports settle time in seconds),
+# the margin only needs to be small compared to a partition (a month) to let Postgres skip newer partitions
+PAYMENT_TIME_SKEW = timedelta(days=1)
+
+
 class UnableToCancelDonation(ValidationError):
     pass
 
 
+def encode_donations_cursor(donation: Donation) -> str:
+    """
+    Opaque cursor pointing right after *donation* in donations list
+    """
+    return to_base64url(json.dumps([(donation.paid_at or donation.created_at).isoformat(), str(donation.id)]).encode())
+
+
+def decode_donations_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        timestamp, id_ = json.loads(from_base64url(cursor))
+        return datetime.fromisoformat(timestamp), UUID(id_)
+    except (TypeError, ValueError) as exc:
+        raise ValidationError(f"Invalid cursor {cursor}") from exc
+
+
+class DonationProjection(Enum):
+    """
+    Related objects loaded together with donations, the others are left None
+    """
+    # Only donation's own columns
+    ids = ()
+    # Sender only, for lists of donations to a known receiver
+    summary = ('donator', 'donator_twitter_account')
+    full = (
+        'donator', 'receiver', 'youtube_channel', 'youtube_video', 'twitter_account', 'twitter_tweet', 'github_user',
+        'donator_twitter_account',
+    )
+
+    @property
+    def options(self) -> list:
+        """
+        Donation targets are loaded with their balances, balances of donators are left deferred
+        """
+        options = []
+        for name in self.value:
+            relationship = getattr(DonationDb, name)
+            model = relationship.property.mapper.class_
+            loader = joinedload(relationship)
+            options.append(loader if model is DonatorDb else loader.options(*undefer_ledger_columns(model)))
+        if 'youtube_video' in self.value:
+            options.append(
+                joinedload(DonationDb.youtube_video).joinedload(YoutubeVideoDb.youtube_channel)
+                .options(*undefer_ledger_columns(YoutubeChannelDb))
+            )
+        return options
+
+
+def to_donation(obj: DonationDb) -> Donation:
+    # Projections do not load balances of donators
+    with unloaded_defaults(DonatorDb.balance):
+        return Donation.from_orm(obj)
+
+
+def donations_query(
+    where, limit: int = 20, offset: int = 0, cursor: str | None = None,
+    projection: DonationProjection = DonationProjection.full,
+):
+    """
+    Order matches donation_*_idx indexes (see db_models.py)
+    *cursor* is a keyset pagination cursor (see `encode_donations_cursor`), it's preferred over *offset*
+    because it does not need to scan all skipped rows.
+    """
+    sort_key = func.coalesce(DonationDb.paid_at, DonationDb.created_at)
+    query = (
+        select(DonationDb)
+        .options(*projection.options)
+        .where(where)
+        .order_by(desc(sort_key), desc(DonationDb.id))
+        .limit(limit)
+        .offset(offset)
+    )
+    if cursor is not None:
+        cursor_timestamp, cursor_id = decode_donations_cursor(cursor)
+        query = query.where(
+            (tuple_(sort_key, DonationDb.id) < tuple_(cursor_timestamp, cursor_id))
+            # Redundant condition on the partition key, donations are paid after they are created
+            & (DonationDb.created_at < cursor_timestamp + PAYMENT_TIME_SKEW)
+        )
+    return query
+
+
 class DonationsDbLib(DbSessionWrapper):
-    async def query_donations(self, where, limit: int = 20, offset: int = 0):
+    async def query_donations(
+        self, where, limit: int = 20, offset: int = 0, cursor: str | None = None,
+        projection: DonationProjection = DonationProjection.full,
+    ):
+        """
+        Returns donations ordered from the most recent
+        """
         result = await self.execute(
-            select(DonationDb)
-            .where(where)
-            .order_by(desc(func.coalesce(DonationDb.paid_at, DonationDb.created_at)))
-            .limit(limit)
-            .offset(offset)
+            donations_query(where, limit=limit, offset=offset, cursor=cursor, projection=projection)
         )
-        return [Donation.from_orm(obj) for obj in result.unique().scalars()]
+        return [to_donation(obj) for obj in result.unique().scalars()]
 
     async def lock_donation(self, r_hash: RequestHash) -> Donation:
+        """
+        Returns donation without related objects
+        """
         result = await self.execute(
             select(DonationDb)
             .where(DonationDb.r_hash == r_hash.as_base64)
-            .with_for_update(of=DonationDb)
+            .with_for_update()
         )
         return Donation.from_orm(result.scalar_one())
 
-    async def query_donation(self, id: UUID) -> Donation:
+    async def query_donation(self, id: UUID, projection: DonationProjection = DonationProjection.full) -> Donation:
         result = await self.execute(
             select(DonationDb)
+            .options(*projection.options)
             .where(DonationDb.id == id)
         )
-        return Donation.from_orm(result.scalar_one())
+        return to_donation(result.unique().scalar_one())
 
     async def create_donation(self, donation: Donation):
         donation.created_at = datetime.utcnow()
@@ -71,9 +167,24 @@ class DonationsDbLib(DbSessionWrapper):
                 donator_twitter_account_id=donation.donator_twitter_account and donation.donator_twitter_account.id,
             )
         )
+        payment_hashes = [
+            dict(r_hash=r_hash.as_base64, transient=transient, donation_id=donation.id)
+            for r_hash, transient in [(donation.r_hash, False), (donation.transient_r_hash, True)]
+            if r_hash is not None
+        ]
+        if payment_hashes:
+            await self.execute(insert(DonationPaymentHashDb).values(payment_hashes))
         return donation
 
     async def update_donation(self, donation_id: UUID, r_hash: RequestHash):
+        await self.execute(
+            delete(DonationPaymentHashDb)
+            .where((DonationPaymentHashDb.donation_id == donation_id) & DonationPaymentHashDb.transient.is_(False))
+        )
+        await self.execute(
+            insert(DonationPaymentHashDb)
+            .values(r_hash=r_hash.as_base64, transient=False, donation_id=donation_id)
+        )
         await self.execute(
             update(DonationDb)
             .values(r_hash=r_hash.as_base64)
@@ -81,6 +192,9 @@ class DonationsDbLib(DbSessionWrapper):
         )
 
     async def cancel_donation(self, donation_id: UUID) -> Donation:
+        # Donations are marked as claimed in background, so donation of a not yet stamped transfer is already paid out.
+        # Concurrent transfer locks the account row which is updated here, so one of transactions fails to serialize.
+        transferred = exists().where(TransferDb.stamped_at.is_(None) & (DonationDb.id == any_(TransferDb.donation_ids)))
         resp = await self.execute(
             update(DonationDb)
             .values(
@@ -90,6 +204,7 @@ class DonationsDbLib(DbSessionWrapper):
                 DonationDb.claimed_at.is_(None)
                 & DonationDb.cancelled_at.is_(None)
                 & (DonationDb.id == donation_id)
+                & ~transferred
             )
             .returning(*DonationDb.__table__.columns)
         )
@@ -136,15 +251,8 @@ class DonationsDbLib(DbSessionWrapper):
             social_db = GithubDbLib(self)
         elif donation.receiver_id:
             social_db = None
-            resp = await self.execute(
-                update(DonatorDb)
-                .values(balance=DonatorDb.balance + balance_amount)
-                .where(DonatorDb.id == donation.receiver_id)
-                .returning(DonatorDb.balance)
-            )
-            if resp.fetchone().balance < 0:
-                raise NotEnoughBalance(f"Donator {donation.receiver_id} hasn't enough money")
-            await self.object_changed('donator', donation.receiver_id)
+            await LedgerDbLib(self).change_balance(DonatorDb, donation.receiver_id, balance_diff=balance_amount)
+            await self.donator_changed(donation.receiver_id)
         else:
             raise ValueError(f"Donation {donation.id} has no target")
         if social_db:
@@ -159,79 +267,12 @@ class DonationsDbLib(DbSessionWrapper):
             #          |                   |   balance                       | increase receiver balance
             # not None | not None          | from an internal balance to     | decrease donator balance
             #          |                   |   an external lightning address |
-            resp = await self.execute(
-                update(DonatorDb)
-                .where((DonatorDb.id == donation.donator_id))
-                .values(balance=DonatorDb.balance - amount - math.ceil((donation.fee_msat or 0) / 1000))
-                .returning(DonatorDb.balance)
+            await LedgerDbLib(self).change_balance(
+                DonatorDb, donation.donator_id, balance_diff=-amount - math.ceil((donation.fee_msat or 0) / 1000),
             )
-            if resp.fetchone().balance < 0:
-                raise NotEnoughBalance(f"Donator {donation.donator_id} hasn't enough money")
 
-        await self.object_changed('donation', donation.id)
-        await self.notify('donations', Notification(id=donation.id, status='OK'))
+        await DonatorStatsDbLib(self).donation_settled(donation, amount)
+        notification = await self.donation_changed(donation)
+        await self.notify('donations', notification)
         if donation.donator_id is not None:
-            await self.object_changed('donator', donation.donator_id)
-
-    async def query_donator_stats(self, donator_id: UUID):
-        received_sq = received_donations_subquery(donator_id)
-        received_stats_sq = select(
-            func.coalesce(func.sum(received_sq.c.amount), 0).label('total_received')
-        ).where(
-            received_sq.c.receiver_id.is_(None)
-            | (received_sq.c.receiver_id != received_sq.c.donator_id)
-        ).subquery()
-
-        sent_sq = sent_donations_subquery(donator_id)
-        sent_stats_sq = select(
-            func.coalesce(func.sum(sent_sq.c.amount), 0).label('total_donated'),
-            func.coalesce(func.sum(case(
-                (sent_sq.c.claimed_at.is_(None), 0),
-                else_=sent_sq.c.amount,
-            )), 0).label('total_claimed'),
-        ).where(
-            sent_sq.c.receiver_id.is_(None)
-            | (sent_sq.c.receiver_id != sent_sq.c.donator_id)
-        ).subquery()
-
-        result = await self.execute(
-            select(received_stats_sq.c.total_received, sent_stats_sq.c.total_claimed, sent_stats_sq.c.total_donated)
-            .join(sent_stats_sq, true())
-        )
-        return DonatorStats.from_orm(result.fetchone())
-
-
-def sent_donations_subquery(donator_id: UUID):
-    return select(
-        DonationDb
-    ).where(
-        DonationDb.paid_at.isnot(None)
-        & DonationDb.cancelled_at.is_(None)
-        & (DonationDb.donator_id == donator_id)
-        & (
-            DonationDb.receiver_id.is_(None) |
-            (DonationDb.donator_id != DonationDb.receiver_id)
-        )
-    ).subquery()
-
-
-def received_donations_subquery(donator_id: UUID):
-    return select(
-        DonationDb
-    ).outerjoin(
-        DonationDb.youtube_channel
-    ).outerjoin(
-        YoutubeChannelDb.links
-    ).outerjoin(
-        DonationDb.twitter_account
-    ).outerjoin(
-        TwitterAuthorDb.links
-    ).where(
-        DonationDb.paid_at.isnot(None)
-        & DonationDb.cancelled_at.is_(None)
-        & (
-            (YoutubeChannelLink.donator_id == donator_id)
-            | (TwitterAuthorLink.donator_id == donator_id)
-            | (DonationDb.receiver_id == donator_id)
-        )
-    ).subquery()
+            await self.donator_changed(donation.donator_id)
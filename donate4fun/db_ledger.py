@@ -0,0 +1,136 @@
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import select, update, delete, func, literal, cast, BigInteger
+from sqlalchemy.dialects.postgresql import insert, ARRAY, UUID as Uuid
+
+from .types import NotEnoughBalance, InvalidDbState
+from .db import DbSessionWrapper
+from .db_models import (
+    BalanceLedgerDb, DonatorDb, YoutubeChannelDb, TwitterAuthorDb, GithubUserDb, YoutubeVideoDb, DonatorStatsDb,
+)
+
+# Tables which balance (or total_donated) could be changed through the ledger
+ledger_models = [DonatorDb, YoutubeChannelDb, TwitterAuthorDb, GithubUserDb, YoutubeVideoDb]
+
+
+def account_value(model, account_id: UUID, column, diff: int):
+    value = select(column).where(model.id == account_id).scalar_subquery()
+    return (value + diff if diff else value).label(column.key)
+
+
+class LedgerDbLib(DbSessionWrapper):
+    async def change_balance(
+        self, model, account_id: UUID, balance_diff: int = 0, total_diff: int = 0, donated_at: datetime | None = None,
+        returning: tuple = (),
+    ):
+        """
+        Increases are appended to the ledger, so they do not lock the account row and concurrent donations do not conflict.
+        Decreases update the row, so concurrent decreases conflict, and raise NotEnoughBalance
+        if the balance (including ledger entries) becomes negative.
+        Returns the row of *returning* account columns after the change (None if nothing is changed),
+        so callers do not need another query for notifications.
+        """
+        if not self.session.synchronous_commit:
+            raise InvalidDbState("Balance could not be changed in an async commit session")
+        if balance_diff >= 0 and total_diff >= 0:
+            if not (balance_diff or total_diff):
+                return None
+            query = (
+                insert(BalanceLedgerDb)
+                .values(
+                    account_type=model.__tablename__, account_id=account_id,
+                    balance_diff=balance_diff, total_diff=total_diff, donated_at=donated_at,
+                )
+            )
+            if returning:
+                # Subqueries see the statement snapshot, so the new entry is added explicitly
+                diffs = dict(balance=balance_diff, total_donated=total_diff)
+                query = query.returning(*[
+                    account_value(model, account_id, column, diffs.get(column.key, 0)) for column in returning
+                ])
+            resp = await self.execute(query)
+            return resp.one() if returning else None
+        values = {}
+        if balance_diff:
+            values['balance'] = model.balance_snapshot + balance_diff
+        if total_diff:
+            values['total_donated'] = model.total_donated_snapshot + total_diff
+        query = update(model).values(**values).where(model.id == account_id)
+        # Column properties (balance, total_donated) are not named after their keys in RETURNING
+        returning = [column.label(column.key) for column in returning]
+        if balance_diff >= 0:
+            resp = await self.execute(query.returning(*returning) if returning else query)
+            return resp.one_or_none() if returning else None
+        resp = await self.execute(query.returning(model.balance.label('new_balance'), *returning))
+        # Raises NoResultFound if the account does not exist
+        row = resp.one()
+        if row.new_balance < 0:
+            raise NotEnoughBalance(f"{model.__tablename__}[{account_id}] hasn't enough money")
+        return row
+
+    async def compact(self, limit: int) -> dict[type, list]:
+        """
+        Folds up to *limit* oldest ledger entries into account rows.
+        Returns rows with account_id and last_donated_at of changed accounts for each model.
+        """
+        oldest = (
+            select(BalanceLedgerDb.id)
+            .order_by(BalanceLedgerDb.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        deleted = (
+            delete(BalanceLedgerDb)
+            .where(BalanceLedgerDb.id.in_(oldest))
+            .returning(
+                BalanceLedgerDb.account_type, BalanceLedgerDb.account_id, BalanceLedgerDb.balance_diff,
+                BalanceLedgerDb.total_diff, BalanceLedgerDb.donated_at,
+            )
+            .cte('deleted')
+        )
+        resp = await self.execute(
+            select(
+                deleted.c.account_type,
+                deleted.c.account_id,
+                cast(func.sum(deleted.c.balance_diff), BigInteger).label('balance_diff'),
+                cast(func.sum(deleted.c.total_diff), BigInteger).label('total_diff'),
+                func.max(deleted.c.donated_at).label('last_donated_at'),
+            )
+            .group_by(deleted.c.account_type, deleted.c.account_id)
+        )
+        rows = resp.all()
+        changed: dict[type, list] = {}
+        for model in ledger_models:
+            if not (model_rows := [row for row in rows if row.account_type == model.__tablename__]):
+                continue
+            diffs = func.unnest(
+                literal([row.account_id for row in model_rows], ARRAY(Uuid)),
+                literal([row.balance_diff for row in model_rows], ARRAY(BigInteger)),
+                literal([row.total_diff for row in model_rows], ARRAY(BigInteger)),
+            ).table_valued('account_id', 'balance_diff', 'total_diff')
+            values = {}
+            if hasattr(model, 'balance_snapshot'):
+                values['balance'] = model.balance_snapshot + diffs.c.balance_diff
+            if hasattr(model, 'total_donated_snapshot'):
+                values['total_donated'] = model.total_donated_snapshot + diffs.c.total_diff
+            await self.execute(
+                update(model)
+                .values(**values)
+                .where(model.id == diffs.c.account_id)
+            )
+            changed[model] = model_rows
+        if stats_rows := [row for row in rows if row.account_type == DonatorStatsDb.__tablename__]:
+            diffs = func.unnest(
+                literal([row.account_id for row in stats_rows], ARRAY(Uuid)),
+                literal([row.total_diff for row in stats_rows], ARRAY(BigInteger)),
+            ).table_valued('donator_id', 'total_received')
+            # Stats row is missing for donators who had not received or donated anything
+            query = insert(DonatorStatsDb).from_select(['donator_id', 'total_received'], select(diffs))
+            await self.execute(query.on_conflict_do_update(
+                index_elements=[DonatorStatsDb.donator_id],
+                set_=dict(total_received=DonatorStatsDb.total_received_snapshot + query.excluded.total_received),
+            ))
+            changed[DonatorStatsDb] = stats_rows
+        return changed
@@ -4,5 +4,11 @@ from .db_github import GithubDbLib
 from .db_donations import DonationsDbLib
 from .db_withdraw import WithdrawalDbLib
 from .db_other import OtherDbLib
+from .db_push import PushDbLib
+from .db_stats import DonatorStatsDbLib
+from .db_partitions import PartitionsDbLib
 
-__all__ = ['YoutubeDbLib', 'TwitterDbLib', 'GithubDbLib', 'DonationsDbLib', 'WithdrawalDbLib', 'OtherDbLib']
+__all__ = [
+    'YoutubeDbLib', 'TwitterDbLib', 'GithubDbLib', 'DonationsDbLib', 'WithdrawalDbLib', 'OtherDbLib', 'PushDbLib',
+    'DonatorStatsDbLib', 'PartitionsDbLib',
+]
@@ -1,17 +1,63 @@
-from sqlalchemy import Column, TIMESTAMP, String, BigInteger, ForeignKey, func, text, Boolean
-from sqlalchemy.dialects.postgresql import UUID as Uuid, JSONB
-from sqlalchemy.orm import declarative_base, relationship, foreign
-from sqlalchemy.schema import CheckConstraint, Index
+from sqlalchemy import Column, TIMESTAMP, String, BigInteger, ForeignKey, func, text, Boolean, desc, select, cast, event
+from sqlalchemy.dialects.postgresql import UUID as Uuid, JSONB, ARRAY
+from sqlalchemy.orm import declarative_base, relationship, foreign, column_property, declared_attr
+from sqlalchemy.schema import CheckConstraint, Index, DDL
 
 Base = declarative_base()
 
 
+class BalanceLedgerDb(Base):
+    """
+    Append-only log of balance increases of donators, social accounts and youtube videos (total_donated only),
+    and of total_received of donator stats (as total_diff).
+    Actual balance is a row balance snapshot plus the sum of its entries, entries are folded into rows by LedgerDbLib.compact.
+    """
+    __tablename__ = 'balance_ledger'
+
+    id = Column(BigInteger, primary_key=True)
+    # Table name of the account
+    account_type = Column(String, nullable=False)
+    account_id = Column(Uuid(as_uuid=True), nullable=False)
+    balance_diff = Column(BigInteger, nullable=False, server_default=text('0'))
+    total_diff = Column(BigInteger, nullable=False, server_default=text('0'))
+    donated_at = Column(TIMESTAMP)
+
+    __table_args__ = (
+        Index('balance_ledger_account_idx', account_type, account_id),
+    )
+
+
+def ledger_tail(account_type: str, account_id, column):
+    """
+    Sum of account's ledger entries that are not compacted yet
+    """
+    return (
+        select(cast(func.coalesce(func.sum(column), 0), BigInteger))
+        .where((BalanceLedgerDb.account_type == account_type) & (BalanceLedgerDb.account_id == account_id))
+        .scalar_subquery()
+    )
+
+
 class DonateeDb(Base):
     __abstract__ = True
-    balance = Column(BigInteger, nullable=False, server_default=text('0'))
-    total_donated = Column(BigInteger, nullable=False, server_default=text('0'))
+    # Compacted values, should be used only for updates, balance and total_donated include ledger entries
+    balance_snapshot = Column('balance', BigInteger, nullable=False, server_default=text('0'))
+    total_donated_snapshot = Column('total_donated', BigInteger, nullable=False, server_default=text('0'))
     last_fetched_at = Column(TIMESTAMP)
 
+    # Deferred because of the ledger subquery, loaded with undefer_ledger_columns or selected with current_columns
+    @declared_attr
+    def balance(cls):
+        return column_property(
+            cls.balance_snapshot + ledger_tail(cls.__tablename__, cls.id, BalanceLedgerDb.balance_diff), deferred=True,
+        )
+
+    @declared_attr
+    def total_donated(cls):
+        return column_property(
+            cls.total_donated_snapshot + ledger_tail(cls.__tablename__, cls.id, BalanceLedgerDb.total_diff), deferred=True,
+        )
+
 
 class YoutubeChannelDb(DonateeDb):
     __tablename__ = 'youtube_channel'
@@ -44,7 +90,10 @@ class YoutubeVideoDb(Base):
     thumbnail_url = Column(String)
     default_audio_language = Column(String)
 
-    total_donated = Column(BigInteger, nullable=False, server_default=text('0'))
+    total_donated_snapshot = Column('total_donated', BigInteger, nullable=False, server_default=text('0'))
+    total_donated = column_property(
+        total_donated_snapshot + ledger_tail('youtube_video', id, BalanceLedgerDb.total_diff), deferred=True,
+    )
 
 
 class TwitterTweetDb(Base):
@@ -94,8 +143,12 @@ class DonatorDb(Base):
     name = Column(String)
     avatar_url = Column(String)
     lnauth_pubkey = Column(String, unique=True)
-    balance = Column(BigInteger, nullable=False, server_default=text('0'))
+    # See DonateeDb.balance_snapshot
+    balance_snapshot = Column('balance', BigInteger, nullable=False, server_default=text('0'))
+    balance = column_property(balance_snapshot + ledger_tail('donator', id, BalanceLedgerDb.balance_diff), deferred=True)
     lightning_address = Column(String, unique=True)
+    # Maintained by DbSession.update_donator_connected
+    connected = Column(Boolean, nullable=False, server_default='f')
 
     linked_youtube_channels = relationship(
         YoutubeChannelDb,
@@ -128,55 +181,107 @@ def num_nonnulls(*columns):
 
 
 class DonationDb(Base):
+    """
+    Partitioned by months of created_at (see db_partitions.py), so primary key and unique indexes include created_at
+    """
     __tablename__ = 'donation'
     __table_args__ = (
         CheckConstraint(
             num_nonnulls('receiver_id', 'youtube_channel_id', 'twitter_account_id') + '=1',
             name='has_a_single_target',
         ),
+        dict(postgresql_partition_by='RANGE (created_at)'),
     )
 
     id = Column(Uuid(as_uuid=True), primary_key=True, server_default=func.uuid_generate_v4())
-    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    created_at = Column(TIMESTAMP, primary_key=True, server_default=func.now())
+
+    # Relationships are not loaded by default, queries choose them using DonationProjection (see db_donations.py)
 
     # This field is set only if local LND has been used for the donation
     # For donations from an external wallet to an external lightning address this field is None
     # Encoding is base64
-    r_hash = Column(String, unique=True)
+    r_hash = Column(String)
     # For transient donations (look at models.py for description)
-    transient_r_hash = Column(String, unique=True)
+    transient_r_hash = Column(String)
     amount = Column(BigInteger, nullable=False)
     fee_msat = Column(BigInteger)
     donator_id = Column(Uuid(as_uuid=True))
     donator = relationship(
-        DonatorDb, lazy='joined', foreign_keys=[donator_id], primaryjoin=lambda: DonationDb.donator_id == DonatorDb.id,
+        DonatorDb, lazy='noload', foreign_keys=[donator_id], primaryjoin=lambda: DonationDb.donator_id == DonatorDb.id,
     )
     paid_at = Column(TIMESTAMP)
     cancelled_at = Column(TIMESTAMP)
     claimed_at = Column(TIMESTAMP)
 
     receiver_id = Column(Uuid(as_uuid=True), ForeignKey(DonatorDb.id))
-    receiver = relationship(DonatorDb, lazy='joined', foreign_keys=[receiver_id])
+    receiver = relationship(DonatorDb, lazy='noload', foreign_keys=[receiver_id])
 
     youtube_channel_id = Column(Uuid(as_uuid=True), ForeignKey(YoutubeChannelDb.id))
-    youtube_channel = relationship(YoutubeChannelDb, lazy='joined')
+    youtube_channel = relationship(YoutubeChannelDb, lazy='noload')
 
     youtube_video_id = Column(Uuid(as_uuid=True), ForeignKey(YoutubeVideoDb.id))
-    youtube_video = relationship(YoutubeVideoDb, lazy='joined')
+    youtube_video = relationship(YoutubeVideoDb, lazy='noload')
 
     twitter_account_id = Column(Uuid(as_uuid=True), ForeignKey(TwitterAuthorDb.id))
-    twitter_account = relationship(TwitterAuthorDb, lazy='joined', foreign_keys=[twitter_account_id])
+    twitter_account = relationship(TwitterAuthorDb, lazy='noload', foreign_keys=[twitter_account_id])
 
     twitter_tweet_id = Column(Uuid(as_uuid=True), ForeignKey(TwitterTweetDb.id))
-    twitter_tweet = relationship(TwitterTweetDb, lazy='joined')
+    twitter_tweet = relationship(TwitterTweetDb, lazy='noload')
 
     github_user_id = Column(Uuid(as_uuid=True), ForeignKey(GithubUserDb.id))
-    github_user = relationship(GithubUserDb, lazy='joined')
+    github_user = relationship(GithubUserDb, lazy='noload')
 
     lightning_address = Column(String)
 
     donator_twitter_account_id = Column(Uuid(as_uuid=True), ForeignKey(TwitterAuthorDb.id))
-    donator_twitter_account = relationship(TwitterAuthorDb, lazy='joined', foreign_keys=[donator_twitter_account_id])
+    donator_twitter_account = relationship(TwitterAuthorDb, lazy='noload', foreign_keys=[donator_twitter_account_id])
+
+
+# Like in the migration, donation_legacy holds all rows before the next month, monthly ones are created by PartitionsDbLib.
+# There is no default partition, because it forbids DETACH PARTITION CONCURRENTLY.
+event.listen(DonationDb.__table__, 'after_create', DDL(
+    "CREATE TABLE donation_legacy PARTITION OF donation"
+    " FOR VALUES FROM (MINVALUE) TO (date_trunc('month', now() AT TIME ZONE 'UTC') + interval '1 month')"
+))
+
+# Unique indexes of a partitioned table have to include created_at, so uniqueness is kept by DonationPaymentHashDb
+Index('donation_r_hash_idx', DonationDb.r_hash)
+Index('donation_transient_r_hash_idx', DonationDb.transient_r_hash)
+
+# Indexes for donations lists (see DonationsDbLib.query_donations) and claims (see claimable_donation_filter)
+# Lists not filtered by donator or target are of settled donations, so donation_settled_idx is the only index by sort key alone
+# Migrations should be updated when changing these indexes
+donation_sort_key = (desc(func.coalesce(DonationDb.paid_at, DonationDb.created_at)), desc(DonationDb.id))
+Index(
+    'donation_settled_idx', *donation_sort_key,
+    postgresql_where=DonationDb.paid_at.isnot(None) & DonationDb.cancelled_at.is_(None),
+)
+Index('donation_donator_id_idx', DonationDb.donator_id, *donation_sort_key)
+for column in [DonationDb.receiver_id, DonationDb.youtube_channel_id, DonationDb.twitter_account_id, DonationDb.github_user_id]:
+    Index(f'donation_{column.key}_idx', column, *donation_sort_key, postgresql_where=column.isnot(None))
+for column in [DonationDb.youtube_channel_id, DonationDb.twitter_account_id, DonationDb.github_user_id]:
+    Index(
+        f'donation_{column.key}_claimable_idx', column,
+        postgresql_where=(
+            column.isnot(None)
+            & DonationDb.claimed_at.is_(None)
+            & DonationDb.paid_at.isnot(None)
+            & DonationDb.cancelled_at.is_(None)
+        ),
+    )
+
+
+class DonationPaymentHashDb(Base):
+    """
+    Payment hashes of donations (r_hash and transient_r_hash), written along with DonationDb to keep them unique
+    """
+    __tablename__ = 'donation_payment_hash'
+
+    r_hash = Column(String, primary_key=True)
+    transient = Column(Boolean, primary_key=True)
+    # Not a foreign key because donation primary key includes created_at
+    donation_id = Column(Uuid(as_uuid=True), nullable=False)
 
 
 class BaseLink(Base):
@@ -255,6 +360,10 @@ class TransferDb(Base):
     id = Column(Uuid(as_uuid=True), primary_key=True, server_default=func.uuid_generate_v4())
     amount = Column(BigInteger, nullable=False)
     created_at = Column(TIMESTAMP, nullable=False)
+    # Set when claimed donations are marked by SocialDbWrapper.stamp_transfers
+    stamped_at = Column(TIMESTAMP)
+    # Donations included into the amount, they are marked as claimed by stamping
+    donation_ids = Column(ARRAY(Uuid(as_uuid=True)), nullable=False, server_default='{}')
     donator_id = Column(Uuid(as_uuid=True), ForeignKey(DonatorDb.id), nullable=False)
 
     youtube_channel_id = Column(Uuid(as_uuid=True), ForeignKey(YoutubeChannelDb.id))
@@ -267,6 +376,9 @@ class TransferDb(Base):
     github_user = relationship(GithubUserDb, lazy='joined')
 
 
+Index('transfer_not_stamped_idx', TransferDb.created_at, postgresql_where=TransferDb.stamped_at.is_(None))
+
+
 class EmailNotificationDb(Base):
     __tablename__ = 'email_notification'
 
@@ -282,4 +394,85 @@ class OAuthTokenDb(Base):
     token = Column(JSONB, nullable=False)
 
 
+class DonatorStatsDb(Base):
+    """
+    Donator's totals maintained by DonatorStatsDbLib
+    """
+    __tablename__ = 'donator_stats'
+
+    donator_id = Column(Uuid(as_uuid=True), ForeignKey(DonatorDb.id, ondelete='CASCADE'), primary_key=True)
+    total_donated = Column(BigInteger, nullable=False, server_default=text('0'))
+    total_claimed = Column(BigInteger, nullable=False, server_default=text('0'))
+    # Received donations are appended to the ledger (as total_diff), because popular accounts get a lot of them
+    total_received_snapshot = Column('total_received', BigInteger, nullable=False, server_default=text('0'))
+    total_received = column_property(
+        total_received_snapshot + ledger_tail('donator_stats', donator_id, BalanceLedgerDb.total_diff),
+    )
+
+
+class DonateeLeaderboardDb(Base):
+    """
+    Denormalized copy of all social accounts for leaderboards, kept in sync by SocialDbWrapper.sync_donatee
+    """
+    __tablename__ = 'donatee_leaderboard'
+
+    type = Column(String, primary_key=True)
+    id = Column(Uuid(as_uuid=True), primary_key=True)
+    title = Column(String)
+    thumbnail_url = Column(String)
+    balance = Column(BigInteger, nullable=False)
+    total_donated = Column(BigInteger, nullable=False)
+    last_donated_at = Column(TIMESTAMP)
+
+    __table_args__ = (
+        Index('donatee_leaderboard_total_donated_idx', total_donated.desc()),
+        Index('donatee_leaderboard_balance_idx', balance.desc(), postgresql_where=balance > 0),
+        Index('donatee_leaderboard_last_donated_at_idx', last_donated_at.desc()),
+    )
+
+
+class DonationArchiveDb(Base):
+    """
+    Per-account totals of a detached donation partition, written by PartitionsDbLib before the partition is detached.
+    Stats and leaderboard rebuilds add them to totals of attached partitions.
+    """
+    __tablename__ = 'donation_archive'
+
+    partition = Column(String, primary_key=True)
+    # Name of DonationDb column the account is referenced by, like donator_id or youtube_channel_id
+    account_column = Column(String, primary_key=True)
+    account_id = Column(Uuid(as_uuid=True), primary_key=True)
+    # Sum of settled donations (see settled_donation_filter)
+    amount = Column(BigInteger, nullable=False)
+    claimed_amount = Column(BigInteger, nullable=False)
+    last_paid_at = Column(TIMESTAMP)
+
+
+class PushSubscriptionDb(Base):
+    __tablename__ = 'push_subscription'
+
+    id = Column(Uuid(as_uuid=True), primary_key=True, server_default=func.uuid_generate_v4())
+    donator_id = Column(Uuid(as_uuid=True), ForeignKey(DonatorDb.id, ondelete='CASCADE'), nullable=False, index=True)
+    endpoint = Column(String, unique=True, nullable=False)
+    p256dh = Column(String, nullable=False)
+    auth = Column(String, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+
+
+class PushDeliveryDb(Base):
+    """
+    Outbox of push messages, there is at most one pending message per subscription
+    because notifications carry full state and only the latest one matters
+    """
+    __tablename__ = 'push_delivery'
+
+    id = Column(Uuid(as_uuid=True), primary_key=True, server_default=func.uuid_generate_v4())
+    subscription_id = Column(
+        Uuid(as_uuid=True), ForeignKey(PushSubscriptionDb.id, ondelete='CASCADE'), nullable=False, unique=True,
+    )
+    payload = Column(String, nullable=False)
+    attempts = Column(BigInteger, nullable=False, server_default=text('0'))
+    next_attempt_at = Column(TIMESTAMP, nullable=False, server_default=func.now(), index=True)
+
+
 Base.registry.configure()  # Create backrefs
@@ -1,46 +1,98 @@
+import logging
 from datetime import datetime
 from uuid import UUID
 
-from sqlalchemy import select, desc, union, literal_column
+from sqlalchemy import select, desc, delete, func
 from sqlalchemy.dialects.postgresql import insert
 
 from .models import Donatee
 from .db import DbSessionWrapper
-from .db_models import EmailNotificationDb
+from .db_models import EmailNotificationDb, DonateeLeaderboardDb, DonationDb
 from .db_libs import YoutubeDbLib, TwitterDbLib, GithubDbLib
+from .db_ledger import LedgerDbLib
+from .db_partitions import archived_donations
 
+logger = logging.getLogger(__name__)
 
-class OtherDbLib(DbSessionWrapper):
-    def donatees_subquery(self):
-        return union(*[
-            select(
-                db_lib.db_model.id,
-                db_lib.db_model.balance,
-                db_lib.db_model.total_donated,
-                getattr(db_lib.db_model, db_lib.db_model_name_column).label('title'),
-                getattr(db_lib.db_model, db_lib.db_model_thumbnail_url_column).label('thumbnail_url'),
-                literal_column(f"'{db_lib.name}'").label('type'),
-            )
-            for db_lib in [YoutubeDbLib, TwitterDbLib, GithubDbLib]
-        ]).subquery()
 
+class OtherDbLib(DbSessionWrapper):
     async def query_recently_donated_donatees(self, limit=20, limit_days=180) -> list[Donatee]:
-        donatees = self.donatees_subquery()
         resp = await self.execute(
-            select(donatees)
-            .order_by(desc(donatees.c.total_donated))
+            select(DonateeLeaderboardDb)
+            .order_by(desc(DonateeLeaderboardDb.total_donated))
             .limit(limit)
         )
-        return [Donatee.from_orm(item) for item in resp.fetchall()]
+        return [Donatee.from_orm(item) for item in resp.scalars()]
 
     async def query_top_unclaimed_donatees(self, limit=20, offset=0) -> list[Donatee]:
-        donatees = self.donatees_subquery()
         resp = await self.execute(
-            select(donatees)
-            .where(donatees.c.balance > 0)
-            .order_by(desc(donatees.c.balance))
+            select(DonateeLeaderboardDb)
+            .where(DonateeLeaderboardDb.balance > 0)
+            .order_by(desc(DonateeLeaderboardDb.balance))
+            .limit(limit)
+            .offset(offset)
         )
-        return [Donatee.from_orm(item) for item in resp.fetchall()]
+        return [Donatee.from_orm(item) for item in resp.scalars()]
+
+    async def rebuild_donatee_leaderboard(self):
+        """
+        Refills donatee leaderboard from social account tables, last_donated_at includes detached donation partitions
+        """
+        await self.execute(delete(DonateeLeaderboardDb))
+        archived = archived_donations()
+        for db_lib in [YoutubeDbLib, TwitterDbLib, GithubDbLib]:
+            last_donated_at = func.greatest(
+                select(func.max(DonationDb.paid_at))
+                .where(
+                    (getattr(DonationDb, db_lib.donation_column) == db_lib.db_model.id)
+                    & DonationDb.cancelled_at.is_(None)
+                )
+                .scalar_subquery(),
+                select(func.max(archived.c.last_paid_at))
+                .where((archived.c.account_column == db_lib.donation_column) & (archived.c.account_id == db_lib.db_model.id))
+                .scalar_subquery(),
+            )
+            await self.execute(
+                insert(DonateeLeaderboardDb)
+                .from_select(
+                    [column.name for column in DonateeLeaderboardDb.__table__.columns],
+                    db_lib.leaderboard_select(last_donated_at),
+                )
+            )
+
+    async def compact_balance_ledger(self, limit: int) -> int:
+        """
+        Folds up to *limit* ledger entries into account rows and updates donatee leaderboard of changed accounts.
+        Returns number of changed accounts.
+        """
+        changed: dict = await LedgerDbLib(self).compact(limit)
+        for db_lib in [YoutubeDbLib, TwitterDbLib, GithubDbLib]:
+            for row in changed.get(db_lib.db_model, []):
+                await db_lib(self).sync_donatee(row.account_id, last_donated_at=row.last_donated_at)
+        return sum(len(rows) for rows in changed.values())
+
+    async def stamp_transfers(self, limit: int) -> int:
+        """
+        Marks donations of up to *limit* new transfers of each account type as claimed, returns number of stamped transfers
+        """
+        stamped = 0
+        for db_lib in [YoutubeDbLib, TwitterDbLib, GithubDbLib]:
+            stamped += await db_lib(self).stamp_transfers(limit=limit)
+        return stamped
+
+    async def audit_balances(self) -> int:
+        """
+        Logs accounts which balance does not match their unclaimed donations, returns number of such accounts
+        """
+        count = 0
+        for db_lib in [YoutubeDbLib, TwitterDbLib, GithubDbLib]:
+            for account in await db_lib(self).audit_balances():
+                logger.error(
+                    "%s account %s balance (%d) != unclaimed donations (%d)",
+                    db_lib.name, account.id, account.balance, account.expected,
+                )
+                count += 1
+        return count
 
     async def save_email(self, email: str) -> UUID | None:
         resp = await self.execute(
@@ -0,0 +1,156 @@
+"""
+Monthly range partitions of the donation table.
+Partitions are created ahead of time, partitions older than retention period could be detached for archival.
+Totals of a partition are copied to DonationArchiveDb before it's detached, so rebuilt stats still include its donations.
+"""
+import logging
+import re
+from datetime import datetime
+
+from sqlalchemy import select, delete, text, column, String
+
+from .db import DbSessionWrapper
+from .db_models import DonationDb, DonationArchiveDb
+
+logger = logging.getLogger(__name__)
+
+# DonationDb columns referencing accounts, archived totals are kept for each of them
+ARCHIVED_COLUMNS = ['donator_id', 'receiver_id', 'youtube_channel_id', 'twitter_account_id', 'github_user_id']
+# Same conditions as settled_donation_filter and claimable_donation_filter
+SETTLED = 'paid_at IS NOT NULL AND cancelled_at IS NULL AND (receiver_id IS NULL OR donator_id != receiver_id)'
+CLAIMABLE = 'claimed_at IS NULL AND paid_at IS NOT NULL AND cancelled_at IS NULL'
+
+
+def month_start(value: datetime, months: int = 0) -> datetime:
+    """
+    Returns the first moment of the month *months* after the month of *value*
+    """
+    month_index: int = value.year * 12 + value.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f'donation_y{month:%Y}m{month:%m}'
+
+
+def parse_bounds(bound: str) -> tuple[datetime | None, datetime | None]:
+    """
+    Parses bounds of a range partition, like FOR VALUES FROM ('2023-01-01 00:00:00') TO ('2023-02-01 00:00:00')
+    Returns None for MINVALUE and for both bounds of the default partition.
+    """
+    lower, upper = (
+        re.search(rf"{keyword} \('([^']+)'\)", bound) for keyword in ['FROM', 'TO']
+    )
+    return tuple(datetime.fromisoformat(match.group(1)) if match else None for match in [lower, upper])
+
+
+def archived_donations():
+    """
+    Selects DonationArchiveDb rows of partitions that are already detached, attached ones are still counted from donations.
+    A partition pending detach is not attached, queries do not see its rows anymore.
+    """
+    attached = text(
+        "SELECT inhrelid::regclass::text AS name FROM pg_inherits"
+        f" WHERE inhparent = '{DonationDb.__tablename__}'::regclass AND NOT inhdetachpending"
+    ).columns(column('name', String))
+    return select(DonationArchiveDb).where(DonationArchiveDb.partition.not_in(attached)).subquery()
+
+
+class PartitionsDbLib(DbSessionWrapper):
+    async def query_partitions(self, detach_pending: bool = False) -> dict[str, tuple[datetime | None, datetime | None]]:
+        """
+        Returns bounds of donation partitions by their names, see parse_bounds.
+        If *detach_pending* is set only partitions with interrupted DETACH CONCURRENTLY are returned.
+        """
+        resp = await self.execute(text("""
+            SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = :table AND pg_inherits.inhdetachpending = :detach_pending
+        """), dict(table=DonationDb.__tablename__, detach_pending=detach_pending))
+        return {row.name: parse_bounds(row.bound) for row in resp.all()}
+
+    async def create_partitions(self, now: datetime, months_ahead: int) -> list[str]:
+        """
+        Creates partitions for the current month and *months_ahead* next months.
+        Month is skipped if it overlaps an existing partition, like donation_legacy,
+        or if the default partition (created by older versions) already has its rows, they should be moved manually.
+        Returns names of created partitions.
+        """
+        partitions: dict[str, tuple[datetime | None, datetime | None]] = await self.query_partitions()
+        created = []
+        for months in range(months_ahead + 1):
+            start: datetime = month_start(now, months)
+            end: datetime = month_start(now, months + 1)
+            name: str = partition_name(start)
+            if name in partitions or any(
+                (lower is None or lower < end) and upper is not None and upper > start
+                for lower, upper in partitions.values()
+            ):
+                continue
+            if 'donation_default' in partitions:
+                resp = await self.execute(text(
+                    "SELECT EXISTS (SELECT 1 FROM donation_default WHERE created_at >= :start AND created_at < :end)"
+                ), dict(start=start, end=end))
+                if resp.scalar():
+                    logger.warning("Default donation partition has rows for %s, partition %s is not created", start, name)
+                    continue
+            await self.execute(text(
+                f"CREATE TABLE {name} PARTITION OF donation FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            ))
+            created.append(name)
+        return created
+
+    async def archive_partitions(self, before: datetime) -> list[str]:
+        """
+        Copies totals of partitions with all rows created before *before* to DonationArchiveDb.
+        Partitions with claimable donations are skipped because they are still a part of account balances.
+        Returns names of archived partitions, they should be detached after commit.
+        """
+        archived = []
+        for name, (_, upper_bound) in (await self.query_partitions()).items():
+            if upper_bound is None or upper_bound > before:
+                continue
+            resp = await self.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name} WHERE {CLAIMABLE})"))
+            if resp.scalar():
+                logger.warning("Donation partition %s has claimable donations, it's not detached", name)
+                continue
+            # Totals of a previous attempt are replaced, the partition has not been detached then
+            await self.execute(delete(DonationArchiveDb).where(DonationArchiveDb.partition == name))
+            for account_column in ARCHIVED_COLUMNS:
+                await self.execute(text(f"""
+                    INSERT INTO {DonationArchiveDb.__tablename__}
+                        (partition, account_column, account_id, amount, claimed_amount, last_paid_at)
+                    SELECT
+                        :partition, :account_column, {account_column},
+                        coalesce(sum(amount) FILTER (WHERE {SETTLED}), 0),
+                        coalesce(sum(amount) FILTER (WHERE {SETTLED} AND claimed_at IS NOT NULL), 0),
+                        max(paid_at) FILTER (WHERE cancelled_at IS NULL)
+                    FROM {name}
+                    WHERE {account_column} IS NOT NULL
+                    GROUP BY {account_column}
+                """), dict(partition=name, account_column=account_column))
+            archived.append(name)
+        return archived
+
+
+async def detach_partitions(db, before: datetime) -> list[str]:
+    """
+    Archives and detaches partitions with all rows created before *before*, detached tables keep their names.
+    DETACH PARTITION CONCURRENTLY does not block queries to the donation table, but it could not run in a transaction,
+    so it's executed after archived totals are committed. Interrupted detaches are finalized first.
+    Returns names of detached partitions.
+    """
+    async with db.session() as db_session:
+        partitions_db = PartitionsDbLib(db_session)
+        if 'donation_default' in await partitions_db.query_partitions():
+            logger.warning("Donation partitions could not be detached concurrently while donation_default exists")
+            return []
+        pending: list[str] = list(await partitions_db.query_partitions(detach_pending=True))
+        archived: list[str] = await partitions_db.archive_partitions(before)
+    for name in pending:
+        await db.execute_autocommit(f'ALTER TABLE donation DETACH PARTITION {name} FINALIZE')
+    for name in archived:
+        await db.execute_autocommit(f'ALTER TABLE donation DETACH PARTITION {name} CONCURRENTLY')
+    return pending + archived
@@ -0,0 +1,110 @@
+"""
+Connection pool with checkout metrics and adaptive sizing
+"""
+import logging
+import math
+import time
+
+import sqlalchemy
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .settings import DbSettings
+from .metrics import pool_checkout_seconds, pool_connections
+
+logger = logging.getLogger(__name__)
+# MeteredPool.resize changes private state of AsyncAdaptedQueuePool and its asyncio.Queue,
+# it's written against SQLAlchemy 1.4.49 and should be rechecked when upgrading
+RESIZABLE_SQLALCHEMY_VERSION = '1.4.'
+
+
+def check_resizable():
+    if not sqlalchemy.__version__.startswith(RESIZABLE_SQLALCHEMY_VERSION):
+        raise NotImplementedError(f"Pool resizing is not supported with SQLAlchemy {sqlalchemy.__version__}")
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """
+    Records time spent waiting for a connection and number of connections.
+    Could be resized without dropping idle connections.
+    """
+    name = 'primary'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Statistics since the last `take_stats` call
+        self.checkouts: int = 0
+        self.wait_seconds: float = 0
+        self.peak_checkedout: int = 0
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.name = self.name
+        return pool
+
+    def connect(self):
+        started_at: float = time.perf_counter()
+        connection = super().connect()
+        duration: float = time.perf_counter() - started_at
+        pool_checkout_seconds.observe(self.name, value=duration)
+        self.checkouts += 1
+        self.wait_seconds += duration
+        self.peak_checkedout = max(self.peak_checkedout, self.checkedout())
+        self.update_metrics()
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self.update_metrics()
+
+    def update_metrics(self):
+        pool_connections.set(self.name, 'checked_out', value=self.checkedout())
+        pool_connections.set(self.name, 'idle', value=self.checkedin())
+        pool_connections.set(self.name, 'size', value=self.size())
+
+    def take_stats(self) -> tuple[float, int]:
+        """
+        Returns average checkout wait and peak number of checked out connections since the previous call
+        """
+        average_wait: float = self.wait_seconds / self.checkouts if self.checkouts else 0
+        peak: int = max(self.peak_checkedout, self.checkedout())
+        self.checkouts, self.wait_seconds, self.peak_checkedout = 0, 0, 0
+        return average_wait, peak
+
+    def resize(self, pool_size: int):
+        """
+        Changes number of connections kept open, max_overflow connections are still allowed above it.
+        Excess idle connections are closed when they are returned to the pool.
+        """
+        check_resizable()
+        with self._overflow_lock:
+            # Overflow is counted relative to the pool size
+            self._overflow -= pool_size - self._pool.maxsize
+            self._pool.maxsize = pool_size
+            # asyncio.Queue is created on first use and does not allow to change maxsize
+            if '_queue' in self._pool.__dict__:
+                self._pool._queue._maxsize = pool_size
+        self.update_metrics()
+
+
+def next_pool_size(pool_size: int, average_wait: float, peak_checkedout: int, settings: DbSettings) -> int:
+    """
+    Grows pool by a quarter when connections are waited for longer than the target,
+    shrinks it by one connection when less than half of it was used.
+    """
+    if average_wait > settings.pool_wait_target.total_seconds():
+        return min(settings.pool_size_max, pool_size + math.ceil(pool_size / 4))
+    elif peak_checkedout < pool_size // 2:
+        return max(settings.pool_size_min, pool_size - 1)
+    else:
+        return pool_size
+
+
+def adapt_pool_size(pool: MeteredPool, settings: DbSettings):
+    average_wait, peak_checkedout = pool.take_stats()
+    pool_size: int = next_pool_size(pool.size(), average_wait, peak_checkedout, settings)
+    if pool_size != pool.size():
+        logger.info(
+            "Resizing %s pool %d -> %d (average wait %.1fms, peak %d connections)",
+            pool.name, pool.size(), pool_size, average_wait * 1000, peak_checkedout,
+        )
+        pool.resize(pool_size)
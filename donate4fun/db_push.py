@@ -0,0 +1,91 @@
+from datetime import timedelta
+from uuid import UUID
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import PushSubscription
+from .db_models import PushSubscriptionDb, PushDeliveryDb, DonatorDb
+from .db import DbSessionWrapper
+
+
+class PushDbLib(DbSessionWrapper):
+    async def save_subscription(self, donator_id: UUID, subscription: PushSubscription):
+        # Ensure that donator is saved in DB (anonymous donators are not saved until they donate)
+        await self.execute(
+            insert(DonatorDb)
+            .values(id=donator_id)
+            .on_conflict_do_nothing()
+        )
+        values = dict(
+            donator_id=donator_id,
+            endpoint=subscription.endpoint,
+            p256dh=subscription.keys.p256dh,
+            auth=subscription.keys.auth,
+        )
+        await self.execute(
+            insert(PushSubscriptionDb)
+            .values(**values)
+            .on_conflict_do_update(index_elements=[PushSubscriptionDb.endpoint], set_=values)
+        )
+
+    async def delete_subscription(self, donator_id: UUID, endpoint: str):
+        await self.execute(
+            delete(PushSubscriptionDb)
+            .where((PushSubscriptionDb.donator_id == donator_id) & (PushSubscriptionDb.endpoint == endpoint))
+        )
+
+    async def claim_deliveries(self, limit: int, lease: timedelta) -> list:
+        """
+        Takes due deliveries and postpones them by *lease* so other workers skip them while they are being sent.
+        Rows are not kept locked to avoid blocking transactions that enqueue new messages.
+        """
+        due = (
+            select(PushDeliveryDb.id)
+            .where(PushDeliveryDb.next_attempt_at <= func.now())
+            .order_by(PushDeliveryDb.next_attempt_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        result = await self.execute(
+            update(PushDeliveryDb)
+            .where(PushDeliveryDb.id.in_(due) & (PushDeliveryDb.subscription_id == PushSubscriptionDb.id))
+            .values(next_attempt_at=func.now() + lease, attempts=PushDeliveryDb.attempts + 1)
+            .returning(
+                PushDeliveryDb.id,
+                PushDeliveryDb.payload,
+                PushDeliveryDb.attempts,
+                PushSubscriptionDb.id.label('subscription_id'),
+                PushSubscriptionDb.endpoint,
+                PushSubscriptionDb.p256dh,
+                PushSubscriptionDb.auth,
+            )
+        )
+        return result.all()
+
+    async def finish_delivery(self, delivery_id: UUID, payload: str):
+        # Do not delete if a newer message was enqueued while sending this one
+        await self.execute(
+            delete(PushDeliveryDb)
+            .where((PushDeliveryDb.id == delivery_id) & (PushDeliveryDb.payload == payload))
+        )
+
+    async def delivery_failed(self, delivery_id: UUID, payload: str, retry_after: timedelta | None):
+        """
+        Reschedules delivery or drops it if *retry_after* is None
+        """
+        if retry_after is None:
+            await self.finish_delivery(delivery_id, payload)
+        else:
+            await self.execute(
+                update(PushDeliveryDb)
+                .where((PushDeliveryDb.id == delivery_id) & (PushDeliveryDb.payload == payload))
+                .values(next_attempt_at=func.now() + retry_after)
+            )
+
+    async def subscription_expired(self, subscription_id: UUID):
+        await self.execute(
+            delete(PushSubscriptionDb)
+            .where(PushSubscriptionDb.id == subscription_id)
+        )
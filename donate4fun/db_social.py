@@ -1,15 +1,26 @@
+import logging
+from datetime import datetime
+from functools import lru_cache
 from uuid import UUID
 from abc import ABC, abstractmethod
 
-from sqlalchemy import select, func, update, delete
+from sqlalchemy import select, func, update, delete, literal, bindparam, union_all, any_, TIMESTAMP
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql import functions
 
-from .db_models import DonatorDb, DonationDb, TransferDb, DonateeDb, Base as BaseDbModel, BaseLink
-from .db_utils import insert_on_conflict_update
+from .db_models import (
+    DonatorDb, DonationDb, TransferDb, DonateeDb, DonateeLeaderboardDb, Base as BaseDbModel, BaseLink,
+)
+from .db_utils import (
+    upsert_id_statement, upsert_id_params, upsert_params, on_conflict_update, current_columns, undefer_ledger_columns,
+)
+from .db_ledger import LedgerDbLib
 from .db import DbSessionWrapper
-from .models import BaseModel, Donator, SocialAccount
-from .types import InvalidDbState, Satoshi, NotEnoughBalance
+from .db_stats import DonatorStatsDbLib
+from .models import BaseModel, Donator, SocialAccount, SocialAccountNotification
+from .types import Satoshi
+
+logger = logging.getLogger(__name__)
 
 
 def claimable_donation_filter():
@@ -20,6 +31,10 @@ def claimable_donation_filter():
     )
 
 
+# Ensures that donator is saved in DB, parameters are Donator fields
+save_donator_if_missing = insert(DonatorDb).on_conflict_do_nothing()
+
+
 def first(iterable):
     try:
         return next(iter(iterable))
@@ -84,28 +99,88 @@ class SocialDbWrapper(DbSessionWrapper, ABC):
         # FIXME: this could be made simpler by unifying link table column names
         return getattr(cls.link_db_model, list(cls.link_db_model.__table__.foreign_keys)[0].parent.name)
 
-    async def query_account(self, *, owner_id: UUID | None = None, **filter_by):
-        """
-        This is a generic function to get specified by `link_table` social accoutnt for donator (`owner_id`)
-        It assumes that first foreign key is linked to a social account table
-        """
-        foreign_column = first(self.link_db_model.__table__.foreign_keys)
+    # Generic statements below are built once for each class (and query shape), values are passed as parameters
+
+    @classmethod
+    @lru_cache
+    def query_account_statement(cls, filter_keys: tuple[str, ...], by_owner: bool):
+        foreign_column = first(cls.link_db_model.__table__.foreign_keys)
         account_table = foreign_column.column.table
-        owner_links = select(self.link_db_model).where(
-            (self.link_db_model.donator_id == owner_id) if owner_id is not None else self.link_db_model.via_oauth
+        owner_links = select(cls.link_db_model).where(
+            (cls.link_db_model.donator_id == bindparam('owner_id')) if by_owner else cls.link_db_model.via_oauth
         ).subquery()
-        resp = await self.execute(
+        return (
             select(
-                *account_table.c,
+                *current_columns(cls.db_model),
                 owner_links.c.donator_id.label('owner_id'),
                 func.coalesce(owner_links.c.via_oauth, False).label('via_oauth'),
             )
-            .filter_by(**filter_by)
+            .where(*[account_table.c[key] == bindparam(key) for key in filter_keys])
             .outerjoin(
                 owner_links,
                 onclause=account_table.c.id == owner_links.c[foreign_column.parent.name],
             )
         )
+
+    @classmethod
+    @lru_cache
+    def link_account_statement(cls):
+        query = insert(cls.link_db_model)
+        return query.on_conflict_do_update(
+            index_elements=[cls.link_db_model.donator_id, cls.link_db_model_foreign_key],
+            set_={cls.link_db_model.via_oauth: cls.link_db_model.via_oauth | query.excluded.via_oauth},
+        )
+
+    @classmethod
+    @lru_cache
+    def transfer_column(cls):
+        # FIXME: this line should be done simpler
+        return first(
+            key for key in TransferDb.__table__.foreign_keys if key.column.table is cls.db_model.__table__
+        ).parent
+
+    @classmethod
+    @lru_cache
+    def lock_balance_statement(cls):
+        return (
+            select(cls.db_model.balance)
+            .with_for_update(of=cls.db_model)
+            .where(cls.db_model.id == bindparam('account_id'))
+        )
+
+    @classmethod
+    def account_state_columns(cls) -> tuple:
+        """
+        Columns needed for `social_account_changed`
+        """
+        return cls.db_model.id, cls.db_model.balance, cls.db_model.total_donated
+
+    @classmethod
+    @lru_cache
+    def sync_donatee_statement(cls):
+        query = insert(DonateeLeaderboardDb).from_select(
+            [column.name for column in DonateeLeaderboardDb.__table__.columns],
+            cls.leaderboard_select(bindparam('last_donated_at', type_=TIMESTAMP))
+            .where(cls.db_model.id.in_(bindparam('account_ids', expanding=True))),
+        )
+        return query.on_conflict_do_update(
+            index_elements=[DonateeLeaderboardDb.type, DonateeLeaderboardDb.id],
+            set_=dict(
+                title=query.excluded.title,
+                thumbnail_url=query.excluded.thumbnail_url,
+                balance=query.excluded.balance,
+                total_donated=query.excluded.total_donated,
+                last_donated_at=func.coalesce(query.excluded.last_donated_at, DonateeLeaderboardDb.last_donated_at),
+            ),
+        )
+
+    async def query_account(self, *, owner_id: UUID | None = None, **filter_by):
+        """
+        This is a generic function to get specified by `link_table` social accoutnt for donator (`owner_id`)
+        It assumes that first foreign key is linked to a social account table
+        """
+        params = dict(filter_by) if owner_id is None else dict(filter_by, owner_id=owner_id)
+        resp = await self.execute(self.query_account_statement(tuple(sorted(filter_by)), owner_id is not None), params)
         return self.owned_model.from_orm(resp.one())
 
     async def link_account(self, account: BaseModel, donator: Donator, via_oauth: bool) -> bool:
@@ -113,30 +188,16 @@ class SocialDbWrapper(DbSessionWrapper, ABC):
         Links a social account to the donator account.
         Returns True if new link is created, False otherwise
         """
-        # Ensure that donator is saved in DB
         # Do no use save_donator because it overwrites fields like lnauth_pubkey which could be uninitialized in `donator`
-        await self.execute(
-            insert(DonatorDb)
-            .values(**donator.dict(exclude={'connected'}))
-            .on_conflict_do_nothing()
-        )
-        foreign_column = list(self.link_db_model.__table__.foreign_keys)[0]
-        result = await self.execute(
-            insert(self.link_db_model)
-            .values(
-                donator_id=donator.id,
-                via_oauth=via_oauth,
-                **{foreign_column.parent.name: account.id},
-            )
-            .on_conflict_do_update(
-                index_elements=[self.link_db_model.donator_id, foreign_column.parent],
-                set_={self.link_db_model.via_oauth: self.link_db_model.via_oauth | via_oauth},
-                where=(
-                    (self.link_db_model.donator_id == donator.id)
-                    & (foreign_column.parent == account.id)
-                )
-            )
-        )
+        await self.execute(save_donator_if_missing, donator.dict(exclude={'connected'}))
+        result = await self.execute(self.link_account_statement(), {
+            'donator_id': donator.id,
+            'via_oauth': via_oauth,
+            self.link_db_model_foreign_key.key: account.id,
+        })
+        await DonatorStatsDbLib(self.session).refresh_total_received(donator.id)
+        await self.update_donator_connected(donator.id)
+        await self.donator_changed(donator.id)
         return result.rowcount == 1
 
     async def unlink_account(self, account_id: UUID, owner_id: UUID):
@@ -147,102 +208,170 @@ class SocialDbWrapper(DbSessionWrapper, ABC):
                 & (self.link_db_model.donator_id == owner_id)
             )
         )
-        await self.object_changed('donator', owner_id)
+        await DonatorStatsDbLib(self.session).refresh_total_received(owner_id)
+        await self.update_donator_connected(owner_id)
+        await self.donator_changed(owner_id)
 
     async def transfer_donations(self, account: BaseModel, donator: Donator) -> Satoshi:
         """
         Transfers money from social account balance to donator balance
-        *social_relation* is a relation inside DonationDb pointing to social account table
+        Only the account row is locked, donations are marked as claimed later by `stamp_transfers`
         Returns amount transferred
         """
-        result = await self.execute(
-            select(self.db_model.balance)
-            .with_for_update()
-            .where(self.db_model.id == account.id)
-        )
+        result = await self.execute(self.lock_balance_statement(), dict(account_id=account.id))
         amount: Satoshi = result.scalar()
-        donations_filter = getattr(DonationDb, self.donation_column) == account.id
-        # FIXME: this line should be done simpler
-        transfer_column = first(
-            key for key in TransferDb.__table__.foreign_keys if key.column.table is self.db_model.__table__
-        ).parent
-        await self.start_transfer(
-            donator=donator,
-            amount=amount,
-            donations_filter=donations_filter,
-            **{transfer_column.key: account.id},
+        # Balance and donations are read from the same snapshot, so these are exactly the donations included into amount
+        # (donations of not yet stamped transfers are not claimed yet, but they are already deducted from the balance)
+        transferred_ids = (
+            select(func.unnest(TransferDb.donation_ids))
+            .where(TransferDb.stamped_at.is_(None) & (self.transfer_column() == account.id))
         )
+        donation_ids = select(func.coalesce(func.array_agg(DonationDb.id), literal([], TransferDb.donation_ids.type))).where(
+            claimable_donation_filter()
+            & (getattr(DonationDb, self.donation_column) == account.id)
+            & DonationDb.id.not_in(transferred_ids)
+        ).scalar_subquery()
         await self.execute(
-            update(self.db_model)
-            .values(balance=self.db_model.balance - amount)
-            .where(self.db_model.id == account.id)
+            insert(TransferDb)
+            .values({
+                'amount': amount,
+                'donator_id': donator.id,
+                'created_at': functions.now(),
+                'donation_ids': donation_ids,
+                self.transfer_column().key: account.id,
+            })
+        )
+        account_state = await LedgerDbLib(self).change_balance(
+            self.db_model, account.id, balance_diff=-amount,
+            returning=self.account_state_columns(),
         )
-        await self.finish_transfer(amount=amount, donator=donator, donations_filter=donations_filter)
+        await self.social_account_changed(account_state)
+        await self.sync_donatee(account.id)
+        await LedgerDbLib(self).change_balance(DonatorDb, donator.id, balance_diff=amount)
+        await self.donator_changed(donator.id)
         return amount
 
-    async def start_transfer(self, donator: Donator, amount: int, donations_filter, **transfer_fields):
+    async def stamp_transfers(self, account_id: UUID | None = None, limit: int | None = None) -> int:
         """
-        Ensures that Donator's balance and sum of unclaimed donations match.
-        Then it creates a corresponding Transfer using *transfer_fields*.
+        Marks donations of not yet stamped transfers as claimed, oldest transfers first.
+        If *account_id* is given then only transfers from this account are stamped.
+        Returns number of stamped transfers.
         """
-        subquery = (
-            select(DonationDb)
-            .where(claimable_donation_filter() & donations_filter)
-            .with_for_update()
-            .subquery()
+        transfer_column = self.transfer_column()
+        query = (
+            select(TransferDb.id, TransferDb.amount, TransferDb.created_at, transfer_column.label('account_id'))
+            .where(TransferDb.stamped_at.is_(None) & transfer_column.isnot(None))
+            .order_by(TransferDb.created_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
         )
-        result = await self.execute(
-            select(func.coalesce(func.sum(subquery.c.amount), 0).label('amount'))
+        if account_id is not None:
+            query = query.where(transfer_column == account_id)
+        transfers = (await self.execute(query)).all()
+        for transfer in transfers:
+            await self.stamp_transfer(transfer)
+        return len(transfers)
+
+    async def stamp_transfer(self, transfer):
+        """
+        Marks donations recorded by `transfer_donations` as claimed
+        """
+        resp = await self.execute(
+            update(DonationDb)
+            .values(claimed_at=transfer.created_at)
+            .where(
+                (DonationDb.id == any_(select(TransferDb.donation_ids).where(TransferDb.id == transfer.id).scalar_subquery()))
+                & DonationDb.claimed_at.is_(None)
+            )
+            .returning(DonationDb.amount, DonationDb.donator_id)
         )
-        sum_amount: int = result.fetchone().amount
-        if sum_amount != amount:
-            raise InvalidDbState(f"Sum of donations ({sum_amount}) != account balance ({amount})")
+        claimed = resp.all()
+        if (claimed_sum := sum(donation.amount for donation in claimed)) != transfer.amount:
+            logger.warning(f"Transfer {transfer.id} amount ({transfer.amount}) != sum of its donations ({claimed_sum})")
+        await DonatorStatsDbLib(self.session).donations_claimed(claimed)
+        # A single notification for the whole batch, subscribers of the account reload its donations
+        await self.object_changed(f'social:{self.name}', transfer.account_id)
         await self.execute(
-            insert(TransferDb)
-            .values(
-                amount=amount,
-                donator_id=donator.id,
-                created_at=functions.now(),
-                **transfer_fields,
-            )
+            update(TransferDb)
+            .values(stamped_at=functions.now())
+            .where(TransferDb.id == transfer.id)
         )
 
-    async def finish_transfer(self, donator: Donator, amount: int, donations_filter):
-        await self.execute(
-            update(DonationDb)
-            .values(claimed_at=functions.now())
-            .where(claimable_donation_filter() & donations_filter)
+    async def audit_balances(self) -> list:
+        """
+        Finds accounts which balance differs from the sum of unclaimed donations minus not yet stamped transfers.
+        Returns rows with id, balance and expected balance.
+        """
+        donation_column = getattr(DonationDb, self.donation_column)
+        transfer_column = self.transfer_column()
+        unclaimed = (
+            select(donation_column.label('account_id'), func.sum(DonationDb.amount).label('amount'))
+            .where(claimable_donation_filter() & donation_column.isnot(None))
+            .group_by(donation_column)
+            .subquery()
         )
-        await self.execute(
-            update(DonatorDb)
-            .values(balance=DonatorDb.balance + amount)
-            .where(DonatorDb.id == donator.id)
+        pending = (
+            select(transfer_column.label('account_id'), func.sum(TransferDb.amount).label('amount'))
+            .where(TransferDb.stamped_at.is_(None) & transfer_column.isnot(None))
+            .group_by(transfer_column)
+            .subquery()
         )
-        await self.object_changed('donator', donator.id)
+        expected = func.coalesce(unclaimed.c.amount, 0) - func.coalesce(pending.c.amount, 0)
+        resp = await self.execute(
+            select(self.db_model.id, self.db_model.balance.label('balance'), expected.label('expected'))
+            .outerjoin(unclaimed, unclaimed.c.account_id == self.db_model.id)
+            .outerjoin(pending, pending.c.account_id == self.db_model.id)
+            .where(self.db_model.balance != expected)
+        )
+        return resp.all()
 
     async def save_account(self, account: DonateeDb):
-        external_key = self.db_model.__table__.info['external_key']
+        external_key = getattr(self.db_model, self.db_model.__table__.info['external_key'])
         resp = await self.execute(
-            insert_on_conflict_update(self.db_model, account, getattr(self.db_model, external_key))
+            upsert_id_statement(self.db_model, external_key), upsert_id_params(self.db_model, account, external_key),
         )
-        id_: UUID = resp.scalar()
-        if id_ is None:
-            resp = await self.execute(
-                select(self.db_model.id).where(getattr(self.db_model, external_key) == getattr(account, external_key))
-            )
-            id_ = resp.scalar()
+        id_: UUID = resp.scalar_one()
         account.id = id_
+        await self.sync_donatee(id_)
+
+    async def save_accounts(self, accounts: list[DonateeDb]) -> list[UUID]:
+        """
+        Bulk version of save_account: upserts all accounts in one statement and returns their ids in the input order.
+        Ids of unchanged accounts are selected in the same statement.
+        """
+        if not accounts:
+            return []
+        external_key = getattr(self.db_model, self.db_model.__table__.info['external_key'])
+        # A row could not be updated twice by one statement, so the last account with the same key wins
+        rows: dict = {getattr(account, external_key.key): upsert_params(self.db_model, account) for account in accounts}
+        upserted = (
+            on_conflict_update(self.db_model, external_key)
+            .values(list(rows.values()))
+            .returning(self.db_model.id, external_key)
+            .cte('upserted')
+        )
+        unchanged = (
+            select(self.db_model.id, external_key)
+            .where(external_key.in_(list(rows)) & external_key.not_in(select(upserted.c[external_key.key])))
+        )
+        result = await self.execute(union_all(select(upserted.c.id, upserted.c[external_key.key]), unchanged))
+        ids: dict = {key: id_ for id_, key in result}
+        for account in accounts:
+            account.id = ids[getattr(account, external_key.key)]
+        await self.sync_donatees(list(ids.values()))
+        return [account.id for account in accounts]
 
     async def query_accounts(self, *filters) -> list[SocialAccount]:
         result = await self.execute(
             select(self.db_model)
+            .options(*undefer_ledger_columns(self.db_model))
             .where(*filters)
         )
         return [self.model.from_orm(row) for row in result.scalars()]
 
     async def query_linked_accounts(self, owner_id: UUID) -> list[SocialAccount]:
         result = await self.execute(
-            select(*self.db_model.__table__.columns, func.bool_or(self.link_db_model.via_oauth).label('via_oauth'))
+            select(*current_columns(self.db_model), func.bool_or(self.link_db_model.via_oauth).label('via_oauth'))
             .join(self.link_db_model, self.db_model.id == self.link_db_model_foreign_key)
             .where(self.link_db_model.donator_id == owner_id)
             .group_by(self.db_model.id)
@@ -251,15 +380,43 @@ class SocialDbWrapper(DbSessionWrapper, ABC):
 
     async def update_balance_for_donation(self, balance_diff: Satoshi, total_diff: Satoshi, donation: DonationDb) -> Satoshi:
         social_account_id: UUID = getattr(donation, self.donation_column)
-        resp = await self.execute(
-            update(self.db_model)
-            .values(
-                balance=self.db_model.balance + balance_diff,
-                total_donated=self.db_model.total_donated + total_diff,
-            )
-            .where(self.db_model.id == social_account_id)
-            .returning(self.db_model.balance)
+        account_state = await LedgerDbLib(self).change_balance(
+            self.db_model, social_account_id, balance_diff=balance_diff, total_diff=total_diff, donated_at=donation.paid_at,
+            returning=self.account_state_columns(),
         )
-        if resp.fetchone().balance < 0:
-            raise NotEnoughBalance(f"{self.db_model}[{social_account_id}] hasn't enough money")
-        await self.object_changed(f'social:{self.name}', social_account_id)
+        await self.social_account_changed(account_state)
+        if balance_diff < 0 or total_diff < 0:
+            await self.sync_donatee(social_account_id)
+        # Otherwise the leaderboard is updated when the ledger is compacted to avoid updating a hot row
+
+    @classmethod
+    def leaderboard_select(cls, last_donated_at):
+        """
+        Selects account columns in DonateeLeaderboardDb order
+        """
+        return select(
+            literal(cls.name).label('type'),
+            cls.db_model.id,
+            getattr(cls.db_model, cls.db_model_name_column).label('title'),
+            getattr(cls.db_model, cls.db_model_thumbnail_url_column).label('thumbnail_url'),
+            cls.db_model.balance,
+            cls.db_model.total_donated,
+            last_donated_at.label('last_donated_at'),
+        )
+
+    async def sync_donatee(self, account_id: UUID, last_donated_at: datetime | None = None):
+        """
+        Copies account to the donatee leaderboard, keeps previous last_donated_at if *last_donated_at* is None
+        """
+        await self.sync_donatees([account_id], last_donated_at=last_donated_at)
+
+    async def sync_donatees(self, account_ids: list[UUID], last_donated_at: datetime | None = None):
+        await self.execute(self.sync_donatee_statement(), dict(account_ids=account_ids, last_donated_at=last_donated_at))
+
+    async def social_account_changed(self, account):
+        """
+        *account* could be any row with account id, balance and total_donated
+        """
+        await self.object_changed(f'social:{self.name}', account.id, SocialAccountNotification(
+            id=account.id, status='OK', balance=account.balance, total_donated=account.total_donated,
+        ))
@@ -0,0 +1,235 @@
+from datetime import timedelta
+from uuid import UUID
+
+from sqlalchemy import select, delete, func, case, literal, union_all, BigInteger
+from sqlalchemy.dialects.postgresql import insert, UUID as Uuid
+
+from .models import DonatorStats
+from .db import DbSessionWrapper, query_budget
+from .db_models import (
+    DonationDb, DonatorStatsDb, BalanceLedgerDb, YoutubeChannelDb, TwitterAuthorDb, YoutubeChannelLink, TwitterAuthorLink,
+    ledger_tail,
+)
+from .db_partitions import archived_donations
+
+# Donations to these accounts are counted as received by donators linked to them
+received_links = [
+    (DonationDb.youtube_channel_id, YoutubeChannelLink, YoutubeChannelLink.youtube_channel_id),
+    (DonationDb.twitter_account_id, TwitterAuthorLink, TwitterAuthorLink.twitter_author_id),
+]
+
+
+def settled_donation_filter():
+    """
+    Paid and not cancelled donations except those sent by donator to himself
+    """
+    return (
+        DonationDb.paid_at.isnot(None)
+        & DonationDb.cancelled_at.is_(None)
+        & (DonationDb.receiver_id.is_(None) | (DonationDb.donator_id != DonationDb.receiver_id))
+    )
+
+
+def sent_donations_subquery(donator_id: UUID):
+    return select(
+        DonationDb
+    ).where(
+        settled_donation_filter() & (DonationDb.donator_id == donator_id)
+    ).subquery()
+
+
+def received_donations_subquery(donator_id: UUID):
+    return select(
+        DonationDb
+    ).outerjoin(
+        DonationDb.youtube_channel
+    ).outerjoin(
+        YoutubeChannelDb.links
+    ).outerjoin(
+        DonationDb.twitter_account
+    ).outerjoin(
+        TwitterAuthorDb.links
+    ).where(
+        DonationDb.paid_at.isnot(None)
+        & DonationDb.cancelled_at.is_(None)
+        & (
+            (YoutubeChannelLink.donator_id == donator_id)
+            | (TwitterAuthorLink.donator_id == donator_id)
+            | (DonationDb.receiver_id == donator_id)
+        )
+    ).subquery()
+
+
+def archived_received(archived):
+    """
+    Selects (donator_id, amount) of received totals of *archived* partitions (see archived_donations)
+    """
+    return [
+        select(archived.c.account_id.label('donator_id'), archived.c.amount)
+        .where(archived.c.account_column == DonationDb.receiver_id.key),
+        *[
+            select(link_model.donator_id, archived.c.amount)
+            .join(link_model, link_column == archived.c.account_id)
+            .where(archived.c.account_column == donation_column.key)
+            for donation_column, link_model, link_column in received_links
+        ],
+    ]
+
+
+def received_amounts():
+    """
+    Selects (donator_id, amount) for every received donation, a donation appears once for each linked donator.
+    Detached partitions are included as their archived totals.
+    """
+    return union_all(
+        select(DonationDb.receiver_id.label('donator_id'), DonationDb.amount)
+        .where(settled_donation_filter() & DonationDb.receiver_id.isnot(None)),
+        *[
+            select(link_model.donator_id, DonationDb.amount)
+            .join(link_model, link_column == donation_column)
+            .where(settled_donation_filter())
+            for donation_column, link_model, link_column in received_links
+        ],
+        *archived_received(archived_donations()),
+    ).subquery()
+
+
+def add_stats(query, *columns: str):
+    """
+    Makes an insert query add *columns* to existing stats instead of failing
+    """
+    return query.on_conflict_do_update(
+        index_elements=[DonatorStatsDb.donator_id],
+        set_={column: DonatorStatsDb.__table__.c[column] + getattr(query.excluded, column) for column in columns},
+    )
+
+
+class DonatorStatsDbLib(DbSessionWrapper):
+    async def query_donator_stats(self, donator_id: UUID) -> DonatorStats:
+        result = await self.execute(
+            select(DonatorStatsDb)
+            .where(DonatorStatsDb.donator_id == donator_id)
+        )
+        stats: DonatorStatsDb | None = result.scalar()
+        if stats is None:
+            # Received donations could be still in the ledger
+            result = await self.execute(select(ledger_tail(DonatorStatsDb.__tablename__, donator_id, BalanceLedgerDb.total_diff)))
+            return DonatorStats(total_donated=0, total_claimed=0, total_received=result.scalar())
+        return DonatorStats.from_orm(stats)
+
+    async def donation_settled(self, donation: DonationDb, amount: int):
+        """
+        Updates stats for a paid (*amount* > 0) or cancelled (*amount* < 0) donation.
+        Receivers' total_received of paid donations is appended to the ledger, so donations to popular accounts
+        do not wait for each other on their stats rows.
+        """
+        if donation.receiver_id is not None and donation.receiver_id == donation.donator_id:
+            return
+        if donation.donator_id is not None:
+            await self.execute(add_stats(
+                insert(DonatorStatsDb).values(
+                    donator_id=donation.donator_id,
+                    total_donated=amount,
+                    total_claimed=0 if donation.claimed_at is None else amount,
+                ),
+                'total_donated', 'total_claimed',
+            ))
+        receivers = [
+            select(link_model.donator_id).where(link_column == account_id)
+            for donation_column, link_model, link_column in received_links
+            if (account_id := getattr(donation, donation_column.key)) is not None
+        ]
+        if donation.receiver_id is not None:
+            receivers.append(select(literal(donation.receiver_id, Uuid(as_uuid=True)).label('donator_id')))
+        if not receivers:
+            return
+        received = union_all(*receivers).subquery()
+        if amount > 0:
+            await self.execute(insert(BalanceLedgerDb).from_select(
+                ['account_type', 'account_id', 'total_diff'],
+                select(literal(DonatorStatsDb.__tablename__), received.c.donator_id, literal(amount, BigInteger)),
+            ))
+        else:
+            # Decreases are rare (cancelled donations), so they are applied to stats rows directly
+            await self.execute(add_stats(
+                insert(DonatorStatsDb).from_select(
+                    ['donator_id', 'total_received'], select(received.c.donator_id, literal(amount, BigInteger)),
+                ),
+                'total_received',
+            ))
+
+    async def donations_claimed(self, donations: list):
+        """
+        *donations* are rows with donator_id and amount of just claimed donations
+        """
+        claimed: dict[UUID, int] = {}
+        for donation in donations:
+            if donation.donator_id is not None:
+                claimed[donation.donator_id] = claimed.get(donation.donator_id, 0) + donation.amount
+        if claimed:
+            await self.execute(add_stats(
+                insert(DonatorStatsDb).values([
+                    dict(donator_id=donator_id, total_claimed=amount) for donator_id, amount in claimed.items()
+                ]),
+                'total_claimed',
+            ))
+
+    @query_budget(statement_timeout=timedelta(seconds=10))
+    async def refresh_total_received(self, donator_id: UUID):
+        """
+        Recalculates total_received when set of donator's linked accounts is changed
+        """
+        # Ledger entries seen by this transaction are included into the recalculated value
+        await self.execute(delete(BalanceLedgerDb).where(
+            (BalanceLedgerDb.account_type == DonatorStatsDb.__tablename__) & (BalanceLedgerDb.account_id == donator_id)
+        ))
+        received = received_donations_subquery(donator_id)
+        archived = union_all(*archived_received(archived_donations())).subquery()
+        total_archived = (
+            select(func.coalesce(func.sum(archived.c.amount), 0))
+            .where(archived.c.donator_id == donator_id)
+            .scalar_subquery()
+        )
+        query = insert(DonatorStatsDb).from_select(
+            ['donator_id', 'total_received'],
+            select(literal(donator_id), func.coalesce(func.sum(received.c.amount), 0) + total_archived)
+            .where(received.c.receiver_id.is_(None) | (received.c.receiver_id != received.c.donator_id)),
+        )
+        await self.execute(query.on_conflict_do_update(
+            index_elements=[DonatorStatsDb.donator_id],
+            set_=dict(total_received=query.excluded.total_received),
+        ))
+
+    async def rebuild_donator_stats(self):
+        await self.execute(delete(DonatorStatsDb))
+        await self.execute(delete(BalanceLedgerDb).where(BalanceLedgerDb.account_type == DonatorStatsDb.__tablename__))
+        await self.execute(
+            insert(DonatorStatsDb).from_select(
+                ['donator_id', 'total_donated', 'total_claimed'],
+                select(
+                    DonationDb.donator_id,
+                    func.sum(DonationDb.amount),
+                    func.sum(case((DonationDb.claimed_at.is_(None), 0), else_=DonationDb.amount)),
+                )
+                .where(settled_donation_filter() & DonationDb.donator_id.isnot(None))
+                .group_by(DonationDb.donator_id)
+            )
+        )
+        archived = archived_donations()
+        await self.execute(add_stats(
+            insert(DonatorStatsDb).from_select(
+                ['donator_id', 'total_donated', 'total_claimed'],
+                select(archived.c.account_id, func.sum(archived.c.amount), func.sum(archived.c.claimed_amount))
+                .where(archived.c.account_column == DonationDb.donator_id.key)
+                .group_by(archived.c.account_id)
+            ),
+            'total_donated', 'total_claimed',
+        ))
+        received = received_amounts()
+        await self.execute(add_stats(
+            insert(DonatorStatsDb).from_select(
+                ['donator_id', 'total_received'],
+                select(received.c.donator_id, func.sum(received.c.amount)).group_by(received.c.donator_id),
+            ),
+            'total_received',
+        ))
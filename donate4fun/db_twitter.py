@@ -7,6 +7,7 @@ from sqlalchemy.dialects.postgresql import insert
 from .models import TwitterAccount, TwitterTweet, TwitterAccountOwned
 from .db_models import TwitterAuthorDb, TwitterTweetDb, OAuthTokenDb, TwitterAuthorLink
 from .db_social import SocialDbWrapper
+from .db_utils import returning_id
 
 
 class TwitterDbLib(SocialDbWrapper):
@@ -21,18 +22,14 @@ class TwitterDbLib(SocialDbWrapper):
     db_model_thumbnail_url_column = 'profile_image_url'
 
     async def get_or_create_tweet(self, tweet: TwitterTweet) -> TwitterAuthorDb:
-        resp = await self.execute(
+        resp = await self.execute(returning_id(
             insert(TwitterTweetDb)
             .values(tweet.dict())
-            .on_conflict_do_nothing()
-            .returning(TwitterTweetDb.id)
-        )
-        id_: UUID = resp.scalar()
-        if id_ is None:
-            resp = await self.execute(
-                select(TwitterTweetDb.id).where(TwitterTweetDb.tweet_id == tweet.tweet_id)
-            )
-            id_ = resp.scalar()
+            .on_conflict_do_nothing(),
+            TwitterTweetDb,
+            TwitterTweetDb.tweet_id == tweet.tweet_id,
+        ))
+        id_: UUID = resp.scalar_one()
         tweet.id = id_
 
     async def query_oauth_token(self, name: str) -> dict[str, Any]:
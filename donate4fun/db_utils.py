@@ -1,32 +1,99 @@
-from sqlalchemy import or_
+from functools import lru_cache
+
+from sqlalchemy import or_, select, union_all, exists, bindparam
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import undefer
 
 from .models import BaseModel
 
+# FIXME: move default_persisten_fields to model declaration
+default_persisten_fields = ['id', 'total_donated', 'balance']
+# Columns mapped to snapshot + balance ledger entries
+ledger_columns = ['balance', 'total_donated']
+# These fields are maintained by DB code and are never written from a model
+computed_fields = ['connected']
+
+
+def writable_columns(table) -> list:
+    return [field for field in table.__table__.c if field.name not in computed_fields]
+
 
-def insert_on_conflict_update(table, obj: BaseModel, *index_fields):
+def on_conflict_update(table, *index_fields):
     """
-    Returns INSERT ... ON CONFLICT (*index_fields) DO UPDATE SET ...; query.
+    Returns INSERT ... ON CONFLICT (*index_fields) DO UPDATE SET ...; query without values.
     If index_fields are empty then uses primary key.
+    Existing row is updated only if some values differ.
     """
-    # FIXME: move default_persisten_fields to model declaration
-    default_persisten_fields = ['id', 'total_donated', 'balance']
     persistent_fields = {
-        field.name for field in table.__table__.c
+        field.name for field in writable_columns(table)
         if field.name in default_persisten_fields or field in index_fields
     }
-    values = [(field, getattr(obj, field.name)) for field in table.__table__.c if field.name not in persistent_fields]
+    updated_fields = [field for field in writable_columns(table) if field.name not in persistent_fields]
+    query = insert(table)
     return (
-        insert(table)
-        .values({field.name: getattr(obj, field.name) for field in table.__table__.c})
+        query
         .on_conflict_do_update(
             index_elements=index_fields or inspect(table).primary_key,
-            set_={field: value for field, value in values},
-            where=or_(*[
-                (field.is_(None) != (value is None))
-                | (field != value) for field, value in values
-            ]),
+            set_={field: query.excluded[field.name] for field in updated_fields},
+            where=or_(*[field.is_distinct_from(query.excluded[field.name]) for field in updated_fields]),
         )
-        .returning(table.id)
     )
+
+
+@lru_cache
+def upsert_statement(table, *index_fields):
+    """
+    Returns INSERT ... ON CONFLICT (*index_fields) DO UPDATE SET ... RETURNING id; query.
+    Statement is built once for each table, values are passed as parameters (see `upsert_params`).
+    Id is returned only if row is inserted or changed.
+    """
+    return on_conflict_update(table, *index_fields).returning(table.id)
+
+
+def returning_id(upsert, table, *key_filters):
+    """
+    Turns INSERT ... ON CONFLICT ...; query into a statement which returns id of the row in one round trip:
+    id of inserted or updated row is returned by the INSERT, id of an unchanged row is selected by *key_filters*.
+    Both parts see the same snapshot, so a conflicting row committed concurrently after the statement start is not returned.
+    """
+    upserted = upsert.returning(table.id).cte('upserted')
+    return union_all(
+        select(upserted.c.id),
+        select(table.id).where(*key_filters, ~exists(select(upserted.c.id))),
+    )
+
+
+@lru_cache
+def upsert_id_statement(table, *index_fields):
+    """
+    Same as `upsert_statement` but id is always returned (see `returning_id`), values are passed as `upsert_id_params`.
+    """
+    return returning_id(
+        on_conflict_update(table, *index_fields), table, *[field == bindparam(f'key_{field.key}') for field in index_fields],
+    )
+
+
+def upsert_params(table, obj: BaseModel) -> dict:
+    return {field.name: getattr(obj, field.name) for field in writable_columns(table)}
+
+
+def upsert_id_params(table, obj: BaseModel, *index_fields) -> dict:
+    return upsert_params(table, obj) | {f'key_{field.key}': getattr(obj, field.key) for field in index_fields}
+
+
+def undefer_ledger_columns(model) -> list:
+    """
+    Loader options for ledger columns, they are deferred and left default in models unless undeferred
+    """
+    return [undefer(getattr(model, name)) for name in ledger_columns if hasattr(model, name)]
+
+
+def current_columns(model) -> list:
+    """
+    Table columns for Core selects, balance and total_donated include ledger entries (see BalanceLedgerDb)
+    """
+    return [
+        getattr(model, column.name).label(column.name) if column.name in ledger_columns else column
+        for column in model.__table__.columns
+    ]
@@ -61,14 +61,15 @@ class WithdrawalDbLib(DbSessionWrapper):
                 (DonatorDb.id == donator_id)
                 & (DonatorDb.balance >= total_amount)
             )
-            .values(balance=DonatorDb.balance - total_amount)
-            .returning(DonatorDb.balance)
+            .values(balance=DonatorDb.balance_snapshot - total_amount)
+            .returning(DonatorDb.balance.label('balance'))
         )
         if result.rowcount != 1:
             raise NotFound(f"Donator {donator_id} does not exist or haven't enough money")
+        balance: int = result.scalar()
         await self.object_changed('withdrawal', withdrawal_id)
-        await self.object_changed('donator', donator_id)
-        return result.scalar()
+        await self.donator_changed(donator_id)
+        return balance
 
     async def finish_withdraw(self, withdrawal_id: UUID, fee_msat: int):
         result = await self.execute(
@@ -81,9 +82,9 @@ class WithdrawalDbLib(DbSessionWrapper):
             .returning(WithdrawalDb.donator_id)
         )
         donator_id = result.scalar()
-        result = await self.execute(
+        await self.execute(
             update(DonatorDb)
             .where(DonatorDb.id == donator_id)
-            .values(balance=DonatorDb.balance + settings.fee_limit - math.ceil(fee_msat / 1000))
-            .returning(DonatorDb.balance)
+            .values(balance=DonatorDb.balance_snapshot + settings.fee_limit - math.ceil(fee_msat / 1000))
         )
+        await self.donator_changed(donator_id)
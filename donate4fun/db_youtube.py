@@ -1,12 +1,15 @@
 from uuid import UUID
 
-from sqlalchemy import select, func, update
+from sqlalchemy import select, func
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound  # noqa
 
 from .models import Donator, YoutubeChannel, YoutubeVideo, YoutubeChannelOwned, YoutubeNotification
 from .db_models import YoutubeChannelDb, YoutubeVideoDb, YoutubeChannelLink, DonationDb
 from .db_social import SocialDbWrapper
+from .db_ledger import LedgerDbLib
+from .db_utils import current_columns, returning_id, undefer_ledger_columns
 from .types import Satoshi
 
 
@@ -29,6 +32,7 @@ class YoutubeDbLib(SocialDbWrapper):
     async def find_youtube_channel(self, **filter_by) -> YoutubeChannel:
         resp = await self.execute(
             select(YoutubeChannelDb)
+            .options(*undefer_ledger_columns(YoutubeChannelDb))
             .filter_by(**filter_by)
         )
         return YoutubeChannel.from_orm(resp.scalars().one())
@@ -36,6 +40,7 @@ class YoutubeDbLib(SocialDbWrapper):
     async def query_youtube_channels(self, *filters) -> list[YoutubeChannel]:
         resp = await self.execute(
             select(YoutubeChannelDb)
+            .options(*undefer_ledger_columns(YoutubeChannelDb))
             .where(*filters)
         )
         return [YoutubeChannel.from_orm(data) for data in resp.scalars()]
@@ -43,13 +48,14 @@ class YoutubeDbLib(SocialDbWrapper):
     async def lock_youtube_channel(self, youtube_channel_id: UUID) -> YoutubeChannel:
         result = await self.execute(
             select(YoutubeChannelDb)
+            .options(*undefer_ledger_columns(YoutubeChannelDb))
             .with_for_update(of=YoutubeChannelDb)
             .where(YoutubeChannelDb.id == youtube_channel_id)
         )
         return YoutubeChannel.from_orm(result.scalars().one())
 
     async def save_youtube_video(self, youtube_video: YoutubeVideo):
-        resp = await self.execute(
+        resp = await self.execute(returning_id(
             insert(YoutubeVideoDb)
             .values(dict(
                 youtube_channel_id=youtube_video.youtube_channel.id,
@@ -69,27 +75,27 @@ class YoutubeDbLib(SocialDbWrapper):
                     (func.coalesce(YoutubeVideoDb.title, '') != youtube_video.title)
                     | (func.coalesce(YoutubeVideoDb.thumbnail_url, '') != youtube_video.thumbnail_url)
                 ),
-            )
-            .returning(YoutubeVideoDb.id)
-        )
-        id_: UUID = resp.scalar()
-        if id_ is None:
-            resp = await self.execute(
-                select(YoutubeVideoDb.id).where(YoutubeVideoDb.video_id == youtube_video.video_id)
-            )
-            id_ = resp.scalar()
+            ),
+            YoutubeVideoDb,
+            YoutubeVideoDb.video_id == youtube_video.video_id,
+        ))
+        id_: UUID = resp.scalar_one()
         youtube_video.id = id_
 
     async def query_youtube_video(self, video_id: str) -> YoutubeVideo:
         resp = await self.execute(
             select(YoutubeVideoDb)
+            .options(
+                *undefer_ledger_columns(YoutubeVideoDb),
+                joinedload(YoutubeVideoDb.youtube_channel).options(*undefer_ledger_columns(YoutubeChannelDb)),
+            )
             .where(YoutubeVideoDb.video_id == video_id)
         )
         return YoutubeVideo.from_orm(resp.scalars().one())
 
     async def query_donator_youtube_channels(self, donator_id: UUID) -> list[YoutubeChannelOwned]:
         result = await self.execute(
-            select(*YoutubeChannelDb.__table__.columns, func.bool_or(YoutubeChannelLink.via_oauth).label('via_oauth'))
+            select(*current_columns(YoutubeChannelDb), func.bool_or(YoutubeChannelLink.via_oauth).label('via_oauth'))
             .join(YoutubeChannelLink, YoutubeChannelDb.id == YoutubeChannelLink.youtube_channel_id)
             .where(YoutubeChannelLink.donator_id == donator_id)
             .group_by(YoutubeChannelDb.id)
@@ -102,13 +108,12 @@ class YoutubeDbLib(SocialDbWrapper):
     async def update_balance_for_donation(self, balance_diff: Satoshi, total_diff: Satoshi, donation: DonationDb) -> Satoshi:
         await super().update_balance_for_donation(balance_diff, total_diff, donation)
         if donation.youtube_video_id:
-            video_update_resp = await self.execute(
-                update(YoutubeVideoDb)
-                .values(total_donated=YoutubeVideoDb.total_donated + total_diff)
+            await LedgerDbLib(self).change_balance(YoutubeVideoDb, donation.youtube_video_id, total_diff=total_diff)
+            video_resp = await self.execute(
+                select(YoutubeVideoDb.video_id, YoutubeVideoDb.total_donated)
                 .where(YoutubeVideoDb.id == donation.youtube_video_id)
-                .returning(YoutubeVideoDb.video_id, YoutubeVideoDb.total_donated)
             )
-            vid, total_donated = video_update_resp.fetchone()
+            vid, total_donated = video_resp.one()
             notification = YoutubeNotification(id=donation.youtube_video_id, vid=vid, status='OK', total_donated=total_donated)
             await self.object_changed('youtube-video', donation.youtube_video_id, notification)
             await self.object_changed('youtube-video-by-vid', vid, notification)
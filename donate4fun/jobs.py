@@ -1,19 +1,33 @@
+import asyncio
 import logging
+from datetime import datetime
 
-from sqlalchemy import func
+from sqlalchemy import func, update
 
-from .db import db
+from .db import db, connected_expression
 from .models import TwitterAccount, YoutubeChannel
-from .db_models import TwitterAuthorDb, YoutubeChannelDb
-from .db_libs import TwitterDbLib, YoutubeDbLib
-from .settings import settings
+from .db_models import TwitterAuthorDb, YoutubeChannelDb, DonatorDb
+from .db_libs import TwitterDbLib, YoutubeDbLib, OtherDbLib, DonatorStatsDbLib, PartitionsDbLib
+from .settings import settings, LedgerSettings, TransferSettings, PartitionSettings, DbSettings
 from .twitter import fetch_twitter_author
 from .youtube import fetch_youtube_channel
-from .core import register_command
+from .core import register_command, as_task
+from .db_pool import adapt_pool_size
+from .db_partitions import detach_partitions
 
 logger = logging.getLogger(__name__)
 
 
+# Accounts are saved in batches, each account takes ~10 bind parameters and asyncpg allows up to 32767
+SAVE_BATCH_SIZE = 500
+
+
+async def save_accounts(db_lib_class, accounts: list):
+    if accounts:
+        async with db.async_commit_session() as db_session:
+            await db_lib_class(db_session).save_accounts(accounts)
+
+
 @register_command
 async def refetch_twitter_authors():
     async with db.session() as db_session:
@@ -22,14 +36,16 @@ async def refetch_twitter_authors():
             | TwitterAuthorDb.last_fetched_at.is_(None)
         )
     logger.info("refetching %d authors", len(accounts))
+    fetched: list[TwitterAccount] = []
     for account in accounts:
         try:
-            account: TwitterAccount = await fetch_twitter_author(user_id=account.user_id)
+            fetched.append(await fetch_twitter_author(user_id=account.user_id))
         except Exception:
             logger.exception("Failed to fetch twitter account %s", account)
-        else:
-            async with db.session() as db_session:
-                await TwitterDbLib(db_session).save_account(account)
+        if len(fetched) >= SAVE_BATCH_SIZE:
+            await save_accounts(TwitterDbLib, fetched)
+            fetched = []
+    await save_accounts(TwitterDbLib, fetched)
 
 
 @register_command
@@ -40,17 +56,158 @@ async def refetch_youtube_channels():
             | YoutubeChannelDb.last_fetched_at.is_(None)
         )
     logger.info("refetching %d channels", len(channels))
+    fetched: list[YoutubeChannel] = []
     for channel in channels:
         try:
-            channel: YoutubeChannel = await fetch_youtube_channel(channel_id=channel.channel_id)
+            fetched.append(await fetch_youtube_channel(channel_id=channel.channel_id))
         except Exception:
             logger.exception("Failed to fetch youtube channel %s", channel)
-        else:
-            async with db.session() as db_session:
-                await YoutubeDbLib(db_session).save_account(channel)
+        if len(fetched) >= SAVE_BATCH_SIZE:
+            await save_accounts(YoutubeDbLib, fetched)
+            fetched = []
+    await save_accounts(YoutubeDbLib, fetched)
 
 
 @register_command
 async def notify(topic: str, object_id: str):
     async with db.session() as db_session:
         await db_session.object_changed(topic, object_id)
+
+
+@register_command
+async def rebuild_donatee_leaderboard():
+    async with db.session() as db_session:
+        await OtherDbLib(db_session).rebuild_donatee_leaderboard()
+
+
+@register_command
+async def rebuild_donator_stats():
+    async with db.session() as db_session:
+        await DonatorStatsDbLib(db_session).rebuild_donator_stats()
+
+
+@register_command
+async def check_donators_connected():
+    """
+    Fixes donators whose connected flag does not match their lnauth_pubkey and OAuth links
+    """
+    async with db.session() as db_session:
+        result = await db_session.execute(
+            update(DonatorDb)
+            .values(connected=connected_expression())
+            .where(DonatorDb.connected != connected_expression())
+            .returning(DonatorDb.id, DonatorDb.connected)
+        )
+        donators = result.all()
+        for donator in donators:
+            logger.warning("Donator %s had wrong connected flag, fixed to %s", donator.id, donator.connected)
+            await db_session.donator_changed(donator.id)
+    return len(donators)
+
+
+@register_command
+async def compact_balance_ledger() -> int:
+    """
+    Folds all balance ledger entries into account rows, returns number of changed accounts
+    """
+    total = 0
+    while True:
+        async with db.session() as db_session:
+            changed: int = await OtherDbLib(db_session).compact_balance_ledger(settings.ledger.compact_batch_size)
+        if not changed:
+            return total
+        total += changed
+
+
+@as_task
+async def run_ledger_compactor(db, ledger_settings: LedgerSettings):
+    while True:
+        try:
+            async with db.session() as db_session:
+                await OtherDbLib(db_session).compact_balance_ledger(ledger_settings.compact_batch_size)
+        except Exception as exc:
+            logger.exception(f"Exception in ledger compactor: {exc}")
+        await asyncio.sleep(ledger_settings.compact_interval.total_seconds())
+
+
+@register_command
+async def stamp_transfers() -> int:
+    """
+    Marks donations of all new transfers as claimed, returns number of stamped transfers
+    """
+    total = 0
+    while True:
+        async with db.session() as db_session:
+            stamped: int = await OtherDbLib(db_session).stamp_transfers(settings.transfer.stamp_batch_size)
+        if not stamped:
+            return total
+        total += stamped
+
+
+@register_command
+async def audit_balances() -> int:
+    async with db.read_only_session() as db_session:
+        return await OtherDbLib(db_session).audit_balances()
+
+
+@as_task
+async def run_transfer_stamper(db, transfer_settings: TransferSettings):
+    """
+    Stamps new transfers and periodically audits account balances (claims do not check them inline)
+    """
+    loop = asyncio.get_running_loop()
+    audited_at: float = loop.time()
+    while True:
+        try:
+            async with db.session() as db_session:
+                await OtherDbLib(db_session).stamp_transfers(transfer_settings.stamp_batch_size)
+            if loop.time() - audited_at >= transfer_settings.audit_interval.total_seconds():
+                audited_at = loop.time()
+                async with db.read_only_session() as db_session:
+                    await OtherDbLib(db_session).audit_balances()
+        except Exception as exc:
+            logger.exception(f"Exception in transfer stamper: {exc}")
+        await asyncio.sleep(transfer_settings.stamp_interval.total_seconds())
+
+
+async def maintain_partitions(db, partition_settings: PartitionSettings) -> tuple[list[str], list[str]]:
+    """
+    Creates next donation partitions and detaches partitions older than retention period
+    """
+    now = datetime.utcnow()
+    async with db.session() as db_session:
+        created: list[str] = await PartitionsDbLib(db_session).create_partitions(now, partition_settings.months_ahead)
+    detached: list[str] = []
+    if partition_settings.retention is not None:
+        detached = await detach_partitions(db, now - partition_settings.retention)
+    for name in created:
+        logger.info("Created donation partition %s", name)
+    for name in detached:
+        logger.info("Detached donation partition %s, it could be archived and dropped", name)
+    return created, detached
+
+
+@register_command
+async def maintain_donation_partitions():
+    await maintain_partitions(db, settings.partitions)
+
+
+@as_task
+async def run_partition_manager(db, partition_settings: PartitionSettings):
+    while True:
+        try:
+            await maintain_partitions(db, partition_settings)
+        except Exception as exc:
+            logger.exception(f"Exception in partition manager: {exc}")
+        await asyncio.sleep(partition_settings.check_interval.total_seconds())
+
+
+@as_task
+async def run_pool_resizer(db, db_settings: DbSettings):
+    while True:
+        await asyncio.sleep(db_settings.pool_resize_interval.total_seconds())
+        for engine in db.engines:
+            try:
+                adapt_pool_size(engine.pool, db_settings)
+            except Exception as exc:
+                logger.exception(f"Exception in pool resizer: {exc}")
@@ -190,6 +190,19 @@ class LndClient:
 lnd = ContextualObject('lnd')
 
 
+async def invoice_paid(db_session, invoice: Invoice) -> Donation:
+    donations_db = DonationsDbLib(db_session)
+    donation: Donation = await donations_db.lock_donation(r_hash=invoice.r_hash)
+    await donations_db.donation_paid(
+        donation_id=donation.id,
+        paid_at=invoice.settle_date,
+        amount=invoice.amt_paid_sat,
+    )
+    donation = await donations_db.query_donation(id=donation.id)
+    await auto_transfer_donations(db_session, donation)
+    return donation
+
+
 @as_task
 async def monitor_invoices(lnd_client, db):
     while True:
@@ -217,16 +230,8 @@ async def monitor_invoices_step(lnd_client, db):
             if invoice.state == 'SETTLED':
                 logger.debug(f"donation paid {data}")
                 try:
-                    async with db.session() as db_session:
-                        donations_db = DonationsDbLib(db_session)
-                        donation: Donation = await donations_db.lock_donation(r_hash=invoice.r_hash)
-                        await donations_db.donation_paid(
-                            donation_id=donation.id,
-                            paid_at=invoice.settle_date,
-                            amount=invoice.amt_paid_sat,
-                        )
-                        track_donation(donation)
-                        await auto_transfer_donations(db_session, donation)
+                    donation: Donation = await db.transact(invoice_paid, invoice)
+                    track_donation(donation)
                 except Exception:
                     logger.exception("Error while handling donation notification from lnd")
     finally:
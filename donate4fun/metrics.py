@@ -0,0 +1,234 @@
+"""
+Prometheus metrics and per-request SQL instrumentation
+"""
+import hashlib
+import logging
+import re
+import time
+from bisect import bisect_left
+from collections import Counter as CounterDict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+from starlette.responses import PlainTextResponse
+
+from .settings import MetricsSettings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# Limits number of label values for statement metrics, the rest is counted as 'other'
+MAX_FINGERPRINTS = 1000
+
+registry: list['Metric'] = []
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        registry.append(self)
+
+    def format_labels(self, labels: tuple, **extra) -> str:
+        pairs = [*zip(self.labelnames, labels), *extra.items()]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}', *self.samples()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{self.format_labels(labels)} {value}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+
+@dataclass
+class HistogramValue:
+    counts: list[int]
+    sum: float = 0
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        self.values: dict[tuple, HistogramValue] = {}
+
+    def observe(self, *labels, value: float):
+        histogram = self.values.get(labels)
+        if histogram is None:
+            histogram = self.values[labels] = HistogramValue(counts=[0] * (len(self.buckets) + 1))
+        histogram.counts[bisect_left(self.buckets, value)] += 1
+        histogram.sum += value
+
+    def samples(self):
+        for labels, histogram in self.values.items():
+            total = 0
+            for bucket, count in zip([*self.buckets, '+Inf'], histogram.counts):
+                total += count
+                yield f'{self.name}_bucket{self.format_labels(labels, le=bucket)} {total}'
+            yield f'{self.name}_count{self.format_labels(labels)} {total}'
+            yield f'{self.name}_sum{self.format_labels(labels)} {histogram.sum}'
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+async def metrics_endpoint(request):
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
+
+
+statement_seconds = Histogram('db_statement_seconds', "SQL statement latency", ('fingerprint',))
+statement_info = Gauge('db_statement_info', "Normalized SQL text of statement fingerprints", ('fingerprint', 'statement'))
+request_queries_count = Histogram(
+    'db_request_queries', "Number of SQL statements per HTTP request", buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200),
+)
+request_queries_seconds = Histogram('db_request_seconds', "Total SQL time per HTTP request")
+repeated_statements = Counter(
+    'db_repeated_statements_total', "HTTP requests that repeated a statement too many times (N+1 queries)", ('fingerprint',),
+)
+query_budget_exceeded = Counter(
+    'db_query_budget_exceeded_total', "Requests and DbLib calls that exceeded their query budget", ('budget', 'reason'),
+)
+transaction_retries = Counter(
+    'db_transaction_retries_total', "Transactions retried after a serialization failure or a deadlock",
+    ('transaction', 'sqlstate'),
+)
+transaction_retries_exhausted = Counter(
+    'db_transaction_retries_exhausted_total', "Transactions failed after all retries", ('transaction', 'sqlstate'),
+)
+pool_checkout_seconds = Histogram('db_pool_checkout_seconds', "Time to get a connection from the pool", ('pool',))
+pool_connections = Gauge('db_pool_connections', "Pool connections by state", ('pool', 'state'))
+
+fingerprints: dict[str, str] = {}
+
+
+def normalize_statement(statement: str) -> str:
+    """
+    Replaces parameters and literals with '?', so statements differing only in values are equal
+    """
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'\$\d+|%\(\w+\)s|\b\d+\b', '?', statement)
+    # IN lists and multi-row VALUES of any length
+    statement = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', statement)
+    statement = re.sub(r'\(\?\)(?:\s*,\s*\(\?\))+', '(?)', statement)
+    return re.sub(r'\s+', ' ', statement).strip()
+
+
+@lru_cache(maxsize=4096)
+def statement_fingerprint(statement: str) -> str:
+    normalized: str = normalize_statement(statement)
+    fingerprint: str = hashlib.sha1(normalized.encode()).hexdigest()[:12]
+    if fingerprint not in fingerprints:
+        if len(fingerprints) >= MAX_FINGERPRINTS:
+            return 'other'
+        fingerprints[fingerprint] = normalized
+        statement_info.set(fingerprint, normalized[:500], value=1)
+    return fingerprint
+
+
+@dataclass
+class RequestQueries:
+    count: int = 0
+    duration: float = 0
+    statements: CounterDict = field(default_factory=CounterDict)
+
+
+request_queries: ContextVar[RequestQueries | None] = ContextVar('request_queries', default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_started_at = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration: float = time.perf_counter() - context.query_started_at
+    fingerprint: str = statement_fingerprint(statement)
+    statement_seconds.observe(fingerprint, value=duration)
+    if (queries := request_queries.get()) is not None:
+        queries.count += 1
+        queries.duration += duration
+        queries.statements[fingerprint] += 1
+
+
+def instrument_engine(engine):
+    """
+    Records latency of each statement executed by *engine* and accumulates per-request statistics
+    """
+    sync_engine = getattr(engine, 'sync_engine', engine)
+    event.listen(sync_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', after_cursor_execute)
+
+
+class QueryStatsMiddleware:
+    """
+    Collects SQL statistics of each HTTP request, warns about repeated statements and adds Server-Timing header
+    """
+    def __init__(self, app, settings: MetricsSettings):
+        self.app = app
+        self.settings = settings
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        queries = RequestQueries()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and self.settings.server_timing:
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing', f'db;dur={queries.duration * 1000:.1f};desc="{queries.count} queries"')
+            await send(message)
+
+        token = request_queries.set(queries)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_queries.reset(token)
+            self.request_finished(scope, queries)
+
+    def request_finished(self, scope, queries: RequestQueries):
+        request_queries_count.observe(value=queries.count)
+        request_queries_seconds.observe(value=queries.duration)
+        for fingerprint, count in queries.statements.items():
+            if count > self.settings.repeated_statement_threshold:
+                repeated_statements.inc(fingerprint)
+                logger.warning(
+                    "%s %s executed the same statement %d times: %s",
+                    scope['method'], scope['path'], count, fingerprints.get(fingerprint, fingerprint),
+                )
@@ -6,23 +6,62 @@ from uuid import uuid4, UUID
 from datetime import datetime
 from typing import Any
 from functools import lru_cache
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 import jwt
 from pydantic import BaseModel as PydanticBaseModel, validator, HttpUrl, Field, root_validator, EmailStr, AnyUrl
 from pydantic.datetime_parse import parse_datetime
+from pydantic.utils import GetterDict
 from funkybob import UniqueRandomNameGenerator
 from multiavatar.multiavatar import multiavatar
 from jwskate import Jwk, Jwt
+from sqlalchemy import inspect
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from .settings import settings
 from .core import to_datauri, from_base64, to_base64
-from .types import Url, RequestHash, PaymentRequest, LightningAddress
+from .types import Url, RequestHash, PaymentRequest, LightningAddress, InvalidDbState
+
+
+# (ORM class, attribute name) pairs which are left default in models if they are not loaded, see `unloaded_defaults`
+allowed_unloaded: ContextVar[frozenset] = ContextVar('allowed_unloaded', default=frozenset())
+
+
+@contextmanager
+def unloaded_defaults(*attributes):
+    """
+    Lets models be built from ORM objects with *attributes* (like DonatorDb.balance) not loaded, they are left default
+    """
+    token = allowed_unloaded.set(allowed_unloaded.get() | {(attribute.class_, attribute.key) for attribute in attributes})
+    try:
+        yield
+    finally:
+        allowed_unloaded.reset(token)
+
+
+class OrmGetterDict(GetterDict):
+    """
+    Raises InvalidDbState for not loaded attributes of ORM objects (e.g. deferred balances) instead of lazy loading them,
+    which is not possible in async sessions
+    """
+    def __init__(self, obj: Any):
+        super().__init__(obj)
+        state = inspect(obj, raiseerr=False)
+        self._unloaded = state.unloaded if state is not None else frozenset()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key in self._unloaded:
+            if (type(self._obj), key) in allowed_unloaded.get():
+                return default
+            raise InvalidDbState(f"{type(self._obj).__name__}.{key} is not loaded")
+        return super().get(key, default)
 
 
 class BaseModel(PydanticBaseModel):
     class Config:
+        getter_dict = OrmGetterDict
         json_encoders = {
             RequestHash: lambda r: r.to_json(),
             int: lambda x: x if abs(x) < 2 ** 31 else str(x),
@@ -337,6 +376,52 @@ class YoutubeNotification(Notification):
     total_donated: int
 
 
+class DonationNotification(Notification):
+    amount: int
+    paid_at: datetime | None
+    cancelled_at: datetime | None
+    claimed_at: datetime | None
+
+
+class SocialAccountNotification(Notification):
+    balance: int
+    total_donated: int
+
+
+class ResumeToken(BaseModel):
+    topics: list[str]
+
+    def to_jwt_payload(self) -> dict:
+        data: dict = self.to_json_dict()
+        data['exp'] = int(time.time()) + 600  # ten minutes
+        return data
+
+    @classmethod
+    def from_jwt(cls, token: str) -> BaseModel:
+        data: dict = jwt.decode(token, settings.jwt_secret, algorithms=["HS256"], options=dict(require=["exp"]))
+        data.pop('exp', None)
+        return cls(**data)
+
+
+class ReconnectHint(BaseModel):
+    status: str = 'RECONNECT'
+    reconnect_after: float  # seconds
+    resume_token: str | None
+
+
+class PushSubscriptionKeys(BaseModel):
+    p256dh: str
+    auth: str
+
+
+class PushSubscription(BaseModel):
+    """
+    Same format as PushSubscription.toJSON() in browser
+    """
+    endpoint: AnyUrl
+    keys: PushSubscriptionKeys
+
+
 class Credentials(BaseModel):
     donator: UUID | None
     lnauth_pubkey: str | None
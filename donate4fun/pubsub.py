@@ -1,11 +1,18 @@
 import asyncio
 import logging
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from functools import partial
 from typing import Callable
 from contextlib import asynccontextmanager
 
+import anyio
+
 from .core import ContextualObject
 from .db import Database
+from .settings import PubSubSettings
 
 logger = logging.getLogger(__name__)
 
@@ -22,20 +29,157 @@ async def callback_wrapper(callback: Callable, conn, pid, channel: str, payload:
         raise
 
 
+@dataclass
+class LastValue:
+    payload: str | None
+    updated_at: float
+
+
+class LastValueCache:
+    """
+    Keeps the last payload seen for each tracked topic.
+    Number of tracked topics is bounded by `size` (least recently used are evicted first),
+    values older than `ttl` are considered missing and are evicted too.
+    """
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.values: OrderedDict[str, LastValue] = OrderedDict()
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self.values
+
+    def track(self, topic: str):
+        if topic in self.values:
+            self.values.move_to_end(topic)
+        else:
+            self.values[topic] = LastValue(payload=None, updated_at=time.monotonic())
+
+    def update(self, topic: str, payload: str):
+        if topic in self.values:
+            self.values[topic] = LastValue(payload=payload, updated_at=time.monotonic())
+            self.values.move_to_end(topic)
+
+    def get(self, topic: str) -> str | None:
+        value: LastValue | None = self.values.get(topic)
+        if value is None or time.monotonic() - value.updated_at > self.ttl:
+            return None
+        return value.payload
+
+    def evict(self) -> list[str]:
+        """
+        Removes expired and excess topics, returns removed topics
+        """
+        now = time.monotonic()
+        evicted = [topic for topic, value in self.values.items() if now - value.updated_at > self.ttl]
+        for topic in evicted:
+            del self.values[topic]
+        while len(self.values) > self.size:
+            topic, _ = self.values.popitem(last=False)
+            evicted.append(topic)
+        return evicted
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens: float = burst
+        self.updated_at: float = time.monotonic()
+
+    def acquire(self) -> float:
+        """
+        Takes a token if available and returns 0, otherwise returns seconds to wait until a token is available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
 class PubSubBroker:
-    def __init__(self):
+    def __init__(self, settings: PubSubSettings | None = None):
+        self.settings = settings = settings or PubSubSettings()
         self.lock = asyncio.Lock()
         self.asyncpg_connection = None
+        self.last_values = LastValueCache(size=settings.cache_size, ttl=settings.cache_ttl.total_seconds())
+        self.started_at: float | None = None
+        self.admission = TokenBucket(rate=settings.warmup_subscribe_rate, burst=settings.warmup_subscribe_burst)
+        self.shutting_down = asyncio.Event()
+        self.connections = 0
+        self.connections_closed = asyncio.Event()
 
     def __str__(self):
         return f'{type(self).__name__}<{hex(id(self))}>'
 
+    def admit(self) -> float:
+        """
+        Admission control for new subscriptions during warm-up.
+        Returns 0 if subscription is admitted or seconds to wait before reconnect otherwise.
+        """
+        if self.started_at is None or time.monotonic() - self.started_at > self.settings.warmup_period.total_seconds():
+            return 0
+        if retry_after := self.admission.acquire():
+            return retry_after + random.uniform(0, retry_after)
+        return 0
+
+    def reconnect_delay(self) -> float:
+        """
+        Randomized delay to spread reconnects of all clients over time
+        """
+        return random.uniform(0, self.settings.reconnect_delay_max.total_seconds())
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Tracks a client connection, yields an event that is set when clients should reconnect
+        """
+        self.connections += 1
+        self.connections_closed.clear()
+        try:
+            yield self.shutting_down
+        finally:
+            self.connections -= 1
+            if self.connections == 0:
+                self.connections_closed.set()
+
+    async def shutdown(self):
+        """
+        Asks all connected clients to reconnect and waits for them to disconnect
+        """
+        logger.info("Asking %d clients to reconnect", self.connections)
+        self.shutting_down.set()
+        if self.connections:
+            with anyio.move_on_after(self.settings.shutdown_timeout.total_seconds()):
+                await self.connections_closed.wait()
+
+    def remember_last_value(self, conn, pid, channel: str, payload: str):
+        self.last_values.update(channel, payload)
+
     @asynccontextmanager
     async def subscribe(self, channel: str, callback: Callable):
-        wrapped_callback = partial(callback_wrapper, callback)
+        notified = False
+
+        async def notified_callback(payload: str):
+            nonlocal notified
+            notified = True
+            return await callback_wrapper(callback, None, None, channel, payload)
+
+        wrapped_callback = partial(callback_wrapper, notified_callback)
         async with self.lock, self.asyncpg_connection.transaction():
+            if channel not in self.last_values:
+                await self.asyncpg_connection.add_listener(channel, self.remember_last_value)
+            self.last_values.track(channel)
             await self.asyncpg_connection.add_listener(channel, wrapped_callback)
+            for evicted_channel in self.last_values.evict():
+                await self.asyncpg_connection.remove_listener(evicted_channel, self.remember_last_value)
         logger.debug(f"Subscribed to '{channel}'")
+        # Send the last known state unless a fresh notification is already delivered
+        if not notified and (payload := self.last_values.get(channel)) is not None:
+            await notified_callback(payload)
         try:
             yield
         except Exception:
@@ -50,10 +194,9 @@ class PubSubBroker:
 
     @asynccontextmanager
     async def run(self, db: Database):
-        async with db.raw_session() as session:
-            connection = await session.connection(execution_options=dict(logging_token=str(self)))
-            raw_connection = await connection.get_raw_connection()
-            self.asyncpg_connection = raw_connection.connection._connection
+        async with db.listen_connection(logging_token=str(self)) as connection:
+            self.asyncpg_connection = connection
+            self.started_at = time.monotonic()
             yield
 
 
@@ -56,6 +56,85 @@ class DbSettings(BaseModel):
     connect_args: dict[str, Any] = {}
     pool_size: int = 10
     max_overflow: int = 20
+    # Open pool_size connections at serve startup, so first requests do not pay for connection setup
+    pool_prewarm: bool = True
+    # Resize pool between pool_size_min and pool_size_max to keep average checkout wait below pool_wait_target
+    adaptive_pool: bool = False
+    pool_size_min: int = 5
+    pool_size_max: int = 30
+    pool_wait_target: timedelta = timedelta(milliseconds=5)
+    pool_resize_interval: timedelta = timedelta(seconds=30)
+    # Set if url points to PgBouncer in transaction pooling mode: prepared statements are not cached and have unique names
+    pgbouncer: bool = False
+    # LISTEN needs a session-long connection, so pubsub connects here (directly to Postgres) if it's set
+    listen_url: str | None = None
+    # Transactions run by Database.transact are retried on serialization failures and deadlocks
+    transaction_retries: int = 3
+    transaction_retry_delay: timedelta = timedelta(milliseconds=20)  # Doubled on each retry, actual delay is random up to it
+    # Read-only sessions are routed to these servers if they are not lagging behind
+    replica_urls: list[str] = []
+    max_replica_lag: timedelta = timedelta(seconds=5)
+    replica_lag_check_interval: timedelta = timedelta(seconds=5)
+    # Lag check is done inline with a request, so a replica not answering in time is considered lagging
+    replica_lag_check_timeout: timedelta = timedelta(milliseconds=200)
+    # Browser sessions read from the primary for this period after a read-write request
+    read_your_writes_period: timedelta = timedelta(seconds=30)
+
+
+class PubSubSettings(BaseModel):
+    cache_size: int = 10000  # Max number of topics to keep last values for
+    cache_ttl: timedelta = timedelta(hours=1)
+    # Clients are asked to reconnect after a random delay up to this value on shutdown
+    reconnect_delay_max: timedelta = timedelta(seconds=30)
+    shutdown_timeout: timedelta = timedelta(seconds=5)
+    # New subscriptions are rate limited during warm-up after start
+    warmup_period: timedelta = timedelta(seconds=60)
+    warmup_subscribe_rate: float = 50  # subscriptions per second
+    warmup_subscribe_burst: int = 100
+
+
+class PushSettings(BaseModel):
+    vapid_private_key: str | None  # PEM-encoded P-256 key, push delivery is disabled if not set
+    vapid_subject: str = 'mailto:support@donate4.fun'
+    ttl: timedelta = timedelta(hours=1)  # How long push service should keep undelivered message
+    batch_size: int = 100
+    max_attempts: int = 8
+    retry_delay: timedelta = timedelta(seconds=5)  # Doubled after each failed attempt
+    poll_interval: timedelta = timedelta(seconds=2)
+    send_timeout: timedelta = timedelta(seconds=10)
+    # Endpoints must be https URLs of these push services, names starting with a dot match any subdomain
+    allowed_hosts: list[str] = [
+        'fcm.googleapis.com', 'updates.push.services.mozilla.com', '.push.apple.com', '.notify.windows.com',
+    ]
+    allow_http: bool = False  # Allows http endpoints for a local push service in tests
+
+
+class LedgerSettings(BaseModel):
+    compact_interval: timedelta = timedelta(seconds=10)  # How often balance ledger entries are folded into accounts
+    compact_batch_size: int = 10000
+
+
+class TransferSettings(BaseModel):
+    stamp_interval: timedelta = timedelta(seconds=10)  # How often donations of new transfers are marked as claimed
+    stamp_batch_size: int = 1000
+    audit_interval: timedelta = timedelta(hours=1)  # How often account balances are checked against unclaimed donations
+
+
+class PartitionSettings(BaseModel):
+    months_ahead: int = 2  # Donation partitions are created for this number of next months
+    retention: timedelta | None = None  # Older donation partitions are detached, they are kept if None
+    check_interval: timedelta = timedelta(hours=1)
+
+
+class MetricsSettings(BaseModel):
+    enabled: bool = False  # Serve Prometheus metrics at /metrics, enable only if it is not reachable from the internet
+    server_timing: bool = False  # Add Server-Timing header with DB time to responses
+    repeated_statement_threshold: int = 10  # Warn if a request executes the same statement more times (N+1 queries)
+
+
+class QueryBudget(BaseModel):
+    statement_timeout: timedelta | None = None  # Applied with SET LOCAL statement_timeout
+    max_queries: int | None = None  # Number of statements allowed in a request or a DbLib method call
 
 
 class FormatterConfig(BaseModel):
@@ -153,6 +232,13 @@ class Settings(BaseSettings):
     twitter: TwitterSettings
     github: GithubSettings
     db: DbSettings
+    pubsub: PubSubSettings = PubSubSettings()
+    push: PushSettings = PushSettings()
+    metrics: MetricsSettings = MetricsSettings()
+    query_budget: QueryBudget = QueryBudget()  # Default budget of HTTP requests without their own
+    ledger: LedgerSettings = LedgerSettings()
+    transfer: TransferSettings = TransferSettings()
+    partitions: PartitionSettings = PartitionSettings()
     log: LoggingConfig
     jwt: JwtSettings
     fastapi: FastApiSettings
@@ -91,7 +91,7 @@ async def query_or_fetch_twitter_account(db: TwitterDbLib, **params) -> TwitterA
 
 @register_command
 async def fetch_and_save_twitter_account(handle: str):
-    async with db.session() as db_session:
+    async with db.async_commit_session() as db_session:
         account: TwitterAccount = await fetch_twitter_author(handle=handle)
         await db_session.save_twitter_account(account)
 
@@ -142,7 +142,7 @@ async def api_get_pages(client, api_path: str, limit: int, params: dict[str, Any
 
 async def save_token(db: Database, token: dict[str, Any], refresh_token: str):
     logger.debug(f"new token: {token} ({refresh_token})")
-    async with db.session() as db_session:
+    async with db.async_commit_session() as db_session:
         await db_session.save_oauth_token('twitter_oauth2', token)
 
 
@@ -205,7 +205,7 @@ async def obtain_twitter_oauth2_token():
             code_verifier=code_verifier,
         )
         db = Database(settings.db)
-        async with db.session() as db_session:
+        async with db.async_commit_session() as db_session:
             await db_session.save_oauth_token('twitter_oauth2', token)
 
 
@@ -217,7 +217,7 @@ async def obtain_twitter_oauth1_token():
         pin: str = input(f"Open this url {auth_url} and paste here PIN:\n")
         token: dict[str, Any] = await client.fetch_access_token('https://api.twitter.com/oauth/access_token', verifier=pin)
         db = Database(settings.db)
-        async with db.session() as db_session:
+        async with db.async_commit_session() as db_session:
             await db_session.save_oauth_token('twitter_oauth1', token)
 
 
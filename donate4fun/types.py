@@ -123,3 +123,7 @@ class LnurlpError(Exception):
 
 class AccountAlreadyLinked(Exception):
     pass
+
+
+class QueryBudgetExceeded(Exception):
+    pass
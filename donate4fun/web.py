@@ -11,7 +11,7 @@ from fastapi.exceptions import RequestValidationError
 from sqlalchemy.orm.exc import NoResultFound
 from jwcrypto.jwk import JWK
 
-from .api_utils import get_db_session, make_absolute_uri
+from .api_utils import get_db_session, get_async_commit_db_session, make_absolute_uri
 from .models import YoutubeChannel, TwitterAccount, Donation, Donator, GithubUser
 from .youtube import query_or_fetch_youtube_channel
 from .twitter import query_or_fetch_twitter_account
@@ -113,19 +113,19 @@ async def sitemap(request: Request, db_session=Depends(get_db_session)):
 
 
 @app.get('/d/{channel_id}')
-async def donate_redirect(request: Request, channel_id: str, db=Depends(get_db_session)):
+async def donate_redirect(request: Request, channel_id: str, db=Depends(get_async_commit_db_session)):
     youtube_channel: YoutubeChannel = await query_or_fetch_youtube_channel(channel_id=channel_id, db=YoutubeDbLib(db))
     return RedirectResponse(f'{settings.base_url}/youtube/{youtube_channel.id}', status_code=302)
 
 
 @app.get('/tw/{handle}')
-async def twitter_account_redirect(request: Request, handle: str, db=Depends(get_db_session)):
+async def twitter_account_redirect(request: Request, handle: str, db=Depends(get_async_commit_db_session)):
     account: TwitterAccount = await query_or_fetch_twitter_account(handle=handle, db=TwitterDbLib(db))
     return RedirectResponse(f'{settings.base_url}/twitter/{account.id}', status_code=302)
 
 
 @app.get('/gh/{login}')
-async def github_user_redirect(request: Request, login: str, db=Depends(get_db_session)):
+async def github_user_redirect(request: Request, login: str, db=Depends(get_async_commit_db_session)):
     user: GithubUser = await query_or_fetch_github_user(login=login, db=GithubDbLib(db))
     return RedirectResponse(f'{settings.base_url}/github/{user.id}', status_code=302)
 
@@ -0,0 +1,198 @@
+"""
+Web Push delivery: message encryption (RFC 8291), VAPID (RFC 8292) and a dispatcher
+that sends messages enqueued by DbSession.flush_notifications
+"""
+import asyncio
+import os
+import time
+import logging
+from datetime import timedelta
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import anyio
+import httpx
+import jwt
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from .core import as_task, register_command, to_base64url, from_base64url
+from .db_push import PushDbLib
+from .settings import PushSettings
+
+logger = logging.getLogger(__name__)
+
+RECORD_SIZE = 4096
+
+
+def hkdf(salt: bytes, ikm: bytes, info: bytes, length: int) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(ikm)
+
+
+def public_key_bytes(key: ec.EllipticCurvePublicKey) -> bytes:
+    return key.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+
+
+def encrypt_payload(payload: bytes, p256dh: str, auth: str) -> bytes:
+    """
+    Encrypts payload using aes128gcm content encoding as a single record
+    """
+    ua_public: bytes = from_base64url(p256dh)
+    auth_secret: bytes = from_base64url(auth)
+    ua_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), ua_public)
+    as_private_key = ec.generate_private_key(ec.SECP256R1())
+    as_public: bytes = public_key_bytes(as_private_key.public_key())
+    shared_secret: bytes = as_private_key.exchange(ec.ECDH(), ua_key)
+    ikm: bytes = hkdf(auth_secret, shared_secret, b'WebPush: info\x00' + ua_public + as_public, 32)
+    salt: bytes = os.urandom(16)
+    cek: bytes = hkdf(salt, ikm, b'Content-Encoding: aes128gcm\x00', 16)
+    nonce: bytes = hkdf(salt, ikm, b'Content-Encoding: nonce\x00', 12)
+    # 0x02 is a padding delimiter of the last record
+    ciphertext: bytes = AESGCM(cek).encrypt(nonce, payload + b'\x02', None)
+    header: bytes = salt + RECORD_SIZE.to_bytes(4, 'big') + len(as_public).to_bytes(1, 'big') + as_public
+    return header + ciphertext
+
+
+@lru_cache
+def load_vapid_key(pem: str) -> ec.EllipticCurvePrivateKey:
+    return serialization.load_pem_private_key(pem.encode(), password=None)
+
+
+def application_server_key(push_settings: PushSettings) -> str:
+    """
+    VAPID public key that browser needs to create a subscription
+    """
+    return to_base64url(public_key_bytes(load_vapid_key(push_settings.vapid_private_key).public_key()))
+
+
+class PushError(Exception):
+    pass
+
+
+class SubscriptionExpired(PushError):
+    pass
+
+
+class InvalidEndpoint(PushError):
+    pass
+
+
+def check_endpoint(endpoint: str, push_settings: PushSettings):
+    """
+    Endpoints come from browsers, so only https URLs of known push services are allowed,
+    otherwise a subscription could make the server send requests to internal hosts
+    """
+    url = urlparse(endpoint)
+    if url.scheme != 'https' and not (push_settings.allow_http and url.scheme == 'http'):
+        raise InvalidEndpoint(f"Push endpoint {endpoint} is not an https URL")
+    host: str = (url.hostname or '').lower()
+    if not any(
+        host == allowed or (allowed.startswith('.') and host.endswith(allowed)) for allowed in push_settings.allowed_hosts
+    ):
+        raise InvalidEndpoint(f"Push endpoint {endpoint} does not belong to a known push service")
+
+
+class WebPushSender:
+    def __init__(self, push_settings: PushSettings, client: httpx.AsyncClient):
+        self.settings = push_settings
+        self.client = client
+
+    def vapid_authorization(self, endpoint: str) -> str:
+        url = urlparse(endpoint)
+        token: str = jwt.encode(
+            dict(aud=f'{url.scheme}://{url.netloc}', exp=int(time.time()) + 12 * 3600, sub=self.settings.vapid_subject),
+            load_vapid_key(self.settings.vapid_private_key),
+            algorithm='ES256',
+        )
+        return f'vapid t={token}, k={application_server_key(self.settings)}'
+
+    async def send(self, endpoint: str, p256dh: str, auth: str, payload: str):
+        # Subscriptions saved before allowed_hosts were changed could have endpoints that are not allowed anymore
+        check_endpoint(endpoint, self.settings)
+        response = await self.client.post(
+            endpoint,
+            content=encrypt_payload(payload.encode(), p256dh=p256dh, auth=auth),
+            headers={
+                'Authorization': self.vapid_authorization(endpoint),
+                'Content-Encoding': 'aes128gcm',
+                'Content-Type': 'application/octet-stream',
+                'TTL': str(int(self.settings.ttl.total_seconds())),
+            },
+            timeout=self.settings.send_timeout.total_seconds(),
+        )
+        if response.status_code in (404, 410):
+            raise SubscriptionExpired(f"{endpoint} responded with {response.status_code}")
+        if not response.is_success:
+            raise PushError(f"{endpoint} responded with {response.status_code}: {response.text}")
+
+
+async def dispatch_push_deliveries(db, sender: WebPushSender) -> int:
+    """
+    Sends one batch of due deliveries, returns number of deliveries processed
+    """
+    push_settings: PushSettings = sender.settings
+    async with db.session() as db_session:
+        deliveries = await PushDbLib(db_session).claim_deliveries(
+            limit=push_settings.batch_size,
+            lease=push_settings.send_timeout * 2,
+        )
+    results: dict = {}
+
+    async def send(delivery):
+        try:
+            await sender.send(delivery.endpoint, p256dh=delivery.p256dh, auth=delivery.auth, payload=delivery.payload)
+        except Exception as exc:
+            results[delivery.id] = exc
+        else:
+            results[delivery.id] = None
+
+    async with anyio.create_task_group() as tg:
+        for delivery in deliveries:
+            tg.start_soon(send, delivery)
+
+    async with db.session() as db_session:
+        push_db = PushDbLib(db_session)
+        for delivery in deliveries:
+            match results[delivery.id]:
+                case None:
+                    await push_db.finish_delivery(delivery.id, delivery.payload)
+                case SubscriptionExpired():
+                    logger.debug("Push subscription %s is expired", delivery.subscription_id)
+                    await push_db.subscription_expired(delivery.subscription_id)
+                case InvalidEndpoint() as exc:
+                    logger.warning("Push subscription %s is removed: %s", delivery.subscription_id, exc)
+                    await push_db.subscription_expired(delivery.subscription_id)
+                case exc:
+                    logger.warning("Failed to send push %s (attempt %d): %s", delivery.id, delivery.attempts, exc)
+                    retry_after: timedelta | None = None
+                    if delivery.attempts < push_settings.max_attempts:
+                        retry_after = push_settings.retry_delay * 2 ** (delivery.attempts - 1)
+                    await push_db.delivery_failed(delivery.id, delivery.payload, retry_after)
+    return len(deliveries)
+
+
+@as_task
+async def run_push_dispatcher(db, push_settings: PushSettings):
+    async with httpx.AsyncClient() as client:
+        sender = WebPushSender(push_settings, client)
+        while True:
+            try:
+                processed: int = await dispatch_push_deliveries(db, sender)
+            except Exception as exc:
+                logger.exception(f"Exception in push dispatcher: {exc}")
+                processed = 0
+            if processed < push_settings.batch_size:
+                await asyncio.sleep(push_settings.poll_interval.total_seconds())
+
+
+@register_command
+async def generate_vapid_key():
+    """
+    Prints a new key for push.vapid_private_key setting
+    """
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    print(private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+    ).decode())
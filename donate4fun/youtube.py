@@ -183,7 +183,7 @@ async def query_or_fetch_youtube_channel(db: YoutubeDbLib, **params) -> YoutubeC
 @register_command
 async def fetch_and_save_youtube_channel(channel_id: str):
     channel: YoutubeChannel = await fetch_youtube_channel(channel_id)
-    async with Database(settings.db).session() as db:
+    async with Database(settings.db).async_commit_session() as db:
         await db.save_youtube_channel(channel)
 
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Measures per-call Python overhead of building hot generic statements:
+statement construction + cache key generation + compiled cache lookup (as Engine.execute does).
+Compares statements built on every call with the cached ones from db_utils/db_social.
+"""
+import sys
+import timeit
+import uuid
+
+from sqlalchemy import select, func, or_
+from sqlalchemy.dialects.postgresql import insert, asyncpg
+from sqlalchemy.inspection import inspect
+
+from donate4fun.db_models import YoutubeChannelDb, YoutubeChannelLink, DonatorDb
+from donate4fun.db_utils import upsert_statement, upsert_params, writable_columns, default_persisten_fields
+from donate4fun.db_youtube import YoutubeDbLib
+from donate4fun.models import YoutubeChannel, Donator
+
+dialect = asyncpg.dialect()
+compiled_cache: dict = {}
+
+
+def prepare(statement, params=None):
+    cache_key = statement._generate_cache_key()
+    # PostgreSQL INSERT .. ON CONFLICT is not cacheable in SQLAlchemy 1.4 (cache key is None), it is compiled every time
+    compiled = compiled_cache.get(cache_key) if cache_key is not None else None
+    if compiled is None:
+        compiled = statement.compile(dialect=dialect, column_keys=list(params or {}))
+        if cache_key is not None:
+            compiled_cache[cache_key] = compiled
+    return compiled.construct_params(params, extracted_parameters=cache_key and cache_key[1])
+
+
+def inline_upsert(table, obj, *index_fields):
+    columns = writable_columns(table)
+    persistent_fields = {
+        field.name for field in columns
+        if field.name in default_persisten_fields or field in index_fields
+    }
+    values = [(field, getattr(obj, field.name)) for field in columns if field.name not in persistent_fields]
+    return (
+        insert(table)
+        .values({field.name: getattr(obj, field.name) for field in columns})
+        .on_conflict_do_update(
+            index_elements=index_fields or inspect(table).primary_key,
+            set_={field: value for field, value in values},
+            where=or_(*[(field.is_(None) != (value is None)) | (field != value) for field, value in values]),
+        )
+        .returning(table.id)
+    )
+
+
+def inline_query_account(owner_id, **filter_by):
+    owner_links = select(YoutubeChannelLink).where(YoutubeChannelLink.donator_id == owner_id).subquery()
+    account_table = YoutubeChannelDb.__table__
+    return (
+        select(
+            *account_table.c,
+            owner_links.c.donator_id.label('owner_id'),
+            func.coalesce(owner_links.c.via_oauth, False).label('via_oauth'),
+        )
+        .filter_by(**filter_by)
+        .outerjoin(owner_links, onclause=account_table.c.id == owner_links.c.youtube_channel_id)
+    )
+
+
+def main(number: int = 10000):
+    channel = YoutubeChannel(id=uuid.uuid4(), channel_id='UCk2OzObixhe_mbMfMQGLuJw', title='Title')
+    owner_id = uuid.uuid4()
+    donator = Donator(id=owner_id)
+    benchmarks = dict(
+        upsert=(
+            lambda: prepare(inline_upsert(YoutubeChannelDb, channel, YoutubeChannelDb.channel_id)),
+            lambda: prepare(
+                upsert_statement(YoutubeChannelDb, YoutubeChannelDb.channel_id), upsert_params(YoutubeChannelDb, channel),
+            ),
+        ),
+        upsert_donator=(
+            lambda: prepare(inline_upsert(DonatorDb, donator)),
+            lambda: prepare(upsert_statement(DonatorDb), upsert_params(DonatorDb, donator)),
+        ),
+        query_account=(
+            lambda: prepare(inline_query_account(owner_id, channel_id=channel.channel_id)),
+            lambda: prepare(
+                YoutubeDbLib.query_account_statement(('channel_id',), True),
+                dict(owner_id=owner_id, channel_id=channel.channel_id),
+            ),
+        ),
+    )
+    for name, (before, after) in benchmarks.items():
+        before_us = timeit.timeit(before, number=number) / number * 1e6
+        after_us = timeit.timeit(after, number=number) / number * 1e6
+        print(f"{name:>16}: {before_us:8.1f} us -> {after_us:8.1f} us per call")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -149,8 +149,8 @@ async def db(settings: Settings):
 
 
 @asynccontextmanager
-async def create_db(db_name: str):
-    test_db_url = os.getenv('DONATE4FUN_TEST_DB_URL', 'postgresql+asyncpg://tester@localhost/postgres')
+async def create_db(db_name: str, test_db_url: str | None = None):
+    test_db_url = test_db_url or os.getenv('DONATE4FUN_TEST_DB_URL', 'postgresql+asyncpg://tester@localhost/postgres')
     base_db = Database(DbSettings(url=test_db_url, isolation_level='AUTOCOMMIT'))
     await base_db.create_database(db_name)
     db = Database(DbSettings(url=str(furl(test_db_url).set(path=db_name))))
@@ -13,7 +13,8 @@ from sqlalchemy import update
 
 from donate4fun.lnd import monitor_invoices_step, LndClient, Invoice, lnd
 from donate4fun.models import (
-    Donation, Donator, SubscribeEmailRequest, YoutubeChannel, TwitterAccount, DonateRequest, DonateResponse
+    Donation, Donator, SubscribeEmailRequest, YoutubeChannel, TwitterAccount, DonateRequest, DonateResponse,
+    ReconnectHint, ResumeToken,
 )
 from donate4fun.api import WithdrawResponse, LnurlWithdrawResponse
 from donate4fun.db import Notification
@@ -21,6 +22,7 @@ from donate4fun.db_models import DonatorDb
 from donate4fun.db_youtube import YoutubeDbLib
 from donate4fun.db_twitter import TwitterDbLib
 from donate4fun.db_donations import DonationsDbLib
+from donate4fun.db_other import OtherDbLib
 from donate4fun.types import PaymentRequest
 
 from tests.test_util import verify_fixture, verify_response, check_response, freeze_time, check_notification, login_to
@@ -124,6 +126,16 @@ async def test_websocket(client, unpaid_donation_fixture, db, freeze_request_has
     verify_fixture(messages, "websocket-messages")
 
 
+async def test_websocket_reconnect_on_shutdown(client, pubsub, unpaid_donation_fixture):
+    topic = f'donation:{unpaid_donation_fixture.id}'
+    async with client.ws_session(f'/api/v1/subscribe/{topic}') as ws:
+        await pubsub.shutdown()
+        hint = ReconnectHint(**await ws.receive_json())
+    assert hint.status == 'RECONNECT'
+    assert 0 <= hint.reconnect_after <= pubsub.settings.reconnect_delay_max.total_seconds()
+    assert ResumeToken.from_jwt(hint.resume_token).topics == [topic]
+
+
 async def test_state(client):
     response = await client.get("/api/v1/status")
     verify_response(response, "status", 200)
@@ -232,7 +244,7 @@ async def test_withdraw(
         async with db.session() as db_session:
             await db_session.execute(
                 update(DonatorDb)
-                .values(balance=DonatorDb.balance + balance_diff)
+                .values(balance=DonatorDb.balance_snapshot + balance_diff)
                 .where(DonatorDb.id == donator.id)
             )
     async with anyio.create_task_group() as tg:
@@ -303,6 +315,8 @@ async def test_recent_donatees(client, db, paid_donation_fixture, rich_donator,
         await donate(donations_db, rich_donator, 10, UUID(int=5), now, twitter_account=twitter_account)
         await donate(donations_db, rich_donator, 20, UUID(int=6), now, twitter_account=twitter_account)
         await donate(donations_db, rich_donator, 15, UUID(int=7), earlier, twitter_account=twitter_account)
+        # Leaderboard is updated when balance ledger is compacted
+        await OtherDbLib(db_session).compact_balance_ledger(limit=100)
 
     response = await client.get("/api/v1/donatee/recently-donated")
     verify_response(response, 'recently-donated-donatees', 200)
@@ -1,17 +1,38 @@
 import asyncio
 import json
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
 from uuid import UUID
 
 import pytest
-from donate4fun.models import Donation, Donator, YoutubeChannel
-from donate4fun.types import RequestHash
-from donate4fun.db_models import DonationDb
-from donate4fun.db import Notification
+import sqlalchemy
+from sqlalchemy import select, update, true, func, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from donate4fun.models import (
+    Donation, Donator, YoutubeChannel, YoutubeVideo, SocialAccountNotification, DonatorStats, unloaded_defaults,
+)
+from donate4fun.types import RequestHash, NotEnoughBalance, QueryBudgetExceeded, InvalidDbState, ValidationError
+from donate4fun.core import to_base64url
+from donate4fun.db_models import (
+    DonationDb, DonateeLeaderboardDb, DonatorDb, YoutubeChannelDb, BalanceLedgerDb, TransferDb, DonatorStatsDb,
+)
+from donate4fun.db import Notification, Database, NoResultFound, engine_options
+from donate4fun.settings import DbSettings, QueryBudget
 from donate4fun.db_youtube import YoutubeDbLib
-from donate4fun.db_donations import DonationsDbLib
+from donate4fun.db_donations import (
+    DonationsDbLib, DonationProjection, UnableToCancelDonation, encode_donations_cursor, decode_donations_cursor,
+)
+from donate4fun.db_other import OtherDbLib
+from donate4fun.db_ledger import LedgerDbLib
+from donate4fun.db_partitions import PartitionsDbLib, detach_partitions
+from donate4fun.db_stats import DonatorStatsDbLib
+from donate4fun.pubsub import LastValueCache, TokenBucket
+from donate4fun.jobs import check_donators_connected
+from donate4fun.db_pool import adapt_pool_size
+from donate4fun.metrics import transaction_retries
 
 from tests.test_util import verify_fixture, freeze_time
+from tests.fixtures import create_db
 
 
 pytestmark = pytest.mark.anyio
@@ -35,6 +56,18 @@ async def test_query_donations(db_session, paid_donation_fixture, freeze_request
     verify_fixture([donation.dict() for donation in donations], 'query-donations')
 
 
+async def test_donation_projections(db_session, unpaid_donation_fixture):
+    donations_db = DonationsDbLib(db_session)
+    donation: Donation = await donations_db.query_donation(id=unpaid_donation_fixture.id, projection=DonationProjection.ids)
+    assert (donation.donator.id, donation.youtube_channel) == (unpaid_donation_fixture.donator.id, None)
+    donation = await donations_db.query_donation(id=unpaid_donation_fixture.id, projection=DonationProjection.summary)
+    assert (donation.donator.id, donation.youtube_channel) == (unpaid_donation_fixture.donator.id, None)
+    donation = await donations_db.query_donation(id=unpaid_donation_fixture.id)
+    assert donation.youtube_channel == unpaid_donation_fixture.youtube_channel
+    donation = await donations_db.lock_donation(r_hash=unpaid_donation_fixture.r_hash)
+    assert donation.youtube_channel is None
+
+
 @freeze_time
 async def test_create_donation(db_session):
     youtube_channel = YoutubeChannel(channel_id='q2dsaf', title='asdzxc', thumbnail_url='http://example.com/thumbnail')
@@ -52,6 +85,59 @@ async def test_create_donation(db_session):
     assert donation.r_hash == donation2.r_hash
 
 
+async def test_donation_payment_hash_unique(db):
+    youtube_channel = YoutubeChannel(channel_id='q2dsaf', title='asdzxc', thumbnail_url='http://example.com/thumbnail')
+    async with db.session() as db_session:
+        await YoutubeDbLib(db_session).save_account(youtube_channel)
+        donations_db = DonationsDbLib(db_session)
+        donation = await donations_db.create_donation(Donation(
+            donator=Donator(), amount=100, youtube_channel=youtube_channel, r_hash=RequestHash(b'123qwe'),
+        ))
+        # The same hash as a transient one is allowed
+        await donations_db.create_donation(Donation(
+            donator=Donator(), amount=100, youtube_channel=youtube_channel, transient_r_hash=RequestHash(b'123qwe'),
+        ))
+        await donations_db.update_donation(donation.id, RequestHash(b'456rty'))
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        async with db.session() as db_session:
+            await DonationsDbLib(db_session).create_donation(Donation(
+                donator=Donator(), amount=100, youtube_channel=youtube_channel, r_hash=RequestHash(b'456rty'),
+            ))
+
+
+async def test_save_accounts(db_session):
+    youtube_db = YoutubeDbLib(db_session)
+    existing = YoutubeChannel(channel_id='existing', title='existing')
+    await youtube_db.save_account(existing)
+    changed = YoutubeChannel(channel_id='changed', title='old title')
+    await youtube_db.save_account(changed)
+    channels = [
+        YoutubeChannel(channel_id='new', title='new'),
+        YoutubeChannel(channel_id='existing', title='existing'),
+        YoutubeChannel(channel_id='changed', title='new title'),
+    ]
+    ids = await youtube_db.save_accounts(channels)
+    assert ids[1:] == [existing.id, changed.id]
+    assert [channel.id for channel in channels] == ids
+    assert (await youtube_db.query_account(id=changed.id)).title == 'new title'
+    assert (await youtube_db.query_account(id=ids[0])).channel_id == 'new'
+    assert await youtube_db.save_accounts([]) == []
+
+
+async def test_upsert_returns_id(db_session):
+    youtube_db = YoutubeDbLib(db_session)
+    channel = YoutubeChannel(channel_id='upserted', title='upserted')
+    await youtube_db.save_account(channel)
+    unchanged = YoutubeChannel(channel_id='upserted', title='upserted')
+    await youtube_db.save_account(unchanged)
+    assert unchanged.id == channel.id
+    video = YoutubeVideo(youtube_channel=channel, video_id='upserted', title='upserted')
+    await youtube_db.save_youtube_video(video)
+    same_video = YoutubeVideo(youtube_channel=channel, video_id='upserted', title='upserted')
+    await youtube_db.save_youtube_video(same_video)
+    assert same_video.id == video.id
+
+
 async def test_donation_paid(db_session, unpaid_donation_fixture):
     donations_db = DonationsDbLib(db_session)
     await donations_db.donation_paid(donation_id=unpaid_donation_fixture.id, paid_at=datetime.utcnow(), amount=100)
@@ -59,6 +145,84 @@ async def test_donation_paid(db_session, unpaid_donation_fixture):
     assert donation.paid_at != None  # noqa
 
 
+async def test_query_donations_cursor(db_session, unpaid_donation_fixture):
+    donations_db = DonationsDbLib(db_session)
+    for amount in range(4):
+        await donations_db.create_donation(Donation(
+            donator=unpaid_donation_fixture.donator, amount=amount, youtube_channel=unpaid_donation_fixture.youtube_channel,
+        ))
+    all_donations: list[Donation] = await donations_db.query_donations(true(), limit=10)
+    assert len(all_donations) == 5
+    paginated: list[Donation] = []
+    cursor = None
+    while page := await donations_db.query_donations(true(), limit=2, cursor=cursor):
+        paginated.extend(page)
+        cursor = encode_donations_cursor(page[-1])
+    assert paginated == all_donations
+    assert await donations_db.query_donations(true(), limit=2, offset=2) == all_donations[2:4]
+
+
+@pytest.mark.parametrize('payload', ['null', '[1, 2]', '["2022-02-02", null]', '{}', 'qwe'])
+def test_invalid_donations_cursor(payload):
+    with pytest.raises(ValidationError):
+        decode_donations_cursor(to_base64url(payload.encode()))
+
+
+async def test_donation_partitions(db, unpaid_donation_fixture):
+    donator: Donator = unpaid_donation_fixture.donator
+    youtube_channel: YoutubeChannel = unpaid_donation_fixture.youtube_channel
+    receiver = Donator(id=UUID(int=5))
+    async with db.session() as db_session:
+        partitions_db = PartitionsDbLib(db_session)
+        assert await partitions_db.create_partitions(datetime(2030, 12, 15), months_ahead=1) == [
+            'donation_y2030m12', 'donation_y2031m01',
+        ]
+        assert await partitions_db.create_partitions(datetime(2030, 12, 15), months_ahead=1) == []
+        # Current month is covered by donation_legacy
+        assert await partitions_db.create_partitions(datetime.utcnow(), months_ahead=0) == []
+        await db_session.save_donator(receiver)
+        await YoutubeDbLib(db_session).link_account(youtube_channel, receiver, via_oauth=False)
+        donations_db = DonationsDbLib(db_session)
+        donation: Donation = await donations_db.create_donation(Donation(
+            donator=donator, amount=10, youtube_channel=youtube_channel,
+        ))
+        await db_session.execute(
+            update(DonationDb).values(created_at=datetime(2030, 12, 20)).where(DonationDb.id == donation.id)
+        )
+        await donations_db.donation_paid(
+            donation_id=donation.id, amount=10, paid_at=datetime(2030, 12, 20), claimed_at=datetime(2030, 12, 21),
+        )
+        partition = await db_session.execute(select(text('tableoid::regclass::text')).where(DonationDb.id == donation.id))
+        assert partition.scalar() == 'donation_y2030m12'
+
+    async def rebuild() -> tuple:
+        async with db.session() as db_session:
+            stats_db = DonatorStatsDbLib(db_session)
+            await stats_db.rebuild_donator_stats()
+            await stats_db.refresh_total_received(receiver.id)
+            await OtherDbLib(db_session).rebuild_donatee_leaderboard()
+            last_donated_at = await db_session.execute(select(DonateeLeaderboardDb.last_donated_at))
+            return (
+                await stats_db.query_donator_stats(donator.id),
+                await stats_db.query_donator_stats(receiver.id),
+                last_donated_at.scalar(),
+            )
+
+    totals = await rebuild()
+    assert totals == (
+        DonatorStats(total_donated=10, total_claimed=10, total_received=0),
+        DonatorStats(total_donated=0, total_claimed=0, total_received=10),
+        datetime(2030, 12, 20),
+    )
+    assert await detach_partitions(db, before=datetime(2031, 1, 1)) == ['donation_y2030m12']
+    async with db.session() as db_session:
+        donations_db = DonationsDbLib(db_session)
+        assert await donations_db.query_donations(DonationDb.id == donation.id) == []
+        assert (await donations_db.query_donation(id=unpaid_donation_fixture.id)).id == unpaid_donation_fixture.id
+    # Detached donations are still counted
+    assert await rebuild() == totals
+
+
 async def test_listen_notify(db, pubsub):
     messages = ['123', 'qwe', 'asd']
     received = []
@@ -78,6 +242,433 @@ async def test_listen_notify(db, pubsub):
     assert received == sent
 
 
+async def test_listen_last_value(db, pubsub):
+    channel = 'channel'
+    notification = Notification(id=UUID(int=0), status='OK', message='last')
+    received = []
+
+    def callback(notification: str):
+        received.append(Notification(**json.loads(notification)))
+
+    async with pubsub.subscribe(channel, lambda notification: None):
+        async with db.session() as db_session:
+            await db_session.notify(channel, notification)
+        await asyncio.sleep(0.1)
+        # New subscriber should receive the last notification without waiting for a new one
+        async with pubsub.subscribe(channel, callback):
+            pass
+    assert received == [notification]
+
+
+async def test_notifications_batched_until_commit(db, pubsub):
+    channel = 'channel'
+    received = []
+
+    def callback(notification: str):
+        received.append(Notification(**json.loads(notification)))
+
+    async with pubsub.subscribe(channel, callback):
+        async with db.session() as db_session:
+            for message in ['first', 'second']:
+                await db_session.notify(channel, Notification(id=UUID(int=0), status='OK', message=message))
+            await db_session.notify(channel, Notification(id=UUID(int=1), status='OK', message='other'))
+            await asyncio.sleep(0.1)
+            # Nothing is sent before commit
+            assert received == []
+        with pytest.raises(ZeroDivisionError):
+            async with db.session() as db_session:
+                await db_session.notify(channel, Notification(id=UUID(int=2), status='OK', message='rolled back'))
+                1 / 0
+        await asyncio.sleep(0.1)
+    # Only the last notification for each object is sent and rolled back ones are discarded
+    assert [notification.message for notification in received] == ['second', 'other']
+
+
+async def test_social_account_notification(db, pubsub, unpaid_donation_fixture):
+    channel = f'social:youtube:{unpaid_donation_fixture.youtube_channel.id}'
+    received = []
+
+    def callback(notification: str):
+        received.append(SocialAccountNotification.parse_raw(notification))
+
+    async with pubsub.subscribe(channel, callback):
+        async with db.session() as db_session:
+            await DonationsDbLib(db_session).donation_paid(
+                donation_id=unpaid_donation_fixture.id, amount=unpaid_donation_fixture.amount, paid_at=datetime.utcnow(),
+            )
+        await asyncio.sleep(0.1)
+    # Notification carries the new state so subscribers don't need to refetch the account
+    assert [(notification.balance, notification.total_donated) for notification in received] == [(20, 20)]
+
+
+async def test_donator_notification_has_no_balance(db, pubsub, unpaid_donation_fixture):
+    donator_id: UUID = unpaid_donation_fixture.donator.id
+    received = []
+    async with pubsub.subscribe(f'donator:{donator_id}', lambda payload: received.append(json.loads(payload))):
+        async with db.session() as db_session:
+            await DonationsDbLib(db_session).donation_paid(
+                donation_id=unpaid_donation_fixture.id, amount=unpaid_donation_fixture.amount, paid_at=datetime.utcnow(),
+            )
+        await asyncio.sleep(0.1)
+    # Donator topics are not authenticated, so balance is fetched by the owner from /donator/me
+    assert received == [json.loads(Notification(id=donator_id, status='OK').json())]
+
+
+async def test_donatee_leaderboard(db, unpaid_donation_fixture):
+    async def query_leaderboard():
+        async with db.session() as db_session:
+            return (await db_session.execute(select(DonateeLeaderboardDb.__table__))).all()
+
+    async with db.session() as db_session:
+        await DonationsDbLib(db_session).donation_paid(
+            donation_id=unpaid_donation_fixture.id, amount=unpaid_donation_fixture.amount, paid_at=datetime.utcnow(),
+        )
+    async with db.session() as db_session:
+        assert await OtherDbLib(db_session).compact_balance_ledger(limit=100) == 1
+    [row] = await query_leaderboard()
+    assert (row.type, row.id, row.balance, row.total_donated) == ('youtube', unpaid_donation_fixture.youtube_channel.id, 20, 20)
+    assert row.last_donated_at is not None
+    async with db.session() as db_session:
+        await OtherDbLib(db_session).rebuild_donatee_leaderboard()
+    assert await query_leaderboard() == [row]
+
+
+async def test_balance_ledger(db, paid_donation_fixture):
+    youtube_channel: YoutubeChannel = paid_donation_fixture.youtube_channel
+    donator: Donator = paid_donation_fixture.donator
+    async with db.session() as db_session:
+        ledger = LedgerDbLib(db_session)
+        await ledger.change_balance(YoutubeChannelDb, youtube_channel.id, balance_diff=5, total_diff=5)
+        await ledger.change_balance(DonatorDb, donator.id, balance_diff=10)
+        assert (await db_session.execute(select(func.count(BalanceLedgerDb.id)))).scalar() == 3
+        assert (await YoutubeDbLib(db_session).query_account(id=youtube_channel.id)).balance == 25
+        assert (await db_session.query_donator(donator.id)).balance == 10
+    with pytest.raises(NotEnoughBalance):
+        async with db.session() as db_session:
+            await LedgerDbLib(db_session).change_balance(YoutubeChannelDb, youtube_channel.id, balance_diff=-26)
+    with pytest.raises(NoResultFound):
+        async with db.session() as db_session:
+            await LedgerDbLib(db_session).change_balance(YoutubeChannelDb, UUID(int=100), balance_diff=-1)
+    async with db.session() as db_session:
+        assert await OtherDbLib(db_session).compact_balance_ledger(limit=100) == 2
+        assert (await db_session.execute(select(func.count(BalanceLedgerDb.id)))).scalar() == 0
+        channel_row = (await db_session.execute(
+            select(YoutubeChannelDb.balance_snapshot, YoutubeChannelDb.total_donated_snapshot)
+            .where(YoutubeChannelDb.id == youtube_channel.id)
+        )).one()
+        assert tuple(channel_row) == (25, 25)
+        await LedgerDbLib(db_session).change_balance(YoutubeChannelDb, youtube_channel.id, balance_diff=-25)
+        assert (await YoutubeDbLib(db_session).query_account(id=youtube_channel.id)).balance == 0
+
+
+async def test_donator_stats_rollup(db, paid_donation_fixture):
+    donator: Donator = paid_donation_fixture.donator
+    async with db.session() as db_session:
+        await YoutubeDbLib(db_session).link_account(paid_donation_fixture.youtube_channel, donator, via_oauth=False)
+        stats_db = DonatorStatsDbLib(db_session)
+        stats: DonatorStats = await stats_db.query_donator_stats(donator.id)
+        assert stats == DonatorStats(total_donated=20, total_claimed=0, total_received=20)
+        await YoutubeDbLib(db_session).transfer_donations(paid_donation_fixture.youtube_channel, donator)
+        assert await YoutubeDbLib(db_session).stamp_transfers() == 1
+        stats = await stats_db.query_donator_stats(donator.id)
+        assert stats == DonatorStats(total_donated=20, total_claimed=20, total_received=20)
+        await stats_db.rebuild_donator_stats()
+        assert await stats_db.query_donator_stats(donator.id) == stats
+
+
+async def test_total_received_ledger(db, unpaid_donation_fixture):
+    receiver = Donator(id=UUID(int=5))
+    async with db.session() as db_session:
+        await db_session.save_donator(receiver)
+        await YoutubeDbLib(db_session).link_account(unpaid_donation_fixture.youtube_channel, receiver, via_oauth=False)
+        await DonationsDbLib(db_session).donation_paid(
+            donation_id=unpaid_donation_fixture.id, amount=unpaid_donation_fixture.amount, paid_at=datetime.utcnow(),
+        )
+        stats_db = DonatorStatsDbLib(db_session)
+        snapshot = select(DonatorStatsDb.total_received_snapshot).where(DonatorStatsDb.donator_id == receiver.id)
+        # Received donations do not update stats row of the receiver until the ledger is compacted
+        assert (await db_session.execute(snapshot)).scalar() == 0
+        assert (await stats_db.query_donator_stats(receiver.id)).total_received == 20
+        await OtherDbLib(db_session).compact_balance_ledger(limit=100)
+        assert (await db_session.execute(snapshot)).scalar() == 20
+        await stats_db.rebuild_donator_stats()
+        assert (await db_session.execute(snapshot)).scalar() == 20
+
+
+async def test_unloaded_ledger_columns(db, paid_donation_fixture):
+    async with db.session() as db_session:
+        [channel] = await YoutubeDbLib(db_session).query_accounts()
+        assert channel.balance == 20
+    async with db.session() as db_session:
+        channel_db: YoutubeChannelDb = (await db_session.execute(select(YoutubeChannelDb))).scalar_one()
+        with pytest.raises(InvalidDbState):
+            YoutubeChannel.from_orm(channel_db)
+        with unloaded_defaults(YoutubeChannelDb.balance, YoutubeChannelDb.total_donated):
+            assert YoutubeChannel.from_orm(channel_db).balance == 0
+
+
+async def test_transfer_stamping(db, paid_donation_fixture):
+    donator: Donator = paid_donation_fixture.donator
+    async with db.session() as db_session:
+        youtube_db = YoutubeDbLib(db_session)
+        assert await youtube_db.transfer_donations(paid_donation_fixture.youtube_channel, donator) == 20
+        donation: Donation = await DonationsDbLib(db_session).query_donation(id=paid_donation_fixture.id)
+        assert donation.claimed_at is None
+        # Not yet stamped transfer is taken into account
+        assert await OtherDbLib(db_session).audit_balances() == 0
+        db_session.pending_notifications.clear()
+        assert await OtherDbLib(db_session).stamp_transfers(limit=100) == 1
+        # Stamping sends a single notification for the account instead of one per donation
+        assert list(db_session.pending_notifications) == [
+            (f'social:youtube:{paid_donation_fixture.youtube_channel.id}', str(paid_donation_fixture.youtube_channel.id)),
+        ]
+        donation = await DonationsDbLib(db_session).query_donation(id=paid_donation_fixture.id)
+        assert donation.claimed_at is not None
+        assert await OtherDbLib(db_session).audit_balances() == 0
+        await db_session.execute(update(YoutubeChannelDb).values(balance=100))
+        assert await OtherDbLib(db_session).audit_balances() == 1
+
+
+async def test_transfer_stamping_late_donation(db, paid_donation_fixture):
+    donator: Donator = paid_donation_fixture.donator
+    async with db.session() as db_session:
+        await YoutubeDbLib(db_session).transfer_donations(paid_donation_fixture.youtube_channel, donator)
+        # Donation with the same paid_at committed after the transfer is not included into it
+        donations_db = DonationsDbLib(db_session)
+        late_donation: Donation = await donations_db.create_donation(Donation(
+            donator=donator, amount=10, youtube_channel=paid_donation_fixture.youtube_channel, r_hash=RequestHash(b'late'),
+        ))
+        await donations_db.donation_paid(donation_id=late_donation.id, amount=10, paid_at=paid_donation_fixture.paid_at)
+        assert await OtherDbLib(db_session).stamp_transfers(limit=100) == 1
+        assert (await donations_db.query_donation(id=paid_donation_fixture.id)).claimed_at is not None
+        assert (await donations_db.query_donation(id=late_donation.id)).claimed_at is None
+        assert await OtherDbLib(db_session).audit_balances() == 0
+        # The next transfer takes only the late donation
+        assert await YoutubeDbLib(db_session).transfer_donations(paid_donation_fixture.youtube_channel, donator) == 10
+        assert (await db_session.execute(select(TransferDb.donation_ids).where(TransferDb.stamped_at.is_(None)))).scalar() == [
+            late_donation.id,
+        ]
+
+
+async def test_cancel_transferred_donation(db, paid_donation_fixture):
+    async with db.session() as db_session:
+        await YoutubeDbLib(db_session).transfer_donations(paid_donation_fixture.youtube_channel, paid_donation_fixture.donator)
+    # Donation is not claimed until the transfer is stamped, but it's already paid out
+    with pytest.raises(UnableToCancelDonation):
+        async with db.session() as db_session:
+            await DonationsDbLib(db_session).cancel_donation(paid_donation_fixture.id)
+    async with db.session() as db_session:
+        donation: Donation = await DonationsDbLib(db_session).query_donation(id=paid_donation_fixture.id)
+        assert (donation.claimed_at, donation.cancelled_at) == (None, None)
+
+
+async def test_check_donators_connected(db):
+    donator = Donator(id=UUID(int=1), lnauth_pubkey='pubkey')
+    async with db.session() as db_session:
+        await db_session.save_donator(donator)
+        assert (await db_session.query_donator(donator.id)).connected == True  # noqa
+        await db_session.execute(update(DonatorDb).values(connected=False))
+    assert await check_donators_connected() == 1
+    async with db.session() as db_session:
+        assert (await db_session.query_donator(donator.id)).connected == True  # noqa
+    assert await check_donators_connected() == 0
+
+
+async def test_read_only_session(db):
+    donator = Donator(id=UUID(int=1))
+    async with db.session() as db_session:
+        await db_session.save_donator(donator)
+    async with db.read_only_session() as db_session:
+        assert (await db_session.query_donator(donator.id)).id == donator.id
+    with pytest.raises(sqlalchemy.exc.DBAPIError):
+        async with db.read_only_session() as db_session:
+            await db_session.execute(update(DonatorDb).values(balance=100))
+
+
+@pytest.fixture
+async def replicated_db(db):
+    """
+    Replica is a separate database without replication, so it's possible to tell where a query was routed.
+    Set DONATE4FUN_TEST_REPLICA_URL to use another Postgres instance.
+    """
+    async with create_db('donate4fun-test-replica', os.getenv('DONATE4FUN_TEST_REPLICA_URL')) as replica:
+        replicated_db = Database(DbSettings(
+            url=db.engine.url.render_as_string(hide_password=False),
+            replica_urls=[replica.engine.url.render_as_string(hide_password=False)],
+        ))
+        try:
+            yield replicated_db
+        finally:
+            await replicated_db.dispose()
+
+
+async def test_replica_routing(replicated_db):
+    donator = Donator(id=UUID(int=1))
+    async with replicated_db.session() as db_session:
+        await db_session.save_donator(donator)
+    [replica] = replicated_db.replicas
+    async with replicated_db.read_only_session() as db_session:
+        assert db_session.session.bind is replica.engine
+        with pytest.raises(sqlalchemy.orm.exc.NoResultFound):
+            await db_session.query_donator(donator.id)
+    # Read your writes
+    async with replicated_db.read_only_session(use_replica=False) as db_session:
+        assert db_session.session.bind is replicated_db.engine
+        await db_session.query_donator(donator.id)
+    # Lagging replica
+    replicated_db.settings.max_replica_lag = timedelta(seconds=-1)
+    replica.checked_at = -float('inf')
+    async with replicated_db.read_only_session() as db_session:
+        assert db_session.session.bind is replicated_db.engine
+
+
+async def test_replica_lag_check_timeout(replicated_db):
+    [replica] = replicated_db.replicas
+
+    async def slow_query_lag():
+        await asyncio.sleep(1)
+        return 0
+
+    replica.query_lag = slow_query_lag
+    replicated_db.settings.replica_lag_check_timeout = timedelta(milliseconds=10)
+    async with replicated_db.read_only_session() as db_session:
+        assert db_session.session.bind is replicated_db.engine
+    assert replica.lag is None
+
+
+async def test_last_value_cache_eviction():
+    cache = LastValueCache(size=2, ttl=60)
+    for topic in ['first', 'second', 'third']:
+        cache.track(topic)
+        cache.update(topic, topic)
+    assert cache.evict() == ['first']
+    assert cache.get('first') is None
+    assert cache.get('third') == 'third'
+
+
+async def test_token_bucket():
+    bucket = TokenBucket(rate=1, burst=2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert 0 < bucket.acquire() <= 1
+
+
 async def test_db(db_session):
     db_status = await db_session.query_status()
     assert db_status == 'ok'
+
+
+async def test_pool_sizing(db):
+    await db.prewarm()
+    pool = db.engine.pool
+    assert pool.checkedin() == pool.size()
+    pool.take_stats()
+    async with db.session(), db.session():
+        pass
+    average_wait, peak_checkedout = pool.take_stats()
+    assert peak_checkedout == 2
+    settings = DbSettings(url='', pool_size_min=1, pool_size_max=pool.size(), pool_wait_target=timedelta(0))
+    adapt_pool_size(pool, settings)
+    assert pool.size() == settings.pool_size_max - 1
+    async with db.session():
+        assert pool.checkedout() == 1
+    assert pool.checkedin() == pool.size()
+
+
+async def test_pool_resize_under_load(db):
+    await db.prewarm()
+    pool = db.engine.pool
+    holders_count: int = pool.size() + 2
+    release = asyncio.Event()
+
+    async def hold_connection():
+        async with db.engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+            await release.wait()
+
+    holders = [asyncio.create_task(hold_connection()) for _ in range(holders_count)]
+    while pool.checkedout() < holders_count:
+        await asyncio.sleep(0.01)
+    # Overflow connections are already open, shrinking and growing should not change the number of checked out ones
+    for size in [1, holders_count - 1, 2]:
+        pool.resize(size)
+        assert (pool.size(), pool.checkedout()) == (size, holders_count)
+    release.set()
+    await asyncio.gather(*holders)
+    # Connections above the new size are closed on return
+    assert (pool.checkedout(), pool.checkedin(), pool.overflow()) == (0, 2, 0)
+    async with db.session(), db.session(), db.session():
+        assert (pool.checkedout(), pool.overflow()) == (3, 1)
+    assert (pool.checkedout(), pool.checkedin(), pool.overflow()) == (0, 2, 0)
+
+
+def test_engine_options():
+    # Used by alembic/env.py too, so every DbSettings field should be either an engine option or excluded from them
+    settings = DbSettings(
+        url='postgresql+asyncpg://localhost/donate4fun', pgbouncer=True, replica_urls=['postgresql+asyncpg://replica/'],
+    )
+    engine = create_async_engine(**engine_options(settings))
+    assert engine.url.host == 'localhost'
+
+
+async def test_listen_engine(db):
+    url: str = db.engine.url.render_as_string(hide_password=False)
+    listen_db = Database(DbSettings(url=url, listen_url=url, pool_size=3, isolation_level='SERIALIZABLE'))
+    try:
+        assert isinstance(listen_db.listen_engine.pool, sqlalchemy.pool.NullPool)
+        async with listen_db.listen_engine.connect() as connection:
+            assert (await connection.execute(text('SHOW transaction_isolation'))).scalar() == 'serializable'
+    finally:
+        await listen_db.dispose()
+
+
+async def test_query_budget(db):
+    async with db.session() as db_session:
+        async with db_session.query_budget('test', QueryBudget(statement_timeout=timedelta(seconds=1), max_queries=2)):
+            assert (await db_session.execute(text("SELECT current_setting('statement_timeout')"))).scalar() == '1s'
+            await db_session.execute(select(1))
+            with pytest.raises(QueryBudgetExceeded):
+                await db_session.execute(select(1))
+        assert (await db_session.execute(text("SELECT current_setting('statement_timeout')"))).scalar() == '0'
+    with pytest.raises(QueryBudgetExceeded):
+        async with db.session() as db_session:
+            async with db_session.query_budget('test', QueryBudget(statement_timeout=timedelta(milliseconds=10))):
+                await db_session.execute(select(func.pg_sleep(1)))
+
+
+async def test_transaction_retry(db):
+    donator_id = UUID(int=1)
+    async with db.session() as db_session:
+        await db_session.save_donator(Donator(id=donator_id))
+    attempts = 0
+
+    async def add_balance(db_session, amount: int):
+        nonlocal attempts
+        attempts += 1
+        # Takes a snapshot
+        await db_session.query_donator(id=donator_id)
+        if attempts == 1:
+            async with db.session() as concurrent_session:
+                await concurrent_session.execute(
+                    update(DonatorDb).values(balance=DonatorDb.balance_snapshot + 1).where(DonatorDb.id == donator_id)
+                )
+        await db_session.execute(
+            update(DonatorDb).values(balance=DonatorDb.balance_snapshot + amount).where(DonatorDb.id == donator_id)
+        )
+
+    await db.transact(add_balance, 10)
+    assert attempts == 2
+    assert transaction_retries.values[('test_transaction_retry.<locals>.add_balance', '40001')] == 1
+    async with db.session() as db_session:
+        assert (await db_session.query_donator(id=donator_id)).balance == 11
+
+
+async def test_async_commit_session(db):
+    async with db.async_commit_session() as db_session:
+        assert (await db_session.execute(text("SELECT current_setting('synchronous_commit')"))).scalar() == 'off'
+        await YoutubeDbLib(db_session).save_account(YoutubeChannel(channel_id='async-commit', title='async commit'))
+        with pytest.raises(InvalidDbState):
+            await LedgerDbLib(YoutubeDbLib(db_session)).change_balance(DonatorDb, UUID(int=1), balance_diff=1)
+    async with db.session() as db_session:
+        assert (await db_session.execute(text("SELECT current_setting('synchronous_commit')"))).scalar() == 'on'
+        assert (await YoutubeDbLib(db_session).find_youtube_channel(channel_id='async-commit')).title == 'async commit'
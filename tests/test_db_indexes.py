@@ -0,0 +1,138 @@
+import json
+from uuid import UUID
+
+import pytest
+from sqlalchemy import select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from donate4fun.db_models import DonationDb
+from donate4fun.db_donations import donations_query
+from donate4fun.db_stats import sent_donations_subquery
+from donate4fun.db_social import claimable_donation_filter
+
+
+pytestmark = pytest.mark.anyio
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def visit_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kwargs)
+
+
+def used_indexes(plan: dict) -> set[str]:
+    indexes = {plan['Index Name']} if 'Index Name' in plan else set()
+    for subplan in plan.get('Plans', []):
+        indexes |= used_indexes(subplan)
+    return indexes
+
+
+@pytest.fixture
+async def seeded_db(db):
+    """
+    Fills donation table with enough rows to make sequential scans more expensive than index scans
+    """
+    async with db.session() as db_session:
+        for statement in [
+            "INSERT INTO donator (id) SELECT uuid_generate_v4() FROM generate_series(1, 1000)",
+            """
+            INSERT INTO youtube_channel (channel_id)
+            SELECT 'channel-' || i FROM generate_series(1, 1000) AS i
+            """,
+            """
+            INSERT INTO twitter_author (user_id, handle)
+            SELECT i, 'handle-' || i FROM generate_series(1, 1000) AS i
+            """,
+            """
+            WITH
+                donators AS (SELECT array_agg(id) AS ids FROM donator),
+                channels AS (SELECT array_agg(id) AS ids FROM youtube_channel),
+                authors AS (SELECT array_agg(id) AS ids FROM twitter_author)
+            INSERT INTO donation (
+                amount, created_at, paid_at, cancelled_at, claimed_at,
+                donator_id, receiver_id, youtube_channel_id, twitter_account_id
+            )
+            SELECT
+                100,
+                now() - i * interval '1 minute',
+                CASE WHEN i % 10 != 0 THEN now() - i * interval '1 minute' END,
+                CASE WHEN i % 50 = 0 THEN now() END,
+                CASE WHEN i % 7 != 0 THEN now() END,
+                donators.ids[1 + i % 1000],
+                CASE WHEN i % 3 = 0 THEN donators.ids[1 + (i + 1) % 1000] END,
+                CASE WHEN i % 3 = 1 THEN channels.ids[1 + i % 1000] END,
+                CASE WHEN i % 3 = 2 THEN authors.ids[1 + i % 1000] END
+            FROM generate_series(1, 100000) AS i, donators, channels, authors
+            """,
+            # Refresh planner statistics
+            "ANALYZE",
+        ]:
+            await db_session.execute(text(statement))
+    return db
+
+
+async def explain(db, query) -> set[str]:
+    """
+    Returns names of used indexes, indexes of donation partitions are replaced with indexes of the partitioned table
+    """
+    async with db.session() as db_session:
+        result = await db_session.execute(Explain(query))
+        plan = result.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        result = await db_session.execute(text("""
+            SELECT child.relname AS name, parent.relname AS parent_name
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            WHERE child.relkind = 'i'
+        """))
+        parent_indexes: dict[str, str] = {row.name: row.parent_name for row in result.all()}
+        return {parent_indexes.get(name, name) for name in used_indexes(plan[0]['Plan'])}
+
+
+async def first_id(db, column) -> UUID:
+    async with db.session() as db_session:
+        return (await db_session.execute(select(column).where(column.isnot(None)).limit(1))).scalar()
+
+
+async def test_latest_donations_index(seeded_db):
+    query = donations_query(
+        DonationDb.paid_at.isnot(None)
+        & DonationDb.cancelled_at.is_(None)
+        & ((DonationDb.receiver_id != DonationDb.donator_id) | DonationDb.receiver_id.is_(None))
+    )
+    assert 'donation_settled_idx' in await explain(seeded_db, query)
+
+
+async def test_donator_donations_index(seeded_db):
+    donator_id = await first_id(seeded_db, DonationDb.donator_id)
+    query = select(sent_donations_subquery(donator_id).c.id)
+    assert 'donation_donator_id_idx' in await explain(seeded_db, query)
+
+
+async def test_receiver_donations_index(seeded_db):
+    receiver_id = await first_id(seeded_db, DonationDb.receiver_id)
+    query = donations_query(DonationDb.paid_at.isnot(None) & (DonationDb.receiver_id == receiver_id))
+    assert 'donation_receiver_id_idx' in await explain(seeded_db, query)
+
+
+@pytest.mark.parametrize('column', [DonationDb.youtube_channel_id, DonationDb.twitter_account_id])
+async def test_donatee_donations_index(seeded_db, column):
+    account_id = await first_id(seeded_db, column)
+    query = donations_query((column == account_id) & DonationDb.paid_at.isnot(None))
+    assert f'donation_{column.key}_idx' in await explain(seeded_db, query)
+
+
+@pytest.mark.parametrize('column', [DonationDb.youtube_channel_id, DonationDb.twitter_account_id])
+async def test_claimable_donations_index(seeded_db, column):
+    account_id = await first_id(seeded_db, column)
+    query = select(DonationDb.amount).where(claimable_donation_filter() & (column == account_id))
+    assert f'donation_{column.key}_claimable_idx' in await explain(seeded_db, query)
@@ -0,0 +1,49 @@
+import logging
+
+from donate4fun import metrics
+from donate4fun.metrics import normalize_statement, Histogram, request_queries_count, query_budget_exceeded
+from donate4fun.settings import QueryBudget
+
+from tests.test_util import check_response
+
+
+def test_normalize_statement():
+    assert normalize_statement(
+        "SELECT a FROM t\n  WHERE x = $1 AND y IN ($2, $3, $4) AND z = 'it''s' LIMIT 10"
+    ) == "SELECT a FROM t WHERE x = ? AND y IN (?) AND z = ? LIMIT ?"
+    assert normalize_statement("INSERT INTO t (a, b) VALUES ($1, $2), ($3, $4)") == "INSERT INTO t (a, b) VALUES (?)"
+
+
+def test_histogram(monkeypatch):
+    # Do not expose the test histogram at /metrics
+    monkeypatch.setattr(metrics, 'registry', [])
+    histogram = Histogram('test_histogram', "Test histogram", ('label',), buckets=(1, 2))
+    for value in [1, 1.5, 3]:
+        histogram.observe('a', value=value)
+    assert list(histogram.samples()) == [
+        'test_histogram_bucket{label="a",le="1"} 1',
+        'test_histogram_bucket{label="a",le="2"} 2',
+        'test_histogram_bucket{label="a",le="+Inf"} 3',
+        'test_histogram_count{label="a"} 3',
+        'test_histogram_sum{label="a"} 5.5',
+    ]
+
+
+async def test_query_stats(client, settings, caplog):
+    settings.metrics.server_timing = True
+    settings.metrics.repeated_statement_threshold = 0
+    requests_before: int = sum(sum(value.counts) for value in request_queries_count.values.values())
+    with caplog.at_level(logging.WARNING, logger='donate4fun.metrics'):
+        response = check_response(await client.get('/api/v1/me'))
+    assert response.headers['server-timing'].startswith('db;dur=')
+    assert 'executed the same statement' in caplog.text
+    metrics = check_response(await client.get('/metrics')).text
+    assert '# TYPE db_statement_seconds histogram' in metrics
+    assert sum(sum(value.counts) for value in request_queries_count.values.values()) == requests_before + 2
+
+
+async def test_query_budget_exceeded(client, settings):
+    settings.query_budget = QueryBudget(max_queries=0)
+    response = check_response(await client.get('/api/v1/me'), 503)
+    assert 'max_queries' in response.json()['message']
+    assert sum(query_budget_exceeded.values.values()) >= 1
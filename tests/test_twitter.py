@@ -229,6 +229,7 @@ async def test_transfer_from_twitter(client, db, rich_donator, settings):
         assert account.balance == 0
         donator = await db_session.query_donator(id=rich_donator.id)
         assert donator.balance == amount
+        await TwitterDbLib(db_session).stamp_transfers()
         donation = await DonationsDbLib(db_session).query_donation(id=donation.id)
         assert donation.claimed_at != None  # noqa
 
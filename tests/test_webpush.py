@@ -0,0 +1,180 @@
+import json
+import os
+from datetime import datetime
+from uuid import UUID
+
+import pytest
+import httpx
+from fastapi import FastAPI, Request, Response
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy import select
+
+from donate4fun.core import to_base64url, from_base64url
+from donate4fun.models import Donator, Notification, PushSubscription, PushSubscriptionKeys
+from donate4fun.db_models import PushSubscriptionDb, PushDeliveryDb
+from donate4fun.db_push import PushDbLib
+from donate4fun.db_donations import DonationsDbLib
+from donate4fun.webpush import encrypt_payload, hkdf, public_key_bytes, WebPushSender, dispatch_push_deliveries
+
+from tests.test_util import check_response
+from tests.fixtures import find_unused_port, app_serve
+
+
+class UserAgent:
+    """
+    Browser side of a push subscription
+    """
+    def __init__(self):
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.auth: bytes = os.urandom(16)
+
+    @property
+    def keys(self) -> PushSubscriptionKeys:
+        return PushSubscriptionKeys(
+            p256dh=to_base64url(public_key_bytes(self.private_key.public_key())),
+            auth=to_base64url(self.auth),
+        )
+
+    def decrypt(self, body: bytes) -> bytes:
+        salt = body[:16]
+        key_length = body[20]
+        as_public = body[21:21 + key_length]
+        as_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), as_public)
+        shared_secret = self.private_key.exchange(ec.ECDH(), as_key)
+        ua_public = public_key_bytes(self.private_key.public_key())
+        ikm = hkdf(self.auth, shared_secret, b'WebPush: info\x00' + ua_public + as_public, 32)
+        cek = hkdf(salt, ikm, b'Content-Encoding: aes128gcm\x00', 16)
+        nonce = hkdf(salt, ikm, b'Content-Encoding: nonce\x00', 12)
+        plaintext = AESGCM(cek).decrypt(nonce, body[21 + key_length:], None)
+        assert plaintext.endswith(b'\x02')
+        return plaintext[:-1]
+
+
+def test_encrypt_payload():
+    user_agent = UserAgent()
+    body = encrypt_payload(b'payload', p256dh=user_agent.keys.p256dh, auth=user_agent.keys.auth)
+    assert user_agent.decrypt(body) == b'payload'
+
+
+@pytest.fixture
+def push_settings(settings):
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    settings.push.vapid_private_key = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+    ).decode()
+    settings.push.allowed_hosts = [*settings.push.allowed_hosts, 'push.example.com']
+    return settings.push
+
+
+@pytest.fixture
+async def push_service():
+    """
+    Local stand-in for a browser push service
+    """
+    app = FastAPI()
+    app.received = []
+
+    @app.post('/push/{name}')
+    async def push(name: str, request: Request):
+        if name == 'expired':
+            return Response(status_code=410)
+        app.received.append((request.headers, await request.body()))
+        return Response(status_code=201)
+
+    port: int = find_unused_port()
+    async with app_serve(app, port):
+        app.url = f'http://localhost:{port}'
+        yield app
+
+
+async def test_push_delivery(db, push_settings, push_service):
+    push_settings.allowed_hosts = ['localhost']
+    push_settings.allow_http = True
+    user_agent = UserAgent()
+    donator = Donator(id=UUID(int=1))
+    async with db.session() as db_session:
+        await db_session.save_donator(donator)
+        push_db = PushDbLib(db_session)
+        for name in ['active', 'expired']:
+            await push_db.save_subscription(donator.id, PushSubscription(
+                endpoint=f'{push_service.url}/push/{name}', keys=user_agent.keys,
+            ))
+    for message in ['first', 'last']:
+        async with db.session() as db_session:
+            await db_session.object_changed('donator', donator.id, Notification(id=donator.id, status='OK', message=message))
+    async with httpx.AsyncClient() as client:
+        assert await dispatch_push_deliveries(db, WebPushSender(push_settings, client)) == 2
+    # Only the latest state is delivered
+    [(headers, body)] = push_service.received
+    assert headers['content-encoding'] == 'aes128gcm'
+    assert headers['authorization'].startswith('vapid t=')
+    message = json.loads(user_agent.decrypt(body))
+    assert message['topic'] == f'donator:{donator.id}'
+    assert message['notification']['message'] == 'last'
+    async with db.session() as db_session:
+        subscriptions = (await db_session.execute(select(PushSubscriptionDb.endpoint))).scalars().all()
+        assert subscriptions == [f'{push_service.url}/push/active']
+        assert (await db_session.execute(select(PushDeliveryDb))).all() == []
+
+
+async def test_push_delivery_to_invalid_endpoint(db, push_settings):
+    donator = Donator(id=UUID(int=1))
+    async with db.session() as db_session:
+        await db_session.save_donator(donator)
+        await PushDbLib(db_session).save_subscription(donator.id, PushSubscription(
+            endpoint='https://169.254.169.254/latest/meta-data', keys=UserAgent().keys,
+        ))
+    async with db.session() as db_session:
+        await db_session.object_changed('donator', donator.id, Notification(id=donator.id, status='OK'))
+    async with httpx.AsyncClient() as client:
+        assert await dispatch_push_deliveries(db, WebPushSender(push_settings, client)) == 1
+    async with db.session() as db_session:
+        assert (await db_session.execute(select(PushSubscriptionDb))).all() == []
+
+
+async def test_push_delivery_on_donation_paid(db, push_settings, unpaid_donation_fixture):
+    donator_id = unpaid_donation_fixture.donator.id
+    async with db.session() as db_session:
+        await PushDbLib(db_session).save_subscription(donator_id, PushSubscription(
+            endpoint='https://push.example.com/1', keys=UserAgent().keys,
+        ))
+    async with db.session() as db_session:
+        # Notifies 'donations' channel too, which is not an object channel
+        await DonationsDbLib(db_session).donation_paid(
+            donation_id=unpaid_donation_fixture.id,
+            amount=unpaid_donation_fixture.amount,
+            paid_at=datetime.now(),
+        )
+    async with db.session() as db_session:
+        [payload] = (await db_session.execute(select(PushDeliveryDb.payload))).scalars().all()
+        assert json.loads(payload)['topic'] == f'donator:{donator_id}'
+
+
+async def test_push_subscription_api(client, push_settings):
+    response = check_response(await client.get('/api/v1/push/vapid-public-key')).json()
+    assert len(from_base64url(response['public_key'])) == 65
+    subscription = dict(endpoint='https://push.example.com/1', keys=UserAgent().keys.dict())
+    check_response(await client.post('/api/v1/push/subscription', json=subscription))
+    check_response(await client.post('/api/v1/push/unsubscribe', json=dict(endpoint=subscription['endpoint'])))
+
+
+@pytest.mark.parametrize('endpoint', [
+    'http://push.example.com/1',
+    'https://localhost/1',
+    'https://127.0.0.1/1',
+    'https://169.254.169.254/latest/meta-data',
+    'https://push.example.com.evil.com/1',
+    'https://push.example.com@10.0.0.1/1',
+])
+async def test_push_subscription_invalid_endpoint(client, push_settings, endpoint):
+    subscription = dict(endpoint=endpoint, keys=UserAgent().keys.dict())
+    response = await client.post('/api/v1/push/subscription', json=subscription)
+    assert response.status_code == 400, response.text
+
+
+async def test_push_subscription_disabled(client):
+    subscription = dict(endpoint='https://push.example.com/1', keys=UserAgent().keys.dict())
+    response = await client.post('/api/v1/push/subscription', json=subscription)
+    assert response.status_code == 503, response.text
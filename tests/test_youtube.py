@@ -156,6 +156,7 @@ async def test_transfer_from_youtube(client, db, paid_donation_fixture, register
         assert channel.balance == 0
         donator = await db_session.query_donator(id=registered_donator.id)
         assert donator.balance == amount
+        await YoutubeDbLib(db_session).stamp_transfers()
         donation = await DonationsDbLib(db_session).query_donation(id=paid_donation_fixture.id)
         assert donation.claimed_at != None  # noqa
 